@@ -0,0 +1,4 @@
+"""
+Banc d'essai synthétique : données à transformations connues, remplaçant Python
+de featMatchMultiple et chronométrage des trois scripts du pipeline.
+"""
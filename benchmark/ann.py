@@ -0,0 +1,121 @@
+import os
+import time
+import shutil
+import argparse
+
+from benchmark.harness import executer, tre_oracle, tre_predictions
+from benchmark.synthetique import ajouter_arguments_generation, generer
+from recalage.index_ann import IndexANN, build_ann_index, chemin_index_defaut
+from recalage.keys import lire_fichier_key
+from recalage.matching import RATIO_DEFAUT, apparier_descripteurs
+
+"""
+Benchmark de l'index approché (--matcher ann) contre le matching exhaustif paire par paire (--matcher python).
+
+1. Appariements : pour chaque réglage (nprobe, candidats, re-classement), temps par patient et rappel/précision
+   des appariements de l'index par rapport à ceux du matching exhaustif (même test du ratio).
+2. Bout en bout : predict_landmarks.py avec les deux matchers, durée et TRE (et TRE oracle).
+"""
+
+def liste_entiers(texte):
+    return [int(v) for v in texte.split(",")]
+
+def comparer_appariements(index, patients, atlases, args):
+    """Lignes (nprobe, candidats, rerank, temps_ms/patient, rappel, précision) + temps exhaustif."""
+    kps_atlas = [lire_fichier_key(p) for p in atlases]
+    requetes = [lire_fichier_key(p).descripteurs for p in patients]
+
+    t0 = time.perf_counter()
+    reference = [[apparier_descripteurs(q, kp.descripteurs, ratio=args.ratio) for kp in kps_atlas] for q in requetes]
+    duree_exhaustif = (time.perf_counter() - t0) / len(patients)
+    n_reference = sum(len(i) for par_atlas in reference for i, _ in par_atlas)
+
+    lignes = []
+    for rerank in (True, False):
+        for nprobe in args.nprobes:
+            for n_candidats in args.candidates:
+                trouves = corrects = 0
+                t0 = time.perf_counter()
+                resultats = [index.apparier(q, args.ratio, nprobe=nprobe, n_candidats=n_candidats, rerank=rerank)
+                             for q in requetes]
+                duree = (time.perf_counter() - t0) / len(patients)
+                for ref, res in zip(reference, resultats):
+                    for a, (i_pat, i_atl) in enumerate(ref):
+                        if a not in res: continue
+                        attendus = set(zip(i_pat.tolist(), i_atl.tolist()))
+                        obtenus = set(zip(res[a][0].tolist(), res[a][1].tolist()))
+                        trouves += len(obtenus)
+                        corrects += len(attendus & obtenus)
+                lignes.append((nprobe, n_candidats, rerank, duree, corrects / max(n_reference, 1), corrects / max(trouves, 1)))
+    return duree_exhaustif, lignes
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Benchmark de l'index ANN (IVF-PQ) contre le matching exhaustif.")
+    parser.add_argument("--patients", type=int, default=2, help="Nombre de patients")
+    parser.add_argument("--atlases", type=int, default=50, help="Nombre d'atlas")
+    parser.add_argument("--workdir", default="benchmark_runs/ann", help="Dossier de travail")
+    parser.add_argument("--csv", help="CSV des résultats (défaut: <workdir>/ann.csv)")
+    parser.add_argument("--nprobes", type=liste_entiers, default=[1, 4, 8, 16], help="Valeurs de nprobe, ex: 1,4,8")
+    parser.add_argument("--candidates", type=liste_entiers, default=[2, 4], help="Candidats par (descripteur, atlas), ex: 2,4")
+    parser.add_argument("--ratio", type=float, default=RATIO_DEFAUT, help="Test du ratio")
+    parser.add_argument("--k", type=int, default=5, help="K de la fusion (bout en bout)")
+    parser.add_argument("--min_samples", type=int, default=5, help="RANSAC : min_samples")
+    parser.add_argument("--threshold", type=float, default=10.0, help="RANSAC : seuil des résidus")
+    parser.add_argument("--no_end_to_end", dest="bout_en_bout", action="store_false", help="Appariements seulement")
+    parser.add_argument("--keep", action="store_true", help="Conserve les données générées")
+    ajouter_arguments_generation(parser)
+    return parser.parse_args()
+
+def main():
+    args = parse_arguments()
+    args.workdir = os.path.abspath(args.workdir)
+    if os.path.exists(args.workdir): shutil.rmtree(args.workdir)
+    path_csv = args.csv or os.path.join(args.workdir, "ann.csv")
+
+    print(f"--- BENCHMARK INDEX ANN ({args.patients} patients x {args.atlases} atlas, {args.keypoints} keypoints) ---")
+    gen_args = argparse.Namespace(**{**vars(args), "output": args.workdir, "matches": False})
+    verite = generer(gen_args)
+    dossier_patients, dossier_atlases = os.path.join(args.workdir, "patients"), os.path.join(args.workdir, "atlases")
+    ids_patients = [s for s in sorted(verite["affines"]) if s.startswith("sub-P")]
+    ids_atlases = [s for s in sorted(verite["affines"]) if s.startswith("sub-A")]
+    patients = [os.path.join(dossier_patients, f"{p}_T1w.key") for p in ids_patients]
+    atlases = [os.path.join(dossier_atlases, f"{a}_T1w.key") for a in ids_atlases]
+
+    path_index = chemin_index_defaut(dossier_atlases)
+    t0 = time.perf_counter()
+    build_ann_index(path_index, atlas_dir=dossier_atlases, verbose=False)
+    duree_construction = time.perf_counter() - t0
+    index = IndexANN(path_index)
+    print(f"Index : {index.parametres['n_listes']} listes, {os.path.getsize(path_index) / 1e6:.1f} Mo, construit en {duree_construction:.1f} s")
+
+    duree_exhaustif, lignes = comparer_appariements(index, patients, atlases, args)
+    print(f"\n{'nprobe':>7}{'cand.':>7}{'rerank':>8}{'ms/patient':>12}{'accél.':>8}{'rappel':>9}{'précision':>11}")
+    print(f"{'exhaustif':>22}{'':>8}{duree_exhaustif * 1000:>12.1f}{1.0:>8.1f}{1.0:>9.3f}{1.0:>11.3f}")
+    with open(path_csv, 'w') as f:
+        f.write("methode,nprobe,candidats,rerank,duree_ms_patient,rappel,precision,TRE_mm\n")
+        f.write(f"exhaustif,,,,{duree_exhaustif * 1000:.2f},1,1,\n")
+        for nprobe, n_candidats, rerank, duree, rappel, precision in lignes:
+            f.write(f"ann,{nprobe},{n_candidats},{int(rerank)},{duree * 1000:.2f},{rappel:.4f},{precision:.4f},\n")
+            print(f"{nprobe:>7}{n_candidats:>7}{'oui' if rerank else 'non':>8}{duree * 1000:>12.1f}"
+                  f"{duree_exhaustif / duree:>8.1f}{rappel:>9.3f}{precision:>11.3f}")
+
+        if args.bout_en_bout:
+            print(f"\n{'matcher':<10}{'durée_s':>10}{'TRE_mm':>9}")
+            for matcher in ("python", "ann"):
+                sortie = os.path.join(args.workdir, f"predictions_{matcher}")
+                duree = executer("predict_landmarks.py", ["--input", dossier_patients, "--atlas_dir", dossier_atlases,
+                                                          "--output", sortie, "--matcher", matcher, "--k", args.k,
+                                                          "--min_samples", args.min_samples, "--threshold", args.threshold],
+                                 os.path.join(args.workdir, f"predict_{matcher}.log"))
+                tre = tre_predictions(sortie, args.workdir, ids_patients)
+                f.write(f"predict_{matcher},,,,{duree * 1000 / len(patients):.2f},,,{tre:.4f}\n")
+                print(f"{matcher:<10}{duree:>10.2f}{tre:>9.3f}")
+            print(f"{'oracle':<10}{'':>10}{tre_oracle(args.workdir, verite, ids_patients, ids_atlases):>9.3f}")
+
+    print(f"\nRésultats : {path_csv}")
+    if not args.keep:
+        for dossier in (dossier_patients, dossier_atlases): shutil.rmtree(dossier)
+        os.remove(path_index)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+import os
+import sys
+import time
+import argparse
+import statistics
+import subprocess
+
+"""
+Contrôle du temps de démarrage des scripts : `--help` ne doit charger ni sklearn ni
+matplotlib, et rester sous un budget de temps. Code de sortie 1 en cas de régression
+(utilisable en intégration continue).
+"""
+
+RACINE = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCRIPTS = ["generate_matches.py", "top_K.py", "predict_landmarks.py", "prediction_server.py",
+           "build_atlas_bank.py", "build_ann_index.py", "convert_matches.py", "reduce_atlases.py"]
+MODULES_LOURDS = ["sklearn", "matplotlib"]
+
+# Importe le script comme module (sans exécuter main) et liste les modules lourds chargés
+SONDE = ("import sys, importlib; importlib.import_module(sys.argv[1]); "
+         "print(','.join(m for m in sys.argv[2:] if m in sys.modules))")
+
+def temps_aide(script, repetitions):
+    """Médiane du temps mur de `python <script> --help`."""
+    durees = []
+    for _ in range(repetitions):
+        t0 = time.perf_counter()
+        subprocess.run([sys.executable, os.path.join(RACINE, script), "--help"], cwd=RACINE,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+        durees.append(time.perf_counter() - t0)
+    return statistics.median(durees)
+
+def modules_lourds(script):
+    sortie = subprocess.run([sys.executable, "-c", SONDE, script[:-len(".py")]] + MODULES_LOURDS, cwd=RACINE,
+                            capture_output=True, text=True, check=True).stdout.strip()
+    return [m for m in sortie.split(",") if m]
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Vérifie le temps de démarrage des scripts (--help).")
+    parser.add_argument("--budget", type=float, default=0.5, help="Temps maximal de `--help`, en secondes")
+    parser.add_argument("--repeat", type=int, default=5, help="Répétitions (la médiane est retenue)")
+    return parser.parse_args()
+
+def main():
+    args = parse_arguments()
+    base = temps_aide(os.path.join("benchmark", "demarrage.py"), args.repeat)
+    print(f"--- DÉMARRAGE (budget {args.budget:.2f} s, référence interpréteur + argparse : {base:.3f} s) ---")
+    echecs = 0
+    for script in SCRIPTS:
+        duree, lourds = temps_aide(script, args.repeat), modules_lourds(script)
+        ok = duree <= args.budget and not lourds
+        echecs += not ok
+        print(f"{script:<24}{duree:>8.3f} s  {'OK' if ok else 'RÉGRESSION'}"
+              + (f"  (importe : {', '.join(lourds)})" if lourds else ""))
+    sys.exit(1 if echecs else 0)
+
+if __name__ == "__main__":
+    main()
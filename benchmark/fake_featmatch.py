@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+import os
+import sys
+import time
+
+# Exécutable autonome : le paquet recalage est à la racine du dépôt
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+
+from recalage.keys import lire_fichier_key
+from recalage.matching import RATIO_DEFAUT, apparier_descripteurs, ecrire_fichiers_matches
+
+"""
+Remplaçant Python de featMatchMultiple, pour les bancs d'essai sans le binaire.
+
+Même ligne de commande : fake_featmatch.py [-r-] cible.key source1.key [source2.key ...]
+Mêmes fichiers de sortie, écrits à côté de chaque source :
+    <source>.matches.img1.txt / .matches.img2.txt  (correspondances cible / source)
+    <source>.matches.info.txt, <source>.trans.txt, <source>.trans-inverse.txt  (fichiers annexes)
+et <cible>.update.key à côté de la cible.
+
+L'appariement est celui de recalage.matching (plus proche voisin + test du ratio) ; l'option -r-
+est acceptée et sans effet. FAKE_FEATMATCH_DELAI (secondes par source) simule le coût du binaire.
+"""
+
+def main():
+    options = [a for a in sys.argv[1:] if a.startswith("-")]
+    fichiers = [a for a in sys.argv[1:] if not a.startswith("-")]
+    if len(fichiers) < 2:
+        print("usage: fake_featmatch.py [-r-] cible.key source.key [source.key ...]", file=sys.stderr)
+        return 1
+    delai = float(os.environ.get("FAKE_FEATMATCH_DELAI", "0"))
+
+    cible = fichiers[0]
+    kp_cible = lire_fichier_key(cible)
+    for source in fichiers[1:]:
+        if delai: time.sleep(delai)
+        kp_source = lire_fichier_key(source)
+        idx_c, idx_s = apparier_descripteurs(kp_cible.descripteurs, kp_source.descripteurs, ratio=RATIO_DEFAUT)
+
+        stem = source[:-len(".key")] if source.endswith(".key") else source
+        ecrire_fichiers_matches(f"{stem}.matches.img1.txt", f"{stem}.matches.img2.txt",
+                                kp_cible, kp_source, idx_c, idx_s)
+        with open(f"{stem}.matches.info.txt", 'w') as f:
+            f.write(f"# options {' '.join(options)}\nmatches {len(idx_c)}\n")
+        for suffixe in (".trans.txt", ".trans-inverse.txt"):
+            np.savetxt(stem + suffixe, np.eye(4), fmt="%.6f")
+
+    stem_cible = cible[:-len(".key")] if cible.endswith(".key") else cible
+    with open(f"{stem_cible}.update.key", 'w') as f: f.write("# update (synthétique)\n")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
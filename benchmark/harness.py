@@ -0,0 +1,178 @@
+import os
+import sys
+import time
+import shutil
+import argparse
+import subprocess
+
+import numpy as np
+
+from benchmark.synthetique import ajouter_arguments_generation, appliquer, generer
+from recalage.gt import SUFFIXE_GT_ATLAS, lire_fcsv
+
+"""
+Harnais de benchmark : pour chaque taille (patients x atlas), génère un jeu synthétique,
+puis chronomètre generate_matches.py, top_K.py et predict_landmarks.py (featMatchMultiple
+remplacé par fake_featmatch.py) et rapporte débit et TRE.
+
+Avec --coarse_keypoints (matcher python), predict_landmarks.py est relancé en mode grossier-fin :
+la ligne « predict_grossier_fin » donne durée et TRE, et l'écart à la prédiction complète est affiché.
+
+La TRE « oracle » (landmarks des atlas projetés par les affines exactes, médiane sur les atlas)
+est la borne atteignable : l'écart à cette valeur mesure la perte due au matching et au RANSAC.
+"""
+
+RACINE = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FAKE_EXE = os.path.join(RACINE, "benchmark", "fake_featmatch.py")
+
+def taille(texte):
+    """Convertisseur argparse : "5x10" -> (5, 10)."""
+    p, a = texte.lower().split("x")
+    return int(p), int(a)
+
+def executer(script, arguments, log):
+    """Lance un script du dépôt ; retourne la durée (s). La sortie est conservée dans `log`."""
+    cmd = [sys.executable, os.path.join(RACINE, script)] + [str(a) for a in arguments]
+    t0 = time.perf_counter()
+    with open(log, 'w') as f:
+        proc = subprocess.run(cmd, cwd=RACINE, stdout=f, stderr=subprocess.STDOUT)
+    duree = time.perf_counter() - t0
+    if proc.returncode != 0:
+        raise RuntimeError(f"{script} a échoué (code {proc.returncode}), voir {log}")
+    return duree
+
+def tre_oracle(dossier, verite, patients, atlases):
+    """TRE moyenne de la médiane des projections exactes atlas -> patient."""
+    erreurs = []
+    for p in patients:
+        gt_p = lire_fcsv(os.path.join(dossier, "patients", f"{p}{SUFFIXE_GT_ATLAS}.fcsv"))
+        A_p = np.array(verite["affines"][p])
+        projections = []
+        for a in atlases:
+            A_a = np.array(verite["affines"][a])
+            gt_a = lire_fcsv(os.path.join(dossier, "atlases", f"{a}{SUFFIXE_GT_ATLAS}.fcsv"))
+            # Retour dans le gabarit (A_a^-1), puis vers le patient (A_p)
+            gabarit = np.linalg.solve(A_a[:, :3], (gt_a - A_a[:, 3]).T).T
+            projections.append(appliquer(A_p, gabarit))
+        erreurs.append(np.linalg.norm(np.median(projections, axis=0) - gt_p, axis=1).mean())
+    return float(np.mean(erreurs))
+
+def tre_predictions(dossier_pred, dossier, patients):
+    erreurs = []
+    for p in patients:
+        path = os.path.join(dossier_pred, f"{p}_predicted.fcsv")
+        if not os.path.exists(path): continue
+        gt_p = lire_fcsv(os.path.join(dossier, "patients", f"{p}{SUFFIXE_GT_ATLAS}.fcsv"))
+        erreurs.append(np.linalg.norm(lire_fcsv(path) - gt_p, axis=1).mean())
+    return float(np.mean(erreurs)) if erreurs else float("nan")
+
+def tre_top_k(path_csv, k):
+    """TRE moyenne de stats_K.csv au K demandé (ou au plus grand K disponible)."""
+    stats = np.atleast_2d(np.loadtxt(path_csv, delimiter=',', comments='#'))
+    ligne = stats[stats[:, 0] <= k][-1]
+    return float(ligne[1])
+
+def benchmarker_taille(n_patients, n_atlases, args):
+    """Une taille de grille ; retourne la liste des lignes (étape, durée, débit, unité, TRE)."""
+    dossier = os.path.join(args.workdir, f"{n_patients}x{n_atlases}")
+    if os.path.exists(dossier): shutil.rmtree(dossier)
+    gen_args = argparse.Namespace(**{**vars(args), "output": dossier, "patients": n_patients,
+                                     "atlases": n_atlases, "matches": False})
+    verite = generer(gen_args)
+    patients = [s for s in sorted(verite["affines"]) if s.startswith("sub-P")]
+    atlases = [s for s in sorted(verite["affines"]) if s.startswith("sub-A")]
+    dossier_patients, dossier_atlases = os.path.join(dossier, "patients"), os.path.join(dossier, "atlases")
+    matcher = ["--matcher", args.matcher] + (["--exe", FAKE_EXE, "--batch_size", args.batch_size] if args.matcher == "exe" else [])
+    n_paires = n_patients * n_atlases
+    lignes = []
+
+    # 1. Génération des matches
+    resultats = os.path.join(dossier, "matches")
+    duree = executer("generate_matches.py", ["--patients", dossier_patients, "--atlases", dossier_atlases,
+                                             "--output", resultats, "--workers", args.workers] + matcher,
+                     os.path.join(dossier, "generate.log"))
+    lignes.append(("generate_matches", duree, n_paires / duree, "paires/s", float("nan")))
+
+    # 2. Validation Top-K
+    sortie_topk = os.path.join(dossier, "top_K")
+    duree = executer("top_K.py", [resultats, dossier_patients, dossier_atlases, "--output_dir", sortie_topk,
+                                  "--min_samples", args.min_samples, "--threshold", args.threshold],
+                     os.path.join(dossier, "top_K.log"))
+    lignes.append(("top_K", duree, n_paires / duree, "paires/s",
+                   tre_top_k(os.path.join(sortie_topk, "stats_K.csv"), args.k)))
+
+    # 3. Prédiction
+    sortie_pred = os.path.join(dossier, "predictions")
+    duree = executer("predict_landmarks.py", ["--input", dossier_patients, "--atlas_dir", dossier_atlases,
+                                              "--output", sortie_pred, "--k", args.k, "--workers", args.workers,
+                                              "--min_samples", args.min_samples, "--threshold", args.threshold] + matcher,
+                     os.path.join(dossier, "predict.log"))
+    lignes.append(("predict_landmarks", duree, n_patients / duree, "patients/s",
+                   tre_predictions(sortie_pred, dossier, patients)))
+
+    # 3 bis. Prédiction grossier-fin (mêmes paramètres, budgets de keypoints par passe)
+    if args.coarse_keypoints > 0:
+        sortie_gf = os.path.join(dossier, "predictions_grossier_fin")
+        duree = executer("predict_landmarks.py", ["--input", dossier_patients, "--atlas_dir", dossier_atlases,
+                                                  "--output", sortie_gf, "--k", args.k, "--workers", args.workers,
+                                                  "--min_samples", args.min_samples, "--threshold", args.threshold,
+                                                  "--coarse_keypoints", args.coarse_keypoints,
+                                                  "--coarse_selection", args.coarse_selection,
+                                                  "--refine_keypoints", args.refine_keypoints,
+                                                  "--refine_radius", args.refine_radius] + matcher,
+                         os.path.join(dossier, "predict_grossier_fin.log"))
+        lignes.append(("predict_grossier_fin", duree, n_patients / duree, "patients/s",
+                       tre_predictions(sortie_gf, dossier, patients)))
+
+    lignes.append(("oracle", 0.0, float("nan"), "-", tre_oracle(dossier, verite, patients, atlases)))
+    if not args.keep: shutil.rmtree(dossier)
+    return lignes
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Benchmark synthétique du pipeline (débit et TRE).")
+    parser.add_argument("--sizes", type=lambda t: [taille(v) for v in t.split(",")], default=[(3, 8), (5, 16)],
+                        help="Tailles patients x atlas, ex: 3x8,5x16,10x32")
+    parser.add_argument("--workdir", default="benchmark_runs", help="Dossier de travail")
+    parser.add_argument("--csv", help="CSV des résultats (défaut: <workdir>/benchmark.csv)")
+    parser.add_argument("--matcher", choices=["exe", "python"], default="exe",
+                        help="exe : fake_featmatch.py via sous-processus (comme featMatchMultiple) ; python : matcher in-process")
+    parser.add_argument("--workers", type=int, default=1, help="--workers passé à generate_matches.py et predict_landmarks.py")
+    parser.add_argument("--batch_size", type=int, default=1, help="Matcher exe : --batch_size passé à generate_matches.py et predict_landmarks.py")
+    parser.add_argument("--k", type=int, default=5, help="K de la fusion (prédiction) et de la TRE rapportée pour top_K")
+    parser.add_argument("--min_samples", type=int, default=5, help="RANSAC : min_samples")
+    parser.add_argument("--threshold", type=float, default=10.0, help="RANSAC : seuil des résidus")
+    parser.add_argument("--coarse_keypoints", type=int, default=0,
+                        help="Relance la prédiction en mode grossier-fin avec ce budget de keypoints (matcher python ; 0 = non)")
+    parser.add_argument("--coarse_selection", choices=["scale", "grid"], default="grid", help="Grossier-fin : sous-échantillonnage")
+    parser.add_argument("--refine_keypoints", type=int, default=0, help="Grossier-fin : keypoints max en passe fine (0 = tous)")
+    parser.add_argument("--refine_radius", type=float, default=20.0, help="Grossier-fin : rayon (mm) de la passe fine")
+    parser.add_argument("--keep", action="store_true", help="Conserve les données et sorties de chaque taille")
+    ajouter_arguments_generation(parser)
+    return parser.parse_args()
+
+def main():
+    args = parse_arguments()
+    if args.coarse_keypoints > 0 and args.matcher != "python":
+        print("[ERREUR] --coarse_keypoints demande --matcher python")
+        sys.exit(1)
+    args.workdir = os.path.abspath(args.workdir)
+    os.makedirs(args.workdir, exist_ok=True)
+    path_csv = args.csv or os.path.join(args.workdir, "benchmark.csv")
+
+    print(f"--- BENCHMARK SYNTHÉTIQUE (matcher : {args.matcher}, workers : {args.workers}) ---")
+    print(f"{'taille':<10}{'étape':<20}{'durée_s':>10}{'débit':>12}  {'unité':<12}{'TRE_mm':>8}")
+    with open(path_csv, 'w') as f:
+        f.write("patients,atlases,etape,duree_s,debit,unite,TRE_mm\n")
+        for n_patients, n_atlases in args.sizes:
+            lignes = benchmarker_taille(n_patients, n_atlases, args)
+            for etape, duree, debit, unite, tre in lignes:
+                f.write(f"{n_patients},{n_atlases},{etape},{duree:.3f},{debit:.3f},{unite},{tre:.4f}\n")
+                print(f"{f'{n_patients}x{n_atlases}':<10}{etape:<20}{duree:>10.2f}{debit:>12.2f}  {unite:<12}{tre:>8.3f}")
+            par_etape = {l[0]: l for l in lignes}
+            if "predict_grossier_fin" in par_etape:
+                complet, gf = par_etape["predict_landmarks"], par_etape["predict_grossier_fin"]
+                print(f"{'':<10}grossier-fin : durée x{gf[1] / complet[1]:.2f}, TRE {gf[4] - complet[4]:+.3f} mm")
+    print(f"\nRésultats : {path_csv}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+import os
+import json
+import argparse
+
+import numpy as np
+
+from recalage.gt import SUFFIXE_GT_ATLAS, save_fcsv
+
+"""
+Générateur de données synthétiques à vérité connue.
+
+Tous les sujets dérivent d'un même « gabarit » : N keypoints (positions + descripteurs)
+et 32 landmarks. Chaque sujet s est obtenu par une affine aléatoire A_s appliquée au gabarit,
+plus un bruit de position ; une fraction `outliers` de ses keypoints est déplacée au hasard
+(descripteur conservé : ce sont de fausses correspondances). La transformation exacte
+atlas -> patient est donc A_p o A_a^-1, et la TRE d'une prédiction parfaite est le bruit des landmarks.
+
+Arborescence produite :
+    <output>/patients/sub-PXXX_T1w.key + sub-PXXX_space-T1w_desc-groundtruth_afids.fcsv
+    <output>/atlases/sub-AXXX_T1w.key  + GT
+    <output>/matches/sub-PXXX/match_sub-AXXX.img1.txt / .img2.txt   (option --matches)
+    <output>/verite.json : affines de chaque sujet et paramètres de génération
+"""
+
+N_LANDMARKS = 32
+ENTETE_KEY = ("# featExtract 1.6 (synthétique)\n"
+              "Features: {n}\n"
+              "Scale-space location[x y z scale] orientation[o11 o12 o13 o21 o22 o23 o31 o32 o33] "
+              "2nd moment eigenvalues[e1 e2 e3] info flag[i1] descriptor[d1 .. d{d}]\n")
+
+def affine_aleatoire(rng, deformation=0.05, translation=5.0):
+    """Affine 3x4 proche de l'identité."""
+    lineaire = np.eye(3) + rng.normal(0, deformation, (3, 3))
+    return np.hstack([lineaire, rng.normal(0, translation, (3, 1))])
+
+def appliquer(affine, points):
+    return points @ affine[:, :3].T + affine[:, 3]
+
+def gabarit(rng, n_keypoints, dim_descripteur=64):
+    """Positions (mm), descripteurs (entiers 0-255) et landmarks du gabarit commun."""
+    return (rng.uniform(-80, 80, (n_keypoints, 3)),
+            rng.integers(0, 256, (n_keypoints, dim_descripteur)).astype(np.float64),
+            rng.uniform(-50, 50, (N_LANDMARKS, 3)))
+
+def ecrire_key(path, coords, echelles, descripteurs):
+    n, d = descripteurs.shape
+    colonnes = np.hstack([coords, echelles[:, None], np.tile(np.eye(3).ravel(), (n, 1)),
+                          np.ones((n, 3)), np.zeros((n, 1))])
+    with open(path, 'w') as f:
+        f.write(ENTETE_KEY.format(n=n, d=d))
+        for c, desc in zip(colonnes, np.clip(np.rint(descripteurs), 0, 255).astype(int)):
+            f.write(" ".join(f"{v:.4f}" for v in c) + " " + " ".join(map(str, desc)) + "\n")
+
+def ecrire_matches(path_img1, path_img2, pts_img1, pts_img2):
+    """Même format que recalage.matching.ecrire_fichiers_matches (index x y z scale)."""
+    for path, pts in ((path_img1, pts_img1), (path_img2, pts_img2)):
+        with open(path, 'w') as f:
+            f.write("# index x y z scale\n")
+            for i, p in enumerate(pts):
+                f.write(f"{i} {p[0]:.6f} {p[1]:.6f} {p[2]:.6f} 1.000000\n")
+
+def generer_sujet(rng, base, affine, args):
+    """Keypoints (coords, échelles, descripteurs, masque outliers) et landmarks d'un sujet."""
+    pts, desc, landmarks = base
+    coords = appliquer(affine, pts) + rng.normal(0, args.noise, pts.shape)
+    outliers = rng.random(len(pts)) < args.outliers
+    coords[outliers] = rng.uniform(-80, 80, (outliers.sum(), 3))
+    descripteurs = desc + rng.normal(0, args.descriptor_noise, desc.shape)
+    gt = appliquer(affine, landmarks + rng.normal(0, args.landmark_noise, landmarks.shape))
+    return coords, rng.uniform(1, 5, len(pts)), descripteurs, outliers, gt
+
+def generer(args):
+    """Écrit le jeu de données ; retourne le dictionnaire de vérité (aussi écrit dans verite.json)."""
+    rng = np.random.default_rng(args.seed)
+    base = gabarit(rng, args.keypoints)
+    dossiers = {"patients": os.path.join(args.output, "patients"), "atlases": os.path.join(args.output, "atlases")}
+    for d in dossiers.values(): os.makedirs(d, exist_ok=True)
+
+    sujets = {}
+    for groupe, prefixe, n in (("patients", "P", args.patients), ("atlases", "A", args.atlases)):
+        for i in range(n):
+            sujet_id = f"sub-{prefixe}{i:03d}"
+            affine = affine_aleatoire(rng)
+            coords, echelles, descripteurs, outliers, gt = generer_sujet(rng, base, affine, args)
+            ecrire_key(os.path.join(dossiers[groupe], f"{sujet_id}_T1w.key"), coords, echelles, descripteurs)
+            save_fcsv(os.path.join(dossiers[groupe], f"{sujet_id}{SUFFIXE_GT_ATLAS}.fcsv"), gt)
+            sujets[sujet_id] = {"groupe": groupe, "affine": affine.tolist(), "coords": coords, "outliers": outliers}
+
+    if args.matches:
+        # Correspondances par construction : le keypoint i du patient et de l'atlas proviennent du même point du gabarit
+        patients = [s for s in sujets if sujets[s]["groupe"] == "patients"]
+        atlases = [s for s in sujets if sujets[s]["groupe"] == "atlases"]
+        for p in patients:
+            dossier = os.path.join(args.output, "matches", p)
+            os.makedirs(dossier, exist_ok=True)
+            for a in atlases:
+                ecrire_matches(os.path.join(dossier, f"match_{a}.img1.txt"), os.path.join(dossier, f"match_{a}.img2.txt"),
+                               sujets[p]["coords"], sujets[a]["coords"])
+
+    verite = {"parametres": {k: v for k, v in vars(args).items() if k != "output"},
+              "affines": {s: v["affine"] for s, v in sujets.items()},
+              "fraction_outliers": {s: float(np.mean(v["outliers"])) for s, v in sujets.items()}}
+    with open(os.path.join(args.output, "verite.json"), 'w') as f:
+        json.dump(verite, f, indent=1)
+    return verite
+
+def ajouter_arguments_generation(parser):
+    """Options communes au générateur et au harnais (harness.py)."""
+    parser.add_argument("--keypoints", type=int, default=400, help="Keypoints par sujet")
+    parser.add_argument("--outliers", type=float, default=0.3, help="Fraction de keypoints déplacés au hasard (fausses correspondances)")
+    parser.add_argument("--noise", type=float, default=1.5, help="Bruit de position des keypoints (mm)")
+    parser.add_argument("--landmark_noise", type=float, default=2.0, help="Variabilité anatomique des landmarks (mm)")
+    parser.add_argument("--descriptor_noise", type=float, default=3.0, help="Bruit des descripteurs")
+    parser.add_argument("--seed", type=int, default=0, help="Graine du générateur")
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Génère un jeu de données synthétique à transformations connues.")
+    parser.add_argument("--output", required=True, help="Dossier de sortie")
+    parser.add_argument("--patients", type=int, default=5, help="Nombre de patients")
+    parser.add_argument("--atlases", type=int, default=10, help="Nombre d'atlas")
+    parser.add_argument("--matches", action="store_true", help="Écrit aussi les fichiers de matches (vérité par construction)")
+    ajouter_arguments_generation(parser)
+    return parser.parse_args()
+
+def main():
+    args = parse_arguments()
+    args.output = os.path.abspath(args.output)
+    generer(args)
+    print(f"{args.patients} patients, {args.atlases} atlas ({args.keypoints} keypoints, "
+          f"{args.outliers:.0%} outliers) -> {args.output}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,49 @@
+import os
+import sys
+import time
+import argparse
+
+from recalage.index_ann import EXTENSION_INDEX, N_ECHANTILLON, N_SOUS_ESPACES, build_ann_index, chemin_index_defaut
+
+"""
+Construction de l'index approché (IVF-PQ) des descripteurs de tous les atlas,
+utilisé par predict_landmarks.py --matcher ann. Construit une fois, rangé à côté des atlas.
+"""
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Construit l'index IVF-PQ des descripteurs SIFT des atlas.")
+    source_atlas = parser.add_mutually_exclusive_group(required=True)
+    source_atlas.add_argument("--atlas_dir", help="Dossier contenant les atlas (.key)")
+    source_atlas.add_argument("--atlas_bank", help="Banque d'atlas (build_atlas_bank.py)")
+    parser.add_argument("--output", help=f"Fichier index (défaut : <atlas_dir>{EXTENSION_INDEX} ou <banque>{EXTENSION_INDEX})")
+    parser.add_argument("--n_lists", type=int, help="Nombre de listes IVF (défaut : ~4 sqrt(nombre de descripteurs))")
+    parser.add_argument("--n_subspaces", type=int, default=N_SOUS_ESPACES,
+                        help="Sous-espaces PQ, un octet de code chacun (doit diviser la dimension des descripteurs)")
+    parser.add_argument("--train_size", type=int, default=N_ECHANTILLON, help="Descripteurs échantillonnés pour les k-means")
+    parser.add_argument("--no_vectors", action="store_true",
+                        help="Ne garde pas les vecteurs float16 (index plus petit, pas de re-classement exact)")
+    return parser.parse_args()
+
+def main():
+    args = parse_arguments()
+    atlas_dir = os.path.abspath(args.atlas_dir) if args.atlas_dir else None
+    atlas_bank = os.path.abspath(args.atlas_bank) if args.atlas_bank else None
+    if atlas_dir and not os.path.isdir(atlas_dir):
+        print(f"[ERREUR] Dossier atlas introuvable : {atlas_dir}")
+        sys.exit(1)
+    output = os.path.abspath(args.output) if args.output else chemin_index_defaut(atlas_dir, atlas_bank)
+
+    print(f"--- CONSTRUCTION INDEX ANN (IVF-PQ) ---")
+    t0 = time.time()
+    try:
+        n = build_ann_index(output, atlas_dir=atlas_dir, atlas_bank=atlas_bank, n_listes=args.n_lists,
+                            n_sous_espaces=args.n_subspaces, n_echantillon=args.train_size,
+                            garder_vecteurs=not args.no_vectors)
+    except ValueError as e:
+        print(f"[ERREUR] {e}")
+        sys.exit(1)
+    taille = os.path.getsize(output) / 1e6
+    print(f"{n} atlas -> {output} ({taille:.1f} Mo) en {time.time() - t0:.1f} s")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,40 @@
+import os
+import sys
+import time
+import argparse
+
+from recalage.atlas_bank import EXTENSION_BANK, build_atlas_bank
+from recalage.prescreening import TAILLE_CODEBOOK
+
+"""
+Construction de la banque d'atlas utilisée par predict_landmarks.py (--atlas_bank).
+Un seul fichier : identifiants normalisés, GT empilées et keypoints/descripteurs SIFT.
+"""
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Construit une banque d'atlas memory-mappable.")
+    parser.add_argument("--atlas_dir", required=True, help="Dossier contenant les atlas (.key et leurs GT .fcsv)")
+    parser.add_argument("--output", required=True, help=f"Fichier banque à créer (ex: atlas_HCP{EXTENSION_BANK})")
+    parser.add_argument("--codebook_size", type=int, default=TAILLE_CODEBOOK,
+                        help="Taille du codebook des signatures de pré-sélection (0 = pas de signatures)")
+    return parser.parse_args()
+
+def main():
+    args = parse_arguments()
+    atlas_dir = os.path.abspath(args.atlas_dir)
+    if not os.path.isdir(atlas_dir):
+        print(f"[ERREUR] Dossier atlas introuvable : {atlas_dir}")
+        sys.exit(1)
+
+    print(f"--- CONSTRUCTION BANQUE D'ATLAS ---")
+    t0 = time.time()
+    try:
+        n = build_atlas_bank(atlas_dir, os.path.abspath(args.output), codebook_size=args.codebook_size)
+    except ValueError as e:
+        print(f"[ERREUR] {e}")
+        sys.exit(1)
+    taille = os.path.getsize(args.output) / 1e6
+    print(f"{n} atlas -> {args.output} ({taille:.1f} Mo) en {time.time() - t0:.1f} s")
+
+if __name__ == "__main__":
+    main()
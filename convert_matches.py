@@ -0,0 +1,115 @@
+import os
+import glob
+import sys
+import time
+import argparse
+
+from recalage.match_store import MatchStore, chemin_store, ecrire_match_store
+from recalage.matches_io import SUFFIXE_CACHE, parser_fichier_matches
+
+"""
+Migration d'une arborescence de résultats existante (fichiers match_<atlas>.img1/.img2.txt)
+vers le format store : un fichier matches.store par cible, lisible directement par top_K.py.
+Les paires miroirs de generate_matches.py --symmetric sont des liens vers les fichiers d'une
+autre cible : avec --delete_txt, rien n'est supprimé avant que toutes les cibles soient converties,
+et un fichier encore visé par un lien conservé n'est jamais supprimé.
+"""
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Convertit les fichiers de matches texte en stores columnaires.")
+    parser.add_argument("--results", required=True, help="Dossier racine des résultats (un sous-dossier par cible)")
+    parser.add_argument("--delete_txt", action="store_true",
+                        help="Supprime les fichiers texte (et leurs caches) une fois le store écrit et relu")
+    return parser.parse_args()
+
+def convertir_cible(dossier_cible, verifier=False):
+    """
+    Convertit un dossier cible (les liens miroirs sont lus à travers leur cible).
+    verifier : relit le store et vérifie toutes les paires converties (avant suppression des fichiers texte).
+    Retourne (nombre de paires converties, nombre de paires illisibles, fichiers texte convertis).
+    """
+    paires, fichiers, n_illisibles = {}, [], 0
+    # Un store déjà présent est complété, pas écrasé
+    if os.path.exists(chemin_store(dossier_cible)):
+        store = MatchStore(chemin_store(dossier_cible))
+        paires = {s: store.paire(s) for s in store.sources}
+
+    for f_img1 in sorted(glob.glob(os.path.join(dossier_cible, "match_*.img1.txt"))):
+        f_img2 = f_img1.replace(".img1.txt", ".img2.txt")
+        liens_casses = [f for f in (f_img1, f_img2) if os.path.islink(f) and not os.path.exists(f)]
+        if liens_casses:
+            print(f"[ATTENTION] Lien miroir cassé, paire ignorée : {', '.join(liens_casses)}")
+            n_illisibles += 1
+            continue
+        if not os.path.exists(f_img2): continue
+        source_id = os.path.basename(f_img1)[len("match_"):-len(".img1.txt")]
+        p_a, p_b = parser_fichier_matches(f_img1), parser_fichier_matches(f_img2)
+        if p_a is None or p_b is None or len(p_a) != len(p_b):
+            # Même traitement que top_K.py : une paire illisible est ignorée
+            n_illisibles += 1
+            continue
+        paires[source_id] = (p_a, p_b)
+        fichiers += [f_img1, f_img2]
+
+    if not fichiers: return 0, n_illisibles, []
+    ecrire_match_store(chemin_store(dossier_cible), paires)
+
+    if verifier:
+        # Vérification avant suppression : toutes les paires converties sont relisibles
+        store = MatchStore(chemin_store(dossier_cible))
+        if any(s not in store or len(store.paire(s)[0]) != len(paires[s][0]) for s in paires):
+            raise RuntimeError(f"Store incohérent : {chemin_store(dossier_cible)}")
+    return len(fichiers) // 2, n_illisibles, fichiers
+
+def supprimer_txt(results_dir, fichiers):
+    """
+    Supprime les fichiers texte convertis (et leurs caches), une fois toutes les cibles converties :
+    les liens d'abord, puis les fichiers réels qu'aucun lien restant de l'arborescence ne vise.
+    Retourne le nombre de fichiers conservés car encore visés.
+    """
+    liens = {f for f in fichiers if os.path.islink(f)}
+    for f in liens: os.remove(f)
+    vises = set()
+    for dossier, _, noms in os.walk(results_dir):
+        for nom in noms:
+            chemin = os.path.join(dossier, nom)
+            if os.path.islink(chemin): vises.add(os.path.realpath(chemin))
+    conserves = 0
+    for f in fichiers:
+        if f in liens: continue
+        if os.path.realpath(f) in vises:
+            conserves += 1
+            continue
+        for p in (f, f + SUFFIXE_CACHE):
+            if os.path.exists(p): os.remove(p)
+    for f in liens:
+        if os.path.exists(f + SUFFIXE_CACHE): os.remove(f + SUFFIXE_CACHE)
+    return conserves
+
+def main():
+    args = parse_arguments()
+    results_dir = os.path.abspath(args.results)
+    if not os.path.isdir(results_dir):
+        print(f"[ERREUR] Dossier introuvable : {results_dir}")
+        sys.exit(1)
+
+    cibles = sorted(d for d in os.listdir(results_dir)
+                    if os.path.isdir(os.path.join(results_dir, d)) and not d.startswith('.'))
+    print(f"--- CONVERSION TXT -> STORE ({len(cibles)} cibles) ---")
+    t0 = time.time()
+    total, total_illisibles, convertis = 0, 0, []
+    for cible in cibles:
+        n, n_illisibles, fichiers = convertir_cible(os.path.join(results_dir, cible), verifier=args.delete_txt)
+        total += n
+        total_illisibles += n_illisibles
+        convertis += fichiers
+        if n: print(f"   {cible} : {n} paires" + (f" ({n_illisibles} illisibles ignorées)" if n_illisibles else ""))
+    print(f"{total} paires converties, {total_illisibles} illisibles, en {time.time() - t0:.1f} s")
+
+    # Suppression différée : les liens miroirs d'une cible visent les fichiers d'une autre
+    if args.delete_txt and convertis:
+        conserves = supprimer_txt(results_dir, convertis)
+        if conserves: print(f"{conserves} fichiers texte conservés (encore visés par un lien)")
+
+if __name__ == "__main__":
+    main()
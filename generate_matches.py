@@ -5,6 +5,21 @@ import time
 import shutil
 import sys
 import argparse
+import json
+import numpy as np
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+
+from recalage import profiling
+from recalage.gt import identifiant_sujet, identifiants_atlas, meme_sujet
+from recalage.keys import charger_key, compter_keypoints, lire_fichier_key
+from recalage.manifest import Manifest
+from recalage.match_store import chemin_part, consolider, ecrire_part, lire_paire, sources_presentes
+from recalage.matches_io import parser_fichier_matches
+from recalage.matching import RATIO_DEFAUT, apparier_descripteurs, ecrire_fichiers_matches
+from recalage.scratch import (creer_racine_scratch, lier_atomiquement, nettoyer_espace_job, nom_local_lot,
+                              placer_atomiquement, preparer_espace_job, sorties_lot)
+from recalage.sharding import DOSSIER_CLAIMS, liberer, parser_shard, repartir_lpt, revendications_actives, revendiquer
 
 """
 Script d'automatisation UNIFIÉ pour featMatchMultiple.
@@ -12,32 +27,477 @@ Fonctionnalités :
 1. Logique robuste & Clean (aligned with v2 logic)
 2. Gestion de l'option -r- via argument --no_rotation
 3. Anti Auto-Match
-4. Nettoyage agressif
+4. Manifeste de jobs (SQLite) : reprise propre après interruption, retries
+5. Pool de workers, timeout par job, placement atomique des sorties
+6. Nettoyage ciblé : chaque job travaille dans son propre dossier temporaire
+7. Format de sortie : fichiers texte par paire (txt) ou store columnaire par cible (store)
+8. Mode symétrique : chaque paire non ordonnée n'est calculée qu'une fois, le sens
+   inverse est servi en échangeant img1/img2 (liens, ou fragment inversé pour le store)
+9. Sharding multi-machines (--shard i/N, --steal) et étape de fusion/vérification (--merge)
+10. Mode incrémental (--incremental) : seules les paires des cibles/atlas nouveaux ou modifiés
+    depuis la dernière exécution complète (atlas_set.json) sont planifiées
+11. Scratch configurable (--scratch_dir shm) : le binaire travaille en mémoire, seules les
+    sorties finales sont écrites (atomiquement) dans --output
+12. Lots (--batch_size) : une cible et plusieurs sources par appel à featMatchMultiple,
+    repli sur un appel par paire si le lot échoue
 """
 
+NOM_MANIFEST = "manifest.sqlite"
+NOM_SCRATCH = ".scratch"
+NOM_ETAT = "atlas_set.json"
+
+# Une paire (cible, source) à calculer
+Job = namedtuple("Job", ["target_id", "source_id", "path_target", "path_source"])
+
 def parse_arguments():
     parser = argparse.ArgumentParser(description="Générateur de matches SIFT Unifié.")
     parser.add_argument("--patients", required=True, help="Dossier contenant les fichiers .key des images CIBLES")
     parser.add_argument("--atlases", required=True, help="Dossier contenant les fichiers .key des images SOURCES")
     parser.add_argument("--output", required=True, help="Dossier où seront stockés les résultats")
-    parser.add_argument("--exe", required=True, help="Chemin vers l'exécutable featMatchMultiple")
+    parser.add_argument("--exe", help="Chemin vers l'exécutable featMatchMultiple (requis avec --matcher exe)")
     parser.add_argument("--no_rotation", action="store_true", help="Si activé, ajoute l'option -r- (Désactive la rotation)")
-    
+    parser.add_argument("--matcher", choices=["exe", "python"], default="exe",
+                        help="Backend d'appariement : featMatchMultiple (exe) ou matcher SIFT in-process (python)")
+    parser.add_argument("--ratio", type=float, default=RATIO_DEFAUT, help="Matcher python : seuil du test du ratio")
+    parser.add_argument("--format", choices=["txt", "store"], default="txt",
+                        help="Sorties : deux fichiers texte par paire (txt) ou un fichier matches.store par cible (store)")
+    parser.add_argument("--symmetric", action="store_true",
+                        help="Quand cibles et sources se recoupent : calcule (A, B) une seule fois et sert (B, A) par échange img1/img2")
+
+    # Ordonnancement
+    parser.add_argument("--workers", type=int, default=1, help="Nombre de jobs exécutés en parallèle")
+    parser.add_argument("--scratch_dir",
+                        help=f"Dossiers de travail des jobs : 'shm' (/dev/shm) ou un chemin, typiquement un tmpfs (défaut: <output>/{NOM_SCRATCH})")
+    parser.add_argument("--timeout", type=float, help="Durée maximale d'un appel à featMatchMultiple (secondes, par source)")
+    parser.add_argument("--batch_size", type=int, default=1,
+                        help="Matcher exe : sources passées à featMatchMultiple en un seul appel par cible (1 = un appel par paire)")
+    parser.add_argument("--retries", type=int, default=2, help="Nouvelles tentatives pour un job en échec")
+    parser.add_argument("--retry_failed", action="store_true", help="Relance aussi les jobs ayant épuisé leurs tentatives lors d'une exécution précédente")
+    parser.add_argument("--manifest", help=f"Chemin du manifeste SQLite (défaut: <output>/{NOM_MANIFEST})")
+    parser.add_argument("--profile", help="Trace JSON-lines des temps par étape et par paire ; récapitulatif dans <trace>_summary.txt")
+
+    # Multi-machines
+    parser.add_argument("--shard", type=shard_argparse, help="Ne traite que le shard i sur N (ex: 2/4), répartition LPT par nombre de keypoints")
+    parser.add_argument("--steal", action="store_true", help="Avec --shard : une fois son shard terminé, prend les paires restantes des autres shards")
+    parser.add_argument("--claim_ttl", type=float, default=6 * 3600,
+                        help="Âge (s) au-delà duquel la revendication d'une paire par une machine arrêtée est reprise")
+    parser.add_argument("--incremental", action="store_true",
+                        help="Ne planifie que les paires impliquant une cible ou un atlas nouveau/modifié depuis la dernière exécution (atlas_set.json)")
+    parser.add_argument("--merge", action="store_true",
+                        help="Fusion/vérification après les shards : miroirs, consolidation des stores, liste des paires manquantes")
+
     return parser.parse_args()
 
+def shard_argparse(texte):
+    try: return parser_shard(texte)
+    except ValueError as e: raise argparse.ArgumentTypeError(str(e))
+
+def chemins_sortie(output_dir, target_id, source_id):
+    # Fichiers finaux attendus
+    target_output_dir = os.path.join(output_dir, target_id)
+    return (os.path.join(target_output_dir, f"match_{source_id}.img1.txt"),
+            os.path.join(target_output_dir, f"match_{source_id}.img2.txt"))
+
+def paire_presente(output_dir, format_sortie, target_id, source_id):
+    if format_sortie == "store": return source_id in sources_presentes(os.path.join(output_dir, target_id))
+    return all(os.path.exists(p) for p in chemins_sortie(output_dir, target_id, source_id))
+
+def paire_terminee(job, config):
+    """
+    Paire calculée entre-temps par un autre worker (vérifié après revendication).
+    Paire à refaire (.key modifié, --incremental) : ses anciennes sorties sont encore là, seules comptent
+    des sorties écrites après la dernière modification des deux .key (fragment du store, ou fichiers txt).
+    """
+    if (job.target_id, job.source_id) not in config.refaire:
+        return paire_presente(config.output_dir, config.format, job.target_id, job.source_id)
+    if config.format == "store": sorties = [chemin_part(os.path.join(config.output_dir, job.target_id), job.source_id)]
+    else: sorties = chemins_sortie(config.output_dir, job.target_id, job.source_id)
+    try:
+        entrees = max(os.stat(p).st_mtime_ns for p in (job.path_target, job.path_source))
+        return min(os.stat(p).st_mtime_ns for p in sorties) > entrees
+    except OSError:
+        return False
+
+def servir_miroir(canonique, miroir, output_dir, format_sortie):
+    """
+    Sert la paire miroir (B, A) à partir des sorties de la paire calculée (A, B), img1 et img2 échangés.
+    Retourne True si le miroir est disponible (déjà présent ou créé), False si (A, B) n'est pas encore calculée.
+    """
+    dossier_miroir = os.path.join(output_dir, miroir.target_id)
+    if format_sortie == "store":
+        if miroir.source_id in sources_presentes(dossier_miroir): return True
+        paire = lire_paire(os.path.join(output_dir, canonique.target_id), canonique.source_id)
+        if paire is None: return False
+        ecrire_part(dossier_miroir, miroir.source_id, paire[1], paire[0])
+        return True
+
+    dest_match1, dest_match2 = chemins_sortie(output_dir, miroir.target_id, miroir.source_id)
+    if os.path.exists(dest_match1) and os.path.exists(dest_match2): return True
+    src_match1, src_match2 = chemins_sortie(output_dir, canonique.target_id, canonique.source_id)
+    if not (os.path.exists(src_match1) and os.path.exists(src_match2)): return False
+    # img2 d'abord, comme pour une paire calculée
+    lier_atomiquement(src_match1, dest_match2)
+    lier_atomiquement(src_match2, dest_match1)
+    return True
+
+def executer_job(job, config):
+    """
+    Calcule une paire dans un dossier temporaire propre au job, puis place les deux
+    fichiers de sortie (ou le fragment du store) de façon atomique.
+    Retourne (statut, durée, code_retour, erreur).
+    """
+    with profiling.contexte(cible=job.target_id, source=job.source_id):
+        if config.claims_dir is None: return _executer_job(job, config)
+        if not revendiquer(config.claims_dir, job.target_id, job.source_id, config.claim_ttl):
+            return "claimed", 0.0, None, "Revendiquée par un autre worker"
+        try:
+            # Terminée entre-temps par une autre machine
+            if paire_terminee(job, config): return "done", 0.0, None, None
+            return _executer_job(job, config)
+        finally:
+            liberer(config.claims_dir, job.target_id, job.source_id)
+
+def executer_lot(jobs, config):
+    """
+    Paires d'une même cible en un seul appel à featMatchMultiple (cible + lot de sources) :
+    la cible n'est chargée qu'une fois et le coût de démarrage du binaire est partagé.
+    Retourne [(job, (statut, durée, code_retour, erreur))] dans l'ordre du lot.
+    """
+    if len(jobs) == 1 or config.matcher != "exe": return [(job, executer_job(job, config)) for job in jobs]
+    resultats, a_calculer, revendiques = {}, [], []
+    with profiling.contexte(cible=jobs[0].target_id, source=f"lot de {len(jobs)}"):
+        try:
+            for job in jobs:
+                if config.claims_dir is not None:
+                    if not revendiquer(config.claims_dir, job.target_id, job.source_id, config.claim_ttl):
+                        resultats[job] = ("claimed", 0.0, None, "Revendiquée par un autre worker")
+                        continue
+                    revendiques.append(job)
+                    if paire_terminee(job, config):
+                        resultats[job] = ("done", 0.0, None, None)
+                        continue
+                a_calculer.append(job)
+            if a_calculer: resultats.update(_executer_lot(a_calculer, config))
+        finally:
+            for job in revendiques: liberer(config.claims_dir, job.target_id, job.source_id)
+    return [(job, resultats[job]) for job in jobs]
+
+def _executer_lot(jobs, config):
+    """
+    Chaque source est exposée sous un nom indexé (nom_local_lot) qui permet de retrouver ses sorties.
+    Repli : une source sans sortie, ou tout le lot si l'appel échoue ou dépasse son délai
+    (--timeout x taille du lot), repasse par un appel par paire.
+    """
+    t0 = time.time()
+    lot_dir = os.path.join(config.scratch_root, f"{jobs[0].target_id}__lot__{jobs[0].source_id}")
+    noms = [nom_local_lot(i, job.path_source) for i, job in enumerate(jobs)]
+    resultats = {}
+    try:
+        with profiling.etape("fichiers"):
+            locaux = preparer_espace_job(lot_dir, [jobs[0].path_target] + [job.path_source for job in jobs], [None] + noms)
+        cmd = [config.exe_path] + (["-r-"] if config.no_rotation else []) + locaux
+        code_retour = None
+        try:
+            with profiling.etape("featMatchMultiple"):
+                proc = subprocess.run(cmd, cwd=lot_dir, check=False, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                                      timeout=config.timeout * len(jobs) if config.timeout else None)
+            code_retour = proc.returncode
+            with profiling.etape("fichiers"):
+                sorties = sorties_lot(lot_dir, noms)
+        except subprocess.TimeoutExpired:
+            sorties = [None] * len(jobs)
+
+        duree = (time.time() - t0) / len(jobs)
+        for job, fichiers in zip(jobs, sorties):
+            if fichiers is None: continue
+            try:
+                with profiling.contexte(source=job.source_id):
+                    placer_sorties(job, config, *fichiers)
+                resultats[job] = ("done", duree, code_retour, None)
+            except Exception:
+                pass
+    except Exception:
+        pass
+    finally:
+        with profiling.etape("nettoyage"):
+            nettoyer_espace_job(lot_dir)
+
+    for job in jobs:
+        if job not in resultats:
+            with profiling.contexte(source=job.source_id):
+                resultats[job] = _executer_job(job, config)
+    return resultats
+
+def placer_sorties(job, config, f_src_1, f_src_2):
+    """Place les correspondances d'une paire, lues dans son dossier de travail : fragment du store ou deux fichiers txt."""
+    if config.format == "store":
+        # Sortie vide ou illisible : paire enregistrée sans correspondance
+        with profiling.etape("lecture_matches"):
+            pts1, pts2 = parser_fichier_matches(f_src_1), parser_fichier_matches(f_src_2)
+        if pts1 is None or pts2 is None or len(pts1) != len(pts2):
+            pts1 = pts2 = np.zeros((0, 3))
+        with profiling.etape("placement"):
+            ecrire_part(os.path.join(config.output_dir, job.target_id), job.source_id, pts1, pts2)
+        return
+
+    # img2 d'abord : un .img1.txt présent implique une paire complète
+    dest_match1, dest_match2 = chemins_sortie(config.output_dir, job.target_id, job.source_id)
+    with profiling.etape("placement"):
+        placer_atomiquement(f_src_2, dest_match2)
+        placer_atomiquement(f_src_1, dest_match1)
+
+def _executer_job(job, config):
+    t0 = time.time()
+    job_dir = os.path.join(config.scratch_root, f"{job.target_id}__{job.source_id}")
+    code_retour = None
+    try:
+        if config.matcher == "python":
+            # Descripteurs de la cible chargés une seule fois par processus
+            with profiling.etape("lecture_keys"):
+                kp_target = charger_key(job.path_target)
+                kp_source = lire_fichier_key(job.path_source)
+            with profiling.etape("matching_python"):
+                idx_t, idx_s = apparier_descripteurs(kp_target.descripteurs, kp_source.descripteurs, ratio=config.ratio)
+            if config.format == "store":
+                with profiling.etape("placement"):
+                    ecrire_part(os.path.join(config.output_dir, job.target_id), job.source_id,
+                                kp_target.coords[idx_t], kp_source.coords[idx_s])
+                return "done", time.time() - t0, code_retour, None
+            with profiling.etape("ecriture_matches"):
+                os.makedirs(job_dir, exist_ok=True)
+                f_src_1 = os.path.join(job_dir, "matches.img1.txt")
+                f_src_2 = os.path.join(job_dir, "matches.img2.txt")
+                ecrire_fichiers_matches(f_src_1, f_src_2, kp_target, kp_source, idx_t, idx_s)
+        else:
+            with profiling.etape("fichiers"):
+                target_local, source_local = preparer_espace_job(job_dir, [job.path_target, job.path_source])
+
+            # --- EXÉCUTION (GÉRÉE PAR L'ARGUMENT) ---
+            if config.no_rotation:
+                # Mode Sans Rotation (-r-)
+                cmd = [config.exe_path, "-r-", target_local, source_local]
+            else:
+                # Mode Défaut (Avec Rotation)
+                cmd = [config.exe_path, target_local, source_local]
+
+            with profiling.etape("featMatchMultiple"):
+                proc = subprocess.run(cmd, cwd=job_dir, check=False, stdout=subprocess.DEVNULL,
+                                      stderr=subprocess.DEVNULL, timeout=config.timeout)
+            code_retour = proc.returncode
+
+            # Récupération résultats : les sorties sont à côté de la source, donc dans job_dir
+            raw_source_id = os.path.basename(job.path_source).split('_')[0].replace(".key", "")
+            with profiling.etape("fichiers"):
+                candidats = glob.glob(os.path.join(job_dir, f"{raw_source_id}*.matches.img1.txt"))
+            if not candidats:
+                return "failed", time.time() - t0, code_retour, "Sorties absentes"
+            f_src_1 = candidats[0]
+            f_src_2 = f_src_1.replace(".img1.txt", ".img2.txt")
+            if not os.path.exists(f_src_2):
+                return "failed", time.time() - t0, code_retour, "Fichier .img2.txt absent"
+
+        placer_sorties(job, config, f_src_1, f_src_2)
+        return "done", time.time() - t0, code_retour, None
+
+    except subprocess.TimeoutExpired:
+        return "failed", time.time() - t0, code_retour, f"Timeout ({config.timeout} s)"
+    except Exception as e:
+        return "failed", time.time() - t0, code_retour, str(e)
+    finally:
+        # --- NETTOYAGE CIBLÉ : uniquement ce que ce job a produit ---
+        with profiling.etape("nettoyage"):
+            nettoyer_espace_job(job_dir)
+
+def lots_par_cible(a_faire, taille_lot):
+    """Paires à calculer (lignes du manifeste) groupées par cible en lots d'au plus taille_lot, ordre conservé."""
+    par_cible = {}
+    for target_id, source_id, path_target, path_source, _ in a_faire:
+        par_cible.setdefault(target_id, []).append(Job(target_id, source_id, path_target, path_source))
+    return [jobs[i:i + taille_lot] for jobs in par_cible.values() for i in range(0, len(jobs), taille_lot)]
+
+def construire_grille(targets, sources, output_dir, symmetric=False):
+    """
+    Paires (cible, source) à calculer, hors auto-matchs.
+    Retourne (jobs, identifiants des cibles, miroirs) ; miroirs : {(cible, source) calculée: Job miroir}.
+    """
+    jobs = []
+    cibles = []
+    for path_target in targets:
+        target_id = identifiant_sujet(path_target)
+        cibles.append(target_id)
+        os.makedirs(os.path.join(output_dir, target_id), exist_ok=True)
+
+        for path_source in sources:
+            _, final_source_id = identifiants_atlas(path_source)
+
+            # --- FIX ANTI AUTO-MATCH ---
+            if meme_sujet(target_id, final_source_id):
+                for dest in chemins_sortie(output_dir, target_id, final_source_id):
+                    if os.path.exists(dest):
+                        try: os.remove(dest)
+                        except OSError: pass
+                continue
+
+            jobs.append(Job(target_id, final_source_id, path_target, path_source))
+
+    # Mode symétrique : (B, A) n'est pas calculée si (A, B) l'est aussi, avec A < B
+    miroirs = {} # (cible, source) de la paire calculée -> Job miroir servi par échange
+    if symmetric:
+        sujet = lambda id_: id_.replace("sub-", "")
+        grille = {(sujet(j.target_id), sujet(j.source_id)) for j in jobs}
+        restants = []
+        for j in jobs:
+            t, s = sujet(j.target_id), sujet(j.source_id)
+            if (s, t) in grille and s < t:
+                continue # miroir de (s, t), enregistré ci-dessous depuis la paire calculée
+            if (s, t) in grille:
+                miroir = Job(identifiant_sujet(j.path_source), identifiants_atlas(j.path_target)[1],
+                             j.path_source, j.path_target)
+                miroirs[(j.target_id, j.source_id)] = miroir
+            restants.append(j)
+        jobs = restants
+    return jobs, cibles, miroirs
+
+def empreinte(path):
+    st = os.stat(path)
+    return [st.st_size, int(st.st_mtime)]
+
+def etat_grille(targets, sources):
+    """Cibles et atlas de la grille avec leur empreinte (taille, mtime), tel qu'enregistré dans atlas_set.json."""
+    return {"cibles": {identifiant_sujet(p): empreinte(p) for p in targets},
+            "sources": {identifiants_atlas(p)[1]: empreinte(p) for p in sources}}
+
+def lire_etat(output_dir):
+    try:
+        with open(os.path.join(output_dir, NOM_ETAT), 'r') as f: return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def ecrire_etat(output_dir, etat):
+    path = os.path.join(output_dir, NOM_ETAT)
+    tmp = f"{path}.tmp.{os.getpid()}"
+    with open(tmp, 'w') as f: json.dump(etat, f, indent=1, sort_keys=True)
+    os.replace(tmp, path)
+
+def selectionner_increment(jobs, miroirs, precedent, courant, non_terminees):
+    """
+    Mode incrémental : paires dont la cible ou l'atlas est nouveau ou modifié par rapport à l'état précédent,
+    plus les paires restées inachevées au manifeste.
+    Retourne (jobs, miroirs, paires à refaire (entrées modifiées)).
+    """
+    def changes(role):
+        avant, apres = precedent.get(role, {}), courant[role]
+        nouveaux = {i for i in apres if i not in avant}
+        modifies = {i for i in apres if i in avant and avant[i] != apres[i]}
+        disparus = sorted(i for i in avant if i not in apres)
+        return nouveaux, modifies, disparus
+
+    c_nouv, c_modif, c_disp = changes("cibles")
+    s_nouv, s_modif, s_disp = changes("sources")
+    print(f"Incrémental : cibles +{len(c_nouv)} ~{len(c_modif)}, atlas +{len(s_nouv)} ~{len(s_modif)}, "
+          f"{len(non_terminees)} paires inachevées")
+    if c_disp or s_disp:
+        print(f"   [NOTE] Disparus depuis la dernière exécution (sorties conservées) : {(c_disp + s_disp)[:10]}")
+
+    garder, refaire = [], []
+    for j in jobs:
+        modifie = j.target_id in c_modif or j.source_id in s_modif
+        if modifie: refaire.append((j.target_id, j.source_id))
+        if modifie or j.target_id in c_nouv or j.source_id in s_nouv or (j.target_id, j.source_id) in non_terminees:
+            garder.append(j)
+    cles = {(j.target_id, j.source_id) for j in garder}
+    return garder, {k: v for k, v in miroirs.items() if k in cles}, refaire
+
+def selectionner_shard(jobs, shard, steal=False):
+    """
+    Jobs du shard (i, N), par coût estimé décroissant (keypoints cible x source).
+    Avec steal, suivis des jobs des autres shards, pris par la fin de leurs listes
+    (les moins coûteux, que leur propriétaire traitera en dernier).
+    """
+    i, n = shard
+    n_keypoints = {}
+    for j in jobs:
+        for path in (j.path_target, j.path_source):
+            if path not in n_keypoints: n_keypoints[path] = compter_keypoints(path)
+    par_cle = {(j.target_id, j.source_id): j for j in jobs}
+    couts = {cle: float(n_keypoints[j.path_target]) * n_keypoints[j.path_source] for cle, j in par_cle.items()}
+    shards = repartir_lpt(couts, n)
+
+    ordre = list(shards[i - 1])
+    if steal:
+        autres = [list(reversed(shards[k])) for k in range(n) if k != i - 1]
+        for rang in range(max((len(a) for a in autres), default=0)):
+            ordre += [a[rang] for a in autres if rang < len(a)]
+    return [par_cle[cle] for cle in ordre]
+
+def servir_miroirs(miroirs, output_dir, format_sortie):
+    """Miroirs des paires calculées (y compris lors d'une exécution précédente ou par un autre shard)."""
+    n_miroirs = 0
+    for (target_id, source_id), miroir in miroirs.items():
+        canonique = Job(target_id, source_id, miroir.path_source, miroir.path_target)
+        with profiling.etape("miroir"):
+            n_miroirs += servir_miroir(canonique, miroir, output_dir, format_sortie)
+    if miroirs: print(f"\nMiroirs  : {n_miroirs}/{len(miroirs)} paires servies par symétrie")
+    return n_miroirs
+
+def consolider_cibles(cibles, output_dir):
+    # Fusion des fragments (y compris ceux d'une exécution interrompue) dans matches.store
+    for target_id in sorted(set(cibles)):
+        with profiling.contexte(cible=target_id), profiling.etape("consolidation"):
+            consolider(os.path.join(output_dir, target_id))
+
+def fusionner_sorties(jobs, cibles, miroirs, output_dir, format_sortie):
+    """
+    Étape --merge, sur une seule machine une fois les shards terminés : miroirs, consolidation
+    des stores, puis vérification que chaque paire attendue est présente.
+    Retourne le code de sortie (0 si la grille est complète).
+    """
+    actives = revendications_actives(os.path.join(output_dir, DOSSIER_CLAIMS))
+    if actives:
+        print(f"[ATTENTION] {len(actives)} paires encore revendiquées (shard en cours ou arrêté), ex : {actives[0][0]} vs {actives[0][1]}")
+
+    servir_miroirs(miroirs, output_dir, format_sortie)
+    if format_sortie == "store": consolider_cibles(cibles, output_dir)
+
+    attendues = list(jobs) + list(miroirs.values())
+    presentes = {}
+    manquantes = []
+    for j in attendues:
+        if format_sortie == "store":
+            if j.target_id not in presentes:
+                presentes[j.target_id] = sources_presentes(os.path.join(output_dir, j.target_id))
+            ok = j.source_id in presentes[j.target_id]
+        else:
+            ok = paire_presente(output_dir, format_sortie, j.target_id, j.source_id)
+        if not ok: manquantes.append(j)
+
+    print(f"Vérification : {len(attendues) - len(manquantes)}/{len(attendues)} paires présentes")
+    if not manquantes: return 0
+    path_manquantes = os.path.join(output_dir, "missing_pairs.txt")
+    with open(path_manquantes, 'w') as f:
+        for j in manquantes: f.write(f"{j.target_id},{j.source_id}\n")
+    for j in manquantes[:10]: print(f"   manquante : {j.target_id} vs {j.source_id}")
+    print(f"[ERREUR] {len(manquantes)} paires manquantes (liste : {path_manquantes})")
+    return 1
+
 def main():
     args = parse_arguments()
 
     # 1. Chemins absolus
-    exe_path = os.path.abspath(args.exe)
     patients_dir = os.path.abspath(args.patients)
     atlases_dir = os.path.abspath(args.atlases)
     output_dir = os.path.abspath(args.output)
 
-    if not os.path.exists(exe_path):
-        print(f"[ERREUR] Exécutable introuvable : {exe_path}")
-        sys.exit(1)
-    
+    exe_path = None
+    if args.matcher == "exe" and not args.merge:
+        if not args.exe:
+            print("[ERREUR] --exe est requis avec --matcher exe")
+            sys.exit(1)
+        exe_path = os.path.abspath(args.exe)
+        if not os.path.exists(exe_path):
+            print(f"[ERREUR] Exécutable introuvable : {exe_path}")
+            sys.exit(1)
+
     targets = sorted(glob.glob(os.path.join(patients_dir, "*.key")))
     sources = sorted(glob.glob(os.path.join(atlases_dir, "*.key")))
 
@@ -46,106 +506,144 @@ def main():
         sys.exit(1)
 
     print(f"--- DÉMARRAGE DU GÉNÉRATEUR ---")
-    if args.no_rotation:
+    print(f"--- MATCHER : {args.matcher} ---")
+    if args.matcher == "python":
+        if args.no_rotation: print("--- Option --no_rotation ignorée (propre à featMatchMultiple) ---")
+    elif args.no_rotation:
         print("!!! MODE : Rotation DÉSACTIVÉE (Option -r- utilisée) !!!")
     else:
         print("--- MODE : Rotation ACTIVÉE (Comportement par défaut) ---")
 
     print(f"Cibles : {len(targets)}")
     print(f"Sources: {len(sources)}")
-    
+
     start_time_global = time.time()
+    profiling.activer(os.path.abspath(args.profile) if args.profile else None)
 
-    # BOUCLE PRINCIPALE
-    for i, path_target in enumerate(targets):
-        target_filename = os.path.basename(path_target)
-        # Extraction ID propre
-        target_id = target_filename.split('_')[0].split('.')[0] 
-        if target_filename.startswith("sub-"):
-             target_id = target_filename.split('_')[0]
-        
-        target_output_dir = os.path.join(output_dir, target_id)
-        if not os.path.exists(target_output_dir):
-            os.makedirs(target_output_dir)
-        
-        print(f"\n[{i+1}/{len(targets)}] Cible : {target_id}")
-        
-        for j, path_source in enumerate(sources):
-            source_filename = os.path.basename(path_source)
-            raw_source_id = source_filename.split('_')[0].replace(".key", "")
-            final_source_id = f"sub-{raw_source_id}" if not raw_source_id.startswith("sub-") else raw_source_id
-
-            # Fichiers finaux attendus
-            dest_match1 = os.path.join(target_output_dir, f"match_{final_source_id}.img1.txt")
-            dest_match2 = os.path.join(target_output_dir, f"match_{final_source_id}.img2.txt")
+    # 2. Liste des paires
+    jobs, cibles, miroirs = construire_grille(targets, sources, output_dir, args.symmetric)
+    if miroirs: print(f"Symétrie : {len(miroirs)} paires servies par échange img1/img2")
 
-            # --- FIX ANTI AUTO-MATCH ---
-            t_clean = target_id.replace("sub-", "")
-            s_clean = final_source_id.replace("sub-", "")
-
-            if t_clean == s_clean:
-                if os.path.exists(dest_match1): 
-                    try: os.remove(dest_match1)
-                    except: pass
-                if os.path.exists(dest_match2): 
-                    try: os.remove(dest_match2)
-                    except: pass
-                continue
+    etat = etat_grille(targets, sources)
+    if args.merge:
+        code = fusionner_sorties(jobs, cibles, miroirs, output_dir, args.format)
+        # Grille complète : état de référence du prochain --incremental
+        if code == 0: ecrire_etat(output_dir, etat)
+        print(f"--- TERMINÉ en {(time.time() - start_time_global)/60:.1f} minutes ---")
+        sys.exit(code)
 
-            if os.path.exists(dest_match1) and os.path.exists(dest_match2):
-                continue
+    # Un manifeste par shard : chaque machine a le sien (SQLite n'est pas fait pour l'écriture concurrente sur NFS)
+    nom_manifest = NOM_MANIFEST if not args.shard else "manifest.shard-{}-of-{}.sqlite".format(*args.shard)
+    manifest = Manifest(args.manifest or os.path.join(output_dir, nom_manifest))
 
-            # --- EXÉCUTION (GÉRÉE PAR L'ARGUMENT) ---
-            if args.no_rotation:
-                # Mode Sans Rotation (-r-)
-                cmd = [exe_path, "-r-", path_target, path_source]
-            else:
-                # Mode Défaut (Avec Rotation)
-                cmd = [exe_path, path_target, path_source]
-            
-            try:
-                subprocess.run(cmd, cwd=target_output_dir, check=False, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-                
-                # Récupération résultats
-                motif_recherche = os.path.join(atlases_dir, f"{raw_source_id}*.matches.img1.txt")
-                candidats = glob.glob(motif_recherche)
-                
-                moved = False
-                if candidats:
-                    f_src_1 = candidats[0]
-                    f_src_2 = f_src_1.replace(".img1.txt", ".img2.txt")
-                    
-                    shutil.move(f_src_1, dest_match1)
-                    if os.path.exists(f_src_2):
-                        shutil.move(f_src_2, dest_match2)
-                    moved = True
-                
-                if moved:
-                    sys.stdout.write(f"\r   -> vs {final_source_id} : OK   ")
-                else:
-                    sys.stdout.write(f"\r   -> vs {final_source_id} : - (Non trouvé) ")
-                sys.stdout.flush()
-
-            except Exception as e:
-                print(f" [Erreur: {e}]")
-
-            # --- NETTOYAGE AGRESSIF ---
-            extensions_poubelle = [
-                ".matches.info.txt",
-                ".trans.txt",
-                ".trans-inverse.txt",
-                ".update.key"
-            ]
-            dossiers_a_nettoyer = [target_output_dir, atlases_dir, patients_dir]
-
-            for dossier in dossiers_a_nettoyer:
-                for ext in extensions_poubelle:
-                    fichiers_sales = glob.glob(os.path.join(dossier, f"*{ext}"))
-                    for f_sale in fichiers_sales:
-                        try: os.remove(f_sale)
-                        except OSError: pass
+    refaire = []
+    if args.incremental:
+        precedent = lire_etat(output_dir)
+        if precedent is None:
+            print(f"Incrémental : aucun {NOM_ETAT}, grille complète")
+        else:
+            jobs, miroirs, refaire = selectionner_increment(jobs, miroirs, precedent, etat, manifest.non_terminees())
+
+    if args.shard:
+        jobs = selectionner_shard(jobs, args.shard, args.steal)
+        i, n = args.shard
+        print(f"Shard {i}/{n} : {len(jobs)} paires" + (" (dont paires des autres shards, --steal)" if args.steal else ""))
+
+    # 3. Manifeste : statut de chaque paire, repris d'une exécution à l'autre
+    if args.format == "store":
+        # En-tête du store + fragments en attente, lus une fois par cible
+        presentes = {}
+        def sorties_presentes(target_id, source_id):
+            if target_id not in presentes:
+                presentes[target_id] = sources_presentes(os.path.join(output_dir, target_id))
+            return source_id in presentes[target_id]
+    else:
+        def sorties_presentes(target_id, source_id):
+            return paire_presente(output_dir, args.format, target_id, source_id)
+
+    with profiling.etape("manifest"):
+        manifest.synchroniser([tuple(j) for j in jobs], sorties_presentes, reprendre_echecs=args.retry_failed)
+        # Cible ou atlas modifié : les sorties présentes sont périmées
+        manifest.a_refaire(refaire)
+    ids_jobs = {(j.target_id, j.source_id) for j in jobs}
+    rang = {(j.target_id, j.source_id): i for i, j in enumerate(jobs)}
+    max_tentatives = 1 + args.retries
+
+    claims_dir = None
+    if args.shard:
+        claims_dir = os.path.join(output_dir, DOSSIER_CLAIMS)
+        os.makedirs(claims_dir, exist_ok=True)
+    scratch_root = creer_racine_scratch(args.scratch_dir, "generate_matches_", os.path.join(output_dir, NOM_SCRATCH))
+    if args.scratch_dir: print(f"Scratch : {scratch_root}")
+    config = argparse.Namespace(output_dir=output_dir, scratch_root=scratch_root,
+                                matcher=args.matcher, ratio=args.ratio, exe_path=exe_path,
+                                no_rotation=args.no_rotation, timeout=args.timeout, format=args.format,
+                                claims_dir=claims_dir, claim_ttl=args.claim_ttl, refaire=frozenset(refaire))
+
+    # Le matcher python est CPU-bound (processus) ; featMatchMultiple tourne déjà dans un sous-processus (threads)
+    if args.matcher == "python" and args.workers > 1:
+        executor = ProcessPoolExecutor(max_workers=args.workers, initializer=profiling.activer,
+                                       initargs=(args.profile,))
+    else:
+        executor = ThreadPoolExecutor(max_workers=max(args.workers, 1))
+
+    # Ordre de la liste des jobs (coût décroissant avec --shard)
+    a_traiter = lambda: sorted(manifest.a_traiter(max_tentatives, ids=ids_jobs), key=lambda l: rang[(l[0], l[1])])
+    a_faire = a_traiter()
+    # Lots par cible : matcher exe uniquement (le matcher python garde déjà la cible en mémoire)
+    taille_lot = max(args.batch_size, 1) if args.matcher == "exe" else 1
+    print(f"Paires : {len(jobs)} ({len(a_faire)} à calculer, workers : {args.workers}"
+          + (f", lots de {taille_lot} sources par appel" if taille_lot > 1 else "") + ")")
+    n_faits = 0
+    n_ailleurs = 0
+    try:
+        while a_faire:
+            futures = []
+            for lot in lots_par_cible(a_faire, taille_lot):
+                for job in lot: manifest.demarrer(job.target_id, job.source_id)
+                futures.append(executor.submit(executer_lot, lot, config))
+
+            for fut in as_completed(futures):
+                for job, (statut, duree, code_retour, erreur) in fut.result():
+                    if statut == "claimed":
+                        # Traitée par une autre machine : ni échec ni nouvelle tentative dans cette exécution
+                        manifest.liberer(job.target_id, job.source_id)
+                        ids_jobs.discard((job.target_id, job.source_id))
+                        n_ailleurs += 1
+                        continue
+                    with profiling.etape("manifest"):
+                        manifest.terminer(job.target_id, job.source_id, statut, duree, code_retour, erreur)
+                    n_faits += 1
+                    if statut == "done" and (job.target_id, job.source_id) in miroirs:
+                        with profiling.etape("miroir"):
+                            servir_miroir(job, miroirs[(job.target_id, job.source_id)], output_dir, args.format)
+                    if statut == "done":
+                        sys.stdout.write(f"\r   [{n_faits}] {job.target_id} vs {job.source_id} : OK ({duree:.1f} s)   ")
+                    else:
+                        sys.stdout.write(f"\n   [{n_faits}] {job.target_id} vs {job.source_id} : ÉCHEC ({erreur})\n")
+                    sys.stdout.flush()
+
+            # Nouvelle passe pour les échecs qui ont encore des tentatives
+            a_faire = a_traiter()
+    finally:
+        executor.shutdown()
+        resume = manifest.resume()
+        manifest.fermer()
+        try: os.rmdir(config.scratch_root)
+        except OSError: pass
+        # Avec --shard, miroirs et consolidation sont laissés à --merge (une seule machine)
+        if not args.shard:
+            servir_miroirs(miroirs, output_dir, args.format)
+            if args.format == "store": consolider_cibles(cibles, output_dir)
+            # Les paires inachevées restent au manifeste et seront reprises par le prochain --incremental
+            ecrire_etat(output_dir, etat)
+        recapitulatif = profiling.terminer()
+        if recapitulatif: print(f"\n\n=== PROFIL ({args.profile}) ===\n{recapitulatif}")
 
-    print(f"\n\n--- TERMINÉ en {(time.time() - start_time_global)/60:.1f} minutes ---")
+    print(f"\n\nManifeste : " + ", ".join(f"{k}={v}" for k, v in sorted(resume.items())))
+    if n_ailleurs: print(f"Paires traitées par d'autres workers : {n_ailleurs}")
+    if args.shard: print("Lancer --merge une fois tous les shards terminés.")
+    print(f"--- TERMINÉ en {(time.time() - start_time_global)/60:.1f} minutes ---")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
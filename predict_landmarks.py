@@ -6,110 +6,427 @@ import argparse
 import shutil
 import sys
 import time
-from sklearn.linear_model import RANSACRegressor
+from contextlib import nullcontext
+from concurrent.futures import ProcessPoolExecutor
+from collections import namedtuple
+from functools import partial
+
+from recalage import profiling
+from recalage.atlas_bank import charger_atlas_bank
+from recalage.cache_transformations import TAILLE_MAX_MO, affine_en_cache, fermer_caches, ouvrir_cache
+from recalage.gt import identifiant_sujet, identifiants_atlas, load_gt_atlas, meme_sujet, save_fcsv
+from recalage.index_ann import (N_CANDIDATS_DEFAUT, NPROBE_DEFAUT, build_ann_index, charger_index,
+                                chemin_index_defaut, sources_atlas)
+from recalage.keys import SELECTIONS, charger_key, charger_key_reduit, lire_fichier_key, sous_echantillonner
+from recalage.matches_io import charger_fichier_matches_robuste
+from recalage.matching import RATIO_DEFAUT, apparier_keypoints, apparier_voisinage
+from recalage.prescreening import classer_atlas, signatures_atlas
+from recalage.reduction import lire_liste_atlas
+from recalage.scratch import creer_racine_scratch, nettoyer_espace_job, nom_local_lot, preparer_espace_job, sorties_lot
 
 """
 Script de PRÉDICTION DE LANDMARKS.
 """
 
-# --- CONFIGURATION ---
-SUFFIXE_GT_ATLAS = "_space-T1w_desc-groundtruth_afids"
-
 def parse_arguments():
     parser = argparse.ArgumentParser(description="Prédicteur de Landmarks SIFT-RANSAC (Multi-Atlas).")
     
     # Entrées / Sorties
     parser.add_argument("--input", required=True, help="Fichier .key ou dossier contenant les .key des patients à prédire")
-    parser.add_argument("--atlas_dir", required=True, help="Dossier contenant les atlas (.key et leurs GT .fcsv)")
     parser.add_argument("--output", required=True, help="Dossier de sortie des prédictions (.fcsv)")
-    parser.add_argument("--exe", required=True, help="Chemin vers l'exécutable featMatchMultiple")
+    ajouter_arguments_prediction(parser)
+    
+    return parser.parse_args()
+
+def ajouter_arguments_prediction(parser):
+    """Options communes au script et au serveur de prédiction (prediction_server.py)."""
+    source_atlas = parser.add_mutually_exclusive_group(required=True)
+    source_atlas.add_argument("--atlas_dir", help="Dossier contenant les atlas (.key et leurs GT .fcsv)")
+    source_atlas.add_argument("--atlas_bank", help="Banque d'atlas pré-construite (build_atlas_bank.py), memory-mappée")
+    parser.add_argument("--atlas_list", help="Liste réduite d'atlas à utiliser (reduce_atlases.py), un identifiant par ligne")
+    parser.add_argument("--exe", help="Chemin vers l'exécutable featMatchMultiple (requis avec --matcher exe)")
     
     # Paramètres Algorithme
     parser.add_argument("--k", type=int, default=12, help="Nombre d'atlas à utiliser pour la fusion (K)")
     parser.add_argument("--min_samples", type=int, default=5, help="RANSAC: Min samples")
     parser.add_argument("--threshold", type=float, default=15.0, help="RANSAC: Residual threshold")
+    parser.add_argument("--ransac", choices=["numpy", "sklearn"], default="numpy",
+                        help="RANSAC: moteur batché NumPy (défaut) ou RANSACRegressor de sklearn (référence)")
     parser.add_argument("--no_rotation", action="store_true", help="Si activé, ajoute -r- (Désactive rotation)")
+    parser.add_argument("--matcher", choices=["exe", "python", "ann"], default="exe",
+                        help="Backend d'appariement : featMatchMultiple (exe), matcher SIFT in-process (python), "
+                             "ou index approché de tous les atlas, une recherche par patient (ann)")
+    parser.add_argument("--ratio", type=float, default=RATIO_DEFAUT, help="Matchers python/ann : seuil du test du ratio")
+    parser.add_argument("--ann_index", help="Matcher ann : index IVF-PQ (build_ann_index.py ; défaut : à côté des atlas, construit si absent ou périmé)")
+    parser.add_argument("--ann_nprobe", type=int, default=NPROBE_DEFAUT, help="Matcher ann : listes visitées par descripteur (rappel / vitesse)")
+    parser.add_argument("--ann_candidates", type=int, default=N_CANDIDATS_DEFAUT,
+                        help="Matcher ann : candidats par (descripteur, atlas) re-classés par distance exacte")
+    parser.add_argument("--ann_no_rerank", action="store_true", help="Matcher ann : test du ratio sur les distances PQ approchées")
+
+    # Performance
+    parser.add_argument("--order", choices=["sorted", "random", "prior"], default="sorted",
+                        help="Ordre de visite des atlas : nom de fichier, aléatoire (--seed), ou qualité passée (--prior_file)")
+    parser.add_argument("--seed", type=int, default=0, help="Graine de l'ordre aléatoire")
+    parser.add_argument("--prior_file", help="CSV de qualité des atlas (inliers moyens), lu pour --order prior et mis à jour après chaque patient")
+    parser.add_argument("--adaptive_tol", type=float, default=0.0,
+                        help="Arrêt adaptatif : stoppe quand le consensus Top-K bouge de moins de tol mm (0 = désactivé)")
+    parser.add_argument("--adaptive_window", type=int, default=5, help="Arrêt adaptatif : fenêtre (en atlas) de stabilité")
+    parser.add_argument("--prescreen", type=int, default=0,
+                        help="Pré-sélection : matching complet uniquement sur les M atlas de signature globale la plus proche (ex: 3*K ; 0 = désactivé)")
+    parser.add_argument("--coarse_keypoints", type=int, default=0,
+                        help="Grossier-fin (matcher python) : keypoints max par volume en passe grossière (0 = désactivé)")
+    parser.add_argument("--coarse_selection", choices=SELECTIONS, default="grid",
+                        help="Grossier-fin : sous-échantillon des plus grandes échelles (scale) ou stratifié dans l'espace (grid)")
+    parser.add_argument("--refine_top", type=int, default=0, help="Grossier-fin : atlas du Top grossier repris en passe fine (0 = K, sinon au moins K)")
+    parser.add_argument("--refine_keypoints", type=int, default=0, help="Grossier-fin : keypoints max par volume en passe fine (0 = tous)")
+    parser.add_argument("--refine_radius", type=float, default=20.0,
+                        help="Grossier-fin : rayon (mm) du voisinage de la prédiction grossière où sont cherchés les appariements")
+    parser.add_argument("--workers", type=int, default=1, help="Nombre de processus pour traiter les atlas en parallèle (1 = séquentiel)")
+    parser.add_argument("--batch_size", type=int, default=1,
+                        help="Matcher exe : atlas passés à featMatchMultiple en un seul appel avec le patient (1 = un appel par atlas)")
+    parser.add_argument("--scratch_dir", help="Dossiers de travail de featMatchMultiple : 'shm' (/dev/shm) ou un chemin, typiquement un tmpfs "
+                                              "(défaut : <output>/temp_prediction_workspace)")
+    parser.add_argument("--transform_cache", help="Cache SQLite des transformations RANSAC (clé : hash des matches + paramètres), partagé avec top_K.py")
+    parser.add_argument("--transform_cache_size", type=float, default=TAILLE_MAX_MO, help="Taille maximale du cache (Mo), éviction LRU")
+    parser.add_argument("--transform_cache_masks", action="store_true", help="Conserve aussi les masques d'inliers dans le cache")
+    parser.add_argument("--profile", help="Trace JSON-lines des temps par étape et par paire (patient, atlas) ; récapitulatif dans <trace>_summary.txt")
+
+# --- 3. TRAITEMENT ---
+
+# Un atlas de la base ; index = ligne dans la banque (None en mode dossier)
+Atlas = namedtuple("Atlas", ["atlas_id", "raw_atlas_id", "key_path", "index"])
+
+def lister_atlas(args):
+    """Liste des atlas, construite une seule fois pour tous les patients (restreinte à --atlas_list)."""
+    if args.atlas_bank:
+        bank = charger_atlas_bank(args.atlas_bank)
+        atlases = [Atlas(bank.ids[i], bank.raw_ids[i], bank.key_paths[i], i) for i in range(len(bank))]
+    else:
+        atlases = []
+        for key_path in sorted(glob.glob(os.path.join(args.atlas_dir, "*.key"))):
+            raw_atlas_id, atlas_id = identifiants_atlas(key_path)
+            atlases.append(Atlas(atlas_id, raw_atlas_id, key_path, None))
+    if not args.atlas_list: return atlases
+
+    retenus = set(lire_liste_atlas(args.atlas_list))
+    absents = retenus - {a.atlas_id for a in atlases}
+    if absents: print(f"Attention : {len(absents)} atlas de {args.atlas_list} introuvables (ex: {sorted(absents)[:3]})")
+    return [a for a in atlases if a.atlas_id in retenus]
+
+def keypoints_atlas(atlas, args):
+    if atlas.index is not None: return charger_atlas_bank(args.atlas_bank).keypoints(atlas.index)
+    return lire_fichier_key(atlas.key_path)
+
+def gt_atlas(atlas, args):
+    if atlas.index is not None: return charger_atlas_bank(args.atlas_bank).gt_atlas(atlas.index)
+    return load_gt_atlas(args.atlas_dir, atlas.raw_atlas_id)
+
+def matcher_exe(patient_key_path, atlas_key_path, raw_atlas_id, args, job_dir):
+    """Backend featMatchMultiple : lance le binaire dans job_dir et relit ses fichiers texte."""
+    with profiling.etape("fichiers"):
+        patient_local, atlas_local = preparer_espace_job(job_dir, [patient_key_path, atlas_key_path])
+
+    cmd = [args.exe]
+    if args.no_rotation: cmd.append("-r-")
+    cmd.append(patient_local) 
+    cmd.append(atlas_local)   
+
+    with profiling.etape("featMatchMultiple"):
+        subprocess.run(cmd, cwd=job_dir, check=False, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
     
-    return parser.parse_args()
+    # Récupération (les sorties sont écrites à côté de l'atlas, donc dans job_dir)
+    with profiling.etape("fichiers"):
+        motif = os.path.join(job_dir, f"{raw_atlas_id}*.matches.img1.txt")
+        trouves = glob.glob(motif)
+    if not trouves: return None
 
-# --- 1. FONCTIONS FICHIERS ---
+    match_file_1 = trouves[0]
+    match_file_2 = match_file_1.replace(".img1.txt", ".img2.txt")
+    with profiling.etape("lecture_matches"):
+        return charger_fichier_matches_robuste(match_file_1), charger_fichier_matches_robuste(match_file_2)
+
+def grossier_fin(args):
+    """Mode grossier-fin actif (propre au matcher python, seul à voir les keypoints)."""
+    return args.coarse_keypoints > 0 and args.matcher == "python"
+
+def matcher_exe_lot(patient_key_path, lot, args, lot_dir):
+    """
+    Un seul appel featMatchMultiple pour le patient et un lot d'atlas, exposés sous des noms indexés
+    (nom_local_lot) : [(pts_patient, pts_atlas), ou None sans sortie] dans l'ordre du lot.
+    """
+    noms = [nom_local_lot(i, atlas.key_path) for i, atlas in enumerate(lot)]
+    with profiling.etape("fichiers"):
+        locaux = preparer_espace_job(lot_dir, [patient_key_path] + [atlas.key_path for atlas in lot], [None] + noms)
+    cmd = [args.exe] + (["-r-"] if args.no_rotation else []) + locaux
+    with profiling.etape("featMatchMultiple"):
+        subprocess.run(cmd, cwd=lot_dir, check=False, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    with profiling.etape("fichiers"):
+        sorties = sorties_lot(lot_dir, noms)
+    with profiling.etape("lecture_matches"):
+        return [None if fichiers is None else tuple(charger_fichier_matches_robuste(f) for f in fichiers)
+                for fichiers in sorties]
+
+def traiter_lot(lot, patient_key_path=None, patient_id=None, args=None, work_dir=None):
+    """
+    Lot d'atlas (--batch_size) : un appel featMatchMultiple, puis RANSAC et projection atlas par atlas.
+    Un atlas sans sortie (ou tout le lot si l'appel échoue) repasse par un appel par paire.
+    Résultats de traiter_atlas, dans l'ordre du lot.
+    """
+    eligibles = [atlas for atlas in lot if not meme_sujet(patient_id, atlas.atlas_id)]
+    matches = {}
+    if len(eligibles) > 1:
+        lot_dir = os.path.join(work_dir, f"lot__{eligibles[0].atlas_id}")
+        with profiling.contexte(patient=patient_id, atlas=f"lot de {len(eligibles)}"):
+            try:
+                matches = dict(zip([atlas.atlas_id for atlas in eligibles],
+                                   matcher_exe_lot(patient_key_path, eligibles, args, lot_dir)))
+            except Exception as e:
+                print(f"\n[ERREUR LOT] : {e} (repli : un appel par atlas)")
+            finally:
+                with profiling.etape("nettoyage"):
+                    nettoyer_espace_job(lot_dir)
+    return [traiter_atlas(atlas, matches.get(atlas.atlas_id), patient_key_path=patient_key_path,
+                          patient_id=patient_id, args=args, work_dir=work_dir) for atlas in lot]
+
+def matcher_python(patient_key_path, atlas, args, passe=None, affine_grossiere=None):
+    """
+    Backend in-process : aucun sous-processus ni fichier intermédiaire.
+    passe "grossiere" : keypoints sous-échantillonnés (--coarse_keypoints) des deux côtés ;
+    passe "fine" : tous les keypoints (ou --refine_keypoints), appariés au voisinage de l'affine grossière.
+    """
+    with profiling.etape("lecture_keys"):
+        if passe == "grossiere":
+            kp_patient = charger_key_reduit(patient_key_path, args.coarse_keypoints, args.coarse_selection)
+            kp_atlas = sous_echantillonner(keypoints_atlas(atlas, args), args.coarse_keypoints, args.coarse_selection)
+        elif passe == "fine":
+            kp_patient = charger_key_reduit(patient_key_path, args.refine_keypoints, args.coarse_selection)
+            kp_atlas = sous_echantillonner(keypoints_atlas(atlas, args), args.refine_keypoints, args.coarse_selection)
+        else:
+            kp_patient = charger_key(patient_key_path) # lu une seule fois par processus
+            kp_atlas = keypoints_atlas(atlas, args)
+    if passe == "fine":
+        with profiling.etape("matching_fin"):
+            return apparier_voisinage(kp_patient, kp_atlas, affine_grossiere, args.refine_radius, ratio=args.ratio)
+    with profiling.etape("matching_python"):
+        return apparier_keypoints(kp_patient, kp_atlas, ratio=args.ratio)
+
+def traiter_atlas(atlas, matches=None, patient_key_path=None, patient_id=None, args=None, work_dir=None,
+                  passe=None, affine_grossiere=None):
+    """
+    Matching + RANSAC + projection des landmarks pour une paire (patient, atlas).
+    matches : (pts_patient, pts_atlas) déjà trouvés, par l'index (--matcher ann) ou par un appel en lot (--batch_size).
+    passe / affine_grossiere : mode grossier-fin (voir matcher_python).
+    Retourne (code_statut, n_inliers, pred_landmarks, affine) ; code_statut est le caractère
+    de progression affiché ('.', 'x', 'o', '-', 'G') ou None si la paire est ignorée.
+    """
+    with profiling.contexte(patient=patient_id, atlas=atlas.atlas_id):
+        return _traiter_atlas(atlas, matches, patient_key_path, patient_id, args, work_dir, passe, affine_grossiere)
+
+def raffiner_atlas(atlas, affine_grossiere, **kwargs):
+    """Passe fine d'un atlas du Top grossier (job picklable pour le pool)."""
+    return traiter_atlas(atlas, passe="fine", affine_grossiere=affine_grossiere, **kwargs)
+
+def _traiter_atlas(atlas, matches, patient_key_path, patient_id, args, work_dir, passe, affine_grossiere):
+    atlas_id = atlas.atlas_id
+    
+    # Anti Auto-Match
+    if meme_sujet(patient_id, atlas_id): return None, 0, None, None
+
+    # Dossier propre au job : aucune collision possible entre atlas traités en parallèle
+    job_dir = os.path.join(work_dir, atlas_id)
 
-def charger_fichier_matches_robuste(path):
-    try:
-        data = []
-        with open(path, 'r') as f: lines = f.readlines()
-        offset = -1
-        for line in lines:
-            if line.startswith('#'): continue
-            parts = line.split()
-            if len(parts) < 5: continue
-            for i in range(1, len(parts)-2):
-                try:
-                    if float(parts[i]) and float(parts[i+1]) and float(parts[i+2]):
-                        offset = i; break
-                except: continue
-            if offset != -1: break
-        if offset == -1: return None 
-        
-        for line in lines:
-            if line.startswith('#'): continue
-            parts = line.split()
-            if len(parts) < offset + 3: continue
-            try: data.append([float(parts[offset]), float(parts[offset+1]), float(parts[offset+2])])
-            except: continue
-        return np.array(data)
-    except: return None
-
-def load_gt_atlas(atlas_dir, atlas_id):
-    # Essai 1
-    p1 = os.path.join(atlas_dir, f"{atlas_id}{SUFFIXE_GT_ATLAS}.fcsv")
-    if os.path.exists(p1): return np.loadtxt(p1, delimiter=',', comments='#', usecols=(1, 2, 3))
-    # Essai 2 (avec sub-)
-    if not atlas_id.startswith("sub-"):
-        p2 = os.path.join(atlas_dir, f"sub-{atlas_id}{SUFFIXE_GT_ATLAS}.fcsv")
-        if os.path.exists(p2): return np.loadtxt(p2, delimiter=',', comments='#', usecols=(1, 2, 3))
-    # Essai 3 (sans sub-)
-    if atlas_id.startswith("sub-"):
-        p3 = os.path.join(atlas_dir, f"{atlas_id.replace('sub-', '')}{SUFFIXE_GT_ATLAS}.fcsv")
-        if os.path.exists(p3): return np.loadtxt(p3, delimiter=',', comments='#', usecols=(1, 2, 3))
-    return None
-
-def save_fcsv(output_path, points):
-    with open(output_path, 'w') as f:
-        f.write("# Markups fiducial file version = 4.13\n")
-        f.write("# CoordinateSystem = LPS\n")
-        f.write("# columns = id,x,y,z,ow,ox,oy,oz,vis,sel,lock,label,desc,associatedNodeID\n")
-        for i, p in enumerate(points):
-            label = i + 1
-            f.write(f"vtkMRMLMarkupsFiducialNode_{i},{p[0]:.4f},{p[1]:.4f},{p[2]:.4f},0,0,0,1,1,1,0,{label},,\n")
-
-# --- 2. FONCTIONS MATHS ---
-
-def calculer_affine_ransac(pts_src, pts_dst, min_samples=5, threshold=15.0):
-    if len(pts_src) < min_samples or len(pts_dst) < min_samples:
-        return None, 0
-    ransac = RANSACRegressor(min_samples=min_samples, residual_threshold=threshold, random_state=42)
     try:
-        ransac.fit(pts_src, pts_dst)
-        nb_inliers = np.sum(ransac.inlier_mask_)
-        if nb_inliers < min_samples: return None, 0
-        
-        # Refinement
-        src_in = pts_src[ransac.inlier_mask_]
-        dst_in = pts_dst[ransac.inlier_mask_]
-        col_un = np.ones((len(src_in), 1))
-        A = np.hstack([src_in, col_un])
-        solution, _, _, _ = np.linalg.lstsq(A, dst_in, rcond=None)
-        return solution.T, nb_inliers
-    except: return None, 0
+        # --- A. GÉNÉRATION MATCHES ---
+        try:
+            if matches is not None:
+                p_patient, p_atlas = matches
+            elif args.matcher == "python":
+                p_patient, p_atlas = matcher_python(patient_key_path, atlas, args, passe, affine_grossiere)
+            else:
+                matches = matcher_exe(patient_key_path, atlas.key_path, atlas.raw_atlas_id, args, job_dir)
+                if matches is None: return "x", 0, None, None
+                p_patient, p_atlas = matches
 
-# --- 3. TRAITEMENT ---
+        except Exception as e:
+            print(f"\n[ERREUR PYTHON] : {e}")
+            sys.stdout.flush()
+            return None, 0, None, None
+
+        # --- B. CALCUL TRANSFORM ---
+        if p_patient is None or p_atlas is None or len(p_patient) < args.min_samples:
+            return "o", 0, None, None # Pas assez de points
+
+        with profiling.etape("ransac"):
+            cache = ouvrir_cache(args.transform_cache, args.transform_cache_size, args.transform_cache_masks)
+            mat, n_inliers = affine_en_cache(cache, p_atlas, p_patient, 
+                                             min_samples=args.min_samples, 
+                                             threshold=args.threshold,
+                                             backend=args.ransac)
+        if mat is None:
+            return "-", 0, None, None # Ransac fail
+
+        with profiling.etape("gt"):
+            gt = gt_atlas(atlas, args)
+        if gt is None:
+            return "G", 0, None, None # Pas de GT
+
+        ones = np.ones((len(gt), 1))
+        gt_homog = np.hstack([gt, ones])
+        pred_landmarks = np.dot(gt_homog, mat.T)
+        return ".", n_inliers, pred_landmarks, mat
+
+    finally:
+        # Cleanup : tout ce que le binaire a produit est dans job_dir
+        with profiling.etape("nettoyage"):
+            nettoyer_espace_job(job_dir)
+
+def preparer_index_ann(atlases, args):
+    """Index ANN de la session : construit une fois (à côté des atlas), reconstruit si les atlas ont changé."""
+    sources = sources_atlas(args.atlas_dir, args.atlas_bank)
+    index = charger_index(args.ann_index) if os.path.exists(args.ann_index) else None
+    if index is None or not index.a_jour(sources):
+        print(f"Index ANN : construction de {args.ann_index} ({'périmé' if index else 'absent'})...")
+        build_ann_index(args.ann_index, atlas_dir=args.atlas_dir, atlas_bank=args.atlas_bank)
+        charger_index.cache_clear()
+        index = charger_index(args.ann_index)
+    manquants = [a.atlas_id for a in atlases if a.atlas_id not in index.position]
+    if manquants: raise ValueError(f"Atlas absents de l'index {args.ann_index} : {manquants[:5]}")
+    print(f"Index ANN: {args.ann_index} ({len(index)} atlas, {index.parametres.get('n_listes', '?')} listes, nprobe={args.ann_nprobe})")
+    return index
+
+def apparier_ann(patient_key_path, patient_id, atlases, args):
+    """Une seule recherche dans l'index pour tous les atlas : [(pts_patient, pts_atlas)] dans l'ordre de atlases."""
+    index = charger_index(args.ann_index)
+    kp_patient = charger_key(patient_key_path)
+    # Auto-match et atlas hors session (--atlas_list) exclus dès la recherche
+    retenus = {a.atlas_id for a in atlases}
+    exclus = [i for i, atlas_id in enumerate(index.ids) if meme_sujet(patient_id, atlas_id) or atlas_id not in retenus]
+    appariements = index.apparier(kp_patient.descripteurs, args.ratio, nprobe=args.ann_nprobe,
+                                  n_candidats=args.ann_candidates, exclus=exclus, rerank=not args.ann_no_rerank)
+    vide = np.zeros((0, 3))
+    resultats = []
+    for atlas in atlases:
+        i = index.position[atlas.atlas_id]
+        if i not in appariements:
+            resultats.append((vide, vide))
+            continue
+        i_pat, i_atl = appariements[i]
+        resultats.append((kp_patient.coords[i_pat].astype(np.float64),
+                          index.coords_atlas(i)[i_atl].astype(np.float64)))
+    return resultats
 
-def predict_single_patient(patient_key_path, args, temp_root):
+def preparer_prescreening(atlases, args):
+    """(codebook, idf, signatures) des atlas : lus dans la banque, sinon calculés une fois pour la session."""
+    if args.atlas_bank:
+        bank = charger_atlas_bank(args.atlas_bank)
+        if bank.prescreening is not None:
+            # Signatures de la banque : lignes des atlas de la session (--atlas_list)
+            codebook, idf, sigs = bank.prescreening
+            return codebook, idf, np.asarray(sigs)[[a.index for a in atlases]]
+    print("Pré-sélection : calcul des signatures globales des atlas...")
+    return signatures_atlas([keypoints_atlas(a, args).descripteurs for a in atlases])
+
+def preselectionner_atlas(patient_key_path, patient_id, atlases, prescreening, m):
+    """Les m atlas les plus similaires (hors auto-match), dans l'ordre d'origine de la liste."""
+    eligibles = [i for i, a in enumerate(atlases) if not meme_sujet(patient_id, a.atlas_id)]
+    codebook, idf, sigs = prescreening
+    ordre, _ = classer_atlas(charger_key(patient_key_path).descripteurs, codebook, idf, np.asarray(sigs)[eligibles])
+    return [atlases[eligibles[j]] for j in sorted(ordre[:m])]
+
+def charger_prior(path):
+    """Qualité passée des atlas : {atlas_id: (n_patients, inliers_moyens)}."""
+    prior = {}
+    if path and os.path.exists(path):
+        with open(path, 'r') as f:
+            for line in f:
+                if line.startswith('#') or not line.strip(): continue
+                atlas_id, n, moyenne = line.strip().split(',')
+                prior[atlas_id] = (int(n), float(moyenne))
+    return prior
+
+def sauver_prior(path, prior):
+    tmp = f"{path}.tmp"
+    with open(tmp, 'w') as f:
+        f.write("# atlas_id,n_patients,mean_inliers\n")
+        for atlas_id in sorted(prior):
+            n, moyenne = prior[atlas_id]
+            f.write(f"{atlas_id},{n},{moyenne:.4f}\n")
+    os.replace(tmp, path)
+
+def mettre_a_jour_prior(prior, inliers, verrou=None):
+    """Ajoute les inliers d'un patient [(atlas_id, n_inliers)] aux moyennes, en une section sous verrou (serveur)."""
+    with verrou if verrou is not None else nullcontext():
+        for atlas_id, n_inliers in inliers:
+            n, moyenne = prior.get(atlas_id, (0, 0.0))
+            prior[atlas_id] = (n + 1, moyenne + (n_inliers - moyenne) / (n + 1))
+
+def ordonner_atlas(atlases, args, prior, patient_id):
+    """Ordre de visite : nom de fichier (défaut), aléatoire, ou meilleure qualité passée d'abord."""
+    if args.order == "random":
+        # Graine dérivée du patient : ordre reproductible d'une exécution à l'autre
+        graine = [args.seed] + [ord(c) for c in patient_id]
+        return [atlases[i] for i in np.random.default_rng(graine).permutation(len(atlases))]
+    if args.order == "prior":
+        # Les atlas inconnus passent en dernier, dans l'ordre d'origine
+        return sorted(atlases, key=lambda a: -prior.get(a.atlas_id, (0, -1.0))[1])
+    return atlases
+
+def fusion_top_k(candidates, k):
+    """Médiane des prédictions des k candidats ayant le plus d'inliers."""
+    top = sorted(candidates, key=lambda x: x[0], reverse=True)[:k]
+    return np.median(np.array([c[1] for c in top]), axis=0), len(top)
+
+def consensus_stable(historique, fenetre, tol):
+    """
+    Arrêt adaptatif : vrai si, à chacun des `fenetre` derniers atlas, aucun landmark du consensus
+    n'était à plus de tol mm du consensus courant (un aller-retour dans la fenêtre n'est pas stable).
+    """
+    if len(historique) <= fenetre: return False
+    deplacement = np.linalg.norm(np.asarray(historique[-1 - fenetre:-1]) - historique[-1], axis=2)
+    return deplacement.max() < tol
+
+def raffiner_candidats(candidates, job_fin, executor, args):
+    """
+    Passe fine sur les atlas du Top grossier (--refine_top, au moins K), qui remplace leurs candidats :
+    les K fusionnés sont classés sur les inliers fins, jamais face à des atlas restés en passe grossière.
+    Un atlas dont la passe fine échoue est écarté ; si elle échoue pour tous, le Top grossier est gardé tel quel.
+    """
+    top = sorted(candidates, key=lambda c: c[0], reverse=True)[:max(args.refine_top, args.k)]
+    sys.stdout.write(f"\n  Passe fine ({len(top)} atlas) : ")
+    resultats = executer_jobs(job_fin, [c[2] for c in top], executor, len(top), [c[3] for c in top])
+    raffines = []
+    for candidat, (statut, n_inliers, pred_landmarks, mat) in zip(top, resultats):
+        if pred_landmarks is not None: raffines.append((n_inliers, pred_landmarks, candidat[2], mat))
+        sys.stdout.write(statut or "x")
+        sys.stdout.flush()
+    return raffines or top
+
+def executer_jobs(job, atlases, executor, taille_vague, matches=None):
+    """Résultats dans l'ordre des atlas, soumis par vagues pour permettre un arrêt anticipé."""
+    if matches is None: matches = [None] * len(atlases)
+    if executor is None:
+        yield from map(job, atlases, matches)
+        return
+    for debut in range(0, len(atlases), taille_vague):
+        yield from executor.map(job, atlases[debut:debut + taille_vague], matches[debut:debut + taille_vague])
+
+def executer_lots(job, atlases, executor, taille_vague, taille_lot):
+    """Comme executer_jobs, pour un job qui traite des lots consécutifs d'atlas (taille_vague en lots)."""
+    lots = [atlases[debut:debut + taille_lot] for debut in range(0, len(atlases), taille_lot)]
+    if executor is None:
+        for lot in lots: yield from job(lot)
+        return
+    for debut in range(0, len(lots), taille_vague):
+        for resultats in executor.map(job, lots[debut:debut + taille_vague]): yield from resultats
+
+def predict_single_patient(patient_key_path, args, temp_root, atlases, executor=None, prescreening=None, prior=None,
+                           sauvegarder=True, verrou_prior=None):
+    """
+    Prédit les landmarks d'un patient. Retourne le consensus (N_landmarks, 3), ou None en cas d'échec.
+    verrou_prior : verrou pris pour mettre à jour prior, partagé entre threads (prediction_server.py).
+    """
     
-    patient_filename = os.path.basename(patient_key_path)
-    patient_id = patient_filename.split('_')[0].split('.')[0]
-    if patient_filename.startswith("sub-"): patient_id = patient_filename.split('_')[0]
+    patient_id = identifiant_sujet(patient_key_path)
 
     work_dir = os.path.join(temp_root, patient_id)
     if os.path.exists(work_dir): shutil.rmtree(work_dir)
@@ -117,122 +434,144 @@ def predict_single_patient(patient_key_path, args, temp_root):
 
     print(f"\n--- Traitement Patient : {patient_id} ---")
     
-    atlas_keys = sorted(glob.glob(os.path.join(args.atlas_dir, "*.key")))
     candidates = []
 
-    sys.stdout.write("  Matches en cours : ")
-    
-    for idx_atlas, atlas_key_path in enumerate(atlas_keys):
-        atlas_filename = os.path.basename(atlas_key_path)
-        raw_atlas_id = atlas_filename.split('_')[0].replace(".key", "")
-        atlas_id = f"sub-{raw_atlas_id}" if not raw_atlas_id.startswith("sub-") else raw_atlas_id
-        
-        # Anti Auto-Match
-        p_clean = patient_id.replace("sub-", "")
-        a_clean = atlas_id.replace("sub-", "")
-        if p_clean == a_clean: continue
+    if prescreening is not None and args.prescreen < len(atlases):
+        with profiling.contexte(patient=patient_id), profiling.etape("prescreening"):
+            atlases = preselectionner_atlas(patient_key_path, patient_id, atlases, prescreening, args.prescreen)
+        print(f"  Pré-sélection : {len(atlases)} atlas retenus")
 
-        # --- A. GÉNÉRATION MATCHES ---
-        cmd = [args.exe]
-        if args.no_rotation: cmd.append("-r-")
-        cmd.append(patient_key_path) 
-        cmd.append(atlas_key_path)   
+    atlases = ordonner_atlas(atlases, args, prior if prior is not None else {}, patient_id)
+    adaptatif = args.adaptive_tol > 0
 
-        match_file_1 = os.path.join(work_dir, f"match_{atlas_id}.img1.txt")
-        match_file_2 = os.path.join(work_dir, f"match_{atlas_id}.img2.txt")
-        
-        try:
-            
-            subprocess.run(cmd, cwd=work_dir, check=False, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-            
-            # Récupération
-            motif = os.path.join(args.atlas_dir, f"{raw_atlas_id}*.matches.img1.txt")
-            trouves = glob.glob(motif)
-            
-            if trouves:
-                f_src_1 = trouves[0]
-                f_src_2 = f_src_1.replace(".img1.txt", ".img2.txt")
-                shutil.move(f_src_1, match_file_1)
-                if os.path.exists(f_src_2): shutil.move(f_src_2, match_file_2)
-            else:
-                sys.stdout.write("x") 
-                sys.stdout.flush()
-                continue
+    matches = None
+    if args.matcher == "ann":
+        with profiling.contexte(patient=patient_id), profiling.etape("ann"):
+            matches = apparier_ann(patient_key_path, patient_id, atlases, args)
 
-        except Exception as e:
-            print(f"\n[ERREUR PYTHON] : {e}")
-            sys.stdout.flush()
-            continue
+    sys.stdout.write("  Matches en cours : ")
 
-        # --- B. CALCUL TRANSFORM ---
-        p_patient = charger_fichier_matches_robuste(match_file_1)
-        p_atlas = charger_fichier_matches_robuste(match_file_2)
-
-        if p_patient is not None and p_atlas is not None and len(p_patient) >= args.min_samples:
-            mat, n_inliers = calculer_affine_ransac(p_atlas, p_patient, 
-                                                  min_samples=args.min_samples, 
-                                                  threshold=args.threshold)
-            
-            if mat is not None:
-                gt_atlas = load_gt_atlas(args.atlas_dir, raw_atlas_id)
-                if gt_atlas is not None:
-                    ones = np.ones((len(gt_atlas), 1))
-                    gt_homog = np.hstack([gt_atlas, ones])
-                    pred_landmarks = np.dot(gt_homog, mat.T)
-                    candidates.append((n_inliers, pred_landmarks))
-                    sys.stdout.write(".") 
-                else:
-                    sys.stdout.write("G") # Pas de GT
-            else:
-                sys.stdout.write("-") # Ransac fail
-        else:
-            sys.stdout.write("o") # Pas assez de points
-        
+    # Résultats dans l'ordre des atlas : la liste des candidats (et donc la fusion)
+    # est identique en séquentiel et en parallèle, avec ou sans arrêt adaptatif ou lots.
+    taille_vague = max(args.workers, 1) if adaptatif else len(atlases)
+    if args.matcher == "exe" and args.batch_size > 1:
+        job = partial(traiter_lot, patient_key_path=patient_key_path, patient_id=patient_id, args=args, work_dir=work_dir)
+        resultats = executer_lots(job, atlases, executor, taille_vague, args.batch_size)
+    else:
+        job = partial(traiter_atlas, patient_key_path=patient_key_path, patient_id=patient_id,
+                      args=args, work_dir=work_dir, passe="grossiere" if grossier_fin(args) else None)
+        resultats = executer_jobs(job, atlases, executor, taille_vague, matches)
+
+    historique = [] # consensus Top-K après chaque atlas visité (mode adaptatif)
+    inliers_prior = []
+    n_visites = 0
+    for atlas, (statut, n_inliers, pred_landmarks, mat) in zip(atlases, resultats):
+        n_visites += 1
+        if statut is None: continue
+        if pred_landmarks is not None:
+            candidates.append((n_inliers, pred_landmarks, atlas, mat))
+            inliers_prior.append((atlas.atlas_id, n_inliers))
+        sys.stdout.write(statut)
         sys.stdout.flush()
-        
-        # Cleanup fichiers temp
-        for ext in [".matches.info.txt", ".trans.txt", ".trans-inverse.txt", ".update.key"]:
-            for f in glob.glob(os.path.join(work_dir, f"*{ext}")):
-                try: os.remove(f)
-                except: pass
-            for f in glob.glob(os.path.join(args.atlas_dir, f"*{ext}")):
-                try: os.remove(f)
-                except: pass
+
+        if adaptatif and len(candidates) >= args.k:
+            historique.append(fusion_top_k(candidates, args.k)[0])
+            # Arrêt si aucun landmark ne s'est écarté de plus de tol mm sur toute la fenêtre
+            if consensus_stable(historique, args.adaptive_window, args.adaptive_tol): break
 
     print("") 
+    if prior is not None: mettre_a_jour_prior(prior, inliers_prior, verrou_prior)
+    if adaptatif:
+        print(f"  Arrêt adaptatif : {n_visites}/{len(atlases)} atlas visités")
+
+    if grossier_fin(args) and candidates:
+        job_fin = partial(raffiner_atlas, patient_key_path=patient_key_path, patient_id=patient_id,
+                          args=args, work_dir=work_dir)
+        candidates = raffiner_candidats(candidates, job_fin, executor, args)
+        print("")
 
     # --- 4. FUSION ---
     if not candidates:
         print("  [ERREUR] Aucune prédiction valide générée.")
-        return
+        return None
 
-    candidates.sort(key=lambda x: x[0], reverse=True)
-    k_final = min(len(candidates), args.k)
-    top_subset = [c[1] for c in candidates[:k_final]]
-    consensus_pred = np.median(np.array(top_subset), axis=0)
+    with profiling.contexte(patient=patient_id), profiling.etape("fusion"):
+        consensus_pred, k_final = fusion_top_k(candidates, args.k)
+    print(f"  -> Fusion sur {k_final} atlas (Inliers Max: {max(c[0] for c in candidates)}).")
     
-    output_fcsv = os.path.join(args.output, f"{patient_id}_predicted.fcsv")
-    save_fcsv(output_fcsv, consensus_pred)
-    
-    print(f"  -> Fusion sur {k_final} atlas (Inliers Max: {candidates[0][0]}).")
-    print(f"  -> Sauvegardé : {output_fcsv}")
+    if sauvegarder:
+        output_fcsv = os.path.join(args.output, f"{patient_id}_predicted.fcsv")
+        save_fcsv(output_fcsv, consensus_pred)
+        print(f"  -> Sauvegardé : {output_fcsv}")
     
     try: shutil.rmtree(work_dir)
     except: pass
+    return consensus_pred
+
+
+# Tout ce qui ne dépend pas du patient : construit une fois par exécution (ou par serveur)
+Session = namedtuple("Session", ["atlases", "prescreening", "prior", "executor"])
 
+def verifier_arguments(args):
+    """Chemins absolus, vérification de l'exécutable et des options (quitte en cas d'erreur)."""
+    if args.atlas_dir: args.atlas_dir = os.path.abspath(args.atlas_dir)
+    if args.atlas_bank: args.atlas_bank = os.path.abspath(args.atlas_bank)
+    if args.atlas_list: args.atlas_list = os.path.abspath(args.atlas_list)
+    if args.prior_file: args.prior_file = os.path.abspath(args.prior_file)
+    if args.profile: args.profile = os.path.abspath(args.profile)
+    if args.transform_cache: args.transform_cache = os.path.abspath(args.transform_cache)
+    if args.matcher == "ann":
+        args.ann_index = os.path.abspath(args.ann_index) if args.ann_index else chemin_index_defaut(args.atlas_dir, args.atlas_bank)
+    
+    if args.matcher == "exe":
+        if not args.exe:
+            print("[ERREUR FATALE] --exe est requis avec --matcher exe")
+            sys.exit(1)
+        args.exe = os.path.abspath(args.exe)
+        if not os.path.exists(args.exe):
+            print(f"[ERREUR FATALE] Executable introuvable : {args.exe}")
+            sys.exit(1)
+
+    # Moins d'atlas raffinés que K : la fusion comparerait des inliers fins et grossiers
+    if grossier_fin(args) and 0 < args.refine_top < args.k:
+        print(f"[ERREUR FATALE] --refine_top ({args.refine_top}) doit être 0 ou au moins --k ({args.k})")
+        sys.exit(1)
+
+def ouvrir_session(args):
+    atlases = lister_atlas(args)
+    if args.atlas_bank: print(f"Atlas Bank: {args.atlas_bank} ({len(atlases)} atlas)")
+    else: print(f"Atlas Dir: {args.atlas_dir}")
+    if args.atlas_list: print(f"Atlas    : {len(atlases)} retenus ({args.atlas_list})")
+    print(f"Matcher  : {args.matcher}")
+    if args.matcher == "ann": preparer_index_ann(atlases, args)
+    if args.no_rotation:
+        if args.matcher != "exe": print("Option   : --no_rotation ignoré (propre à featMatchMultiple)")
+        else: print("Option   : Rotation DÉSACTIVÉE")
+    if args.coarse_keypoints > 0:
+        if args.matcher != "python": print("Option   : --coarse_keypoints ignoré (propre au matcher python)")
+        else: print(f"Grossier : {args.coarse_keypoints} keypoints ({args.coarse_selection}), passe fine sur "
+                    f"{max(args.refine_top, args.k)} atlas dans un rayon de {args.refine_radius} mm")
+    if args.batch_size > 1:
+        if args.matcher != "exe": print("Option   : --batch_size ignoré (propre à featMatchMultiple)")
+        else: print(f"Lots     : {args.batch_size} atlas par appel à featMatchMultiple")
+    if args.workers > 1: print(f"Workers  : {args.workers}")
+    prescreening = preparer_prescreening(atlases, args) if args.prescreen > 0 else None
+    prior = charger_prior(args.prior_file) if args.prior_file else None
+    if args.order == "prior" and not prior: print("Note     : aucun historique de qualité, ordre par nom de fichier")
+    if args.adaptive_tol > 0: print(f"Adaptatif: tol={args.adaptive_tol} mm sur {args.adaptive_window} atlas (ordre: {args.order})")
+
+    # Un seul pool pour tous les patients (évite de relancer les processus à chaque patient)
+    executor = None
+    if args.workers > 1:
+        executor = ProcessPoolExecutor(max_workers=args.workers, initializer=profiling.activer, initargs=(args.profile,))
+    return Session(atlases, prescreening, prior, executor)
 
 def main():
     args = parse_arguments()
     
-    args.exe = os.path.abspath(args.exe)
     args.input = os.path.abspath(args.input)
-    args.atlas_dir = os.path.abspath(args.atlas_dir)
     args.output = os.path.abspath(args.output)
-    
-    # Vérifications
-    if not os.path.exists(args.exe):
-        print(f"[ERREUR FATALE] Executable introuvable : {args.exe}")
-        sys.exit(1)
+    verifier_arguments(args)
         
     if not os.path.exists(args.output):
         os.makedirs(args.output)
@@ -247,19 +586,32 @@ def main():
         print("[ERREUR] Aucun fichier .key patient trouvé.")
         sys.exit(1)
         
-    # Dossier Temp global
-    temp_root = os.path.join(args.output, "temp_prediction_workspace")
+    # Dossier Temp global (en mémoire avec --scratch_dir shm : rien n'est écrit à côté des atlas ni des patients)
+    temp_root = creer_racine_scratch(args.scratch_dir, "predict_landmarks_", os.path.join(args.output, "temp_prediction_workspace"))
     if not os.path.exists(temp_root): os.makedirs(temp_root)
+    if args.scratch_dir: print(f"Scratch  : {temp_root}")
 
     print(f"=== PRÉDICTION LANDMARKS (K={args.k}) ===")
     print(f"Patients : {len(patients)}")
-    print(f"Atlas Dir: {args.atlas_dir}")
-    if args.no_rotation: print("Option   : Rotation DÉSACTIVÉE")
+    profiling.activer(args.profile)
+    with profiling.etape("session"):
+        session = ouvrir_session(args)
     
     t0 = time.time()
     
-    for p in patients:
-        predict_single_patient(p, args, temp_root)
+    try:
+        for p in patients:
+            with profiling.etape("patient"):
+                predict_single_patient(p, args, temp_root, session.atlases, executor=session.executor,
+                                       prescreening=session.prescreening, prior=session.prior)
+            if session.prior is not None: sauver_prior(args.prior_file, session.prior)
+    finally:
+        if session.executor is not None: session.executor.shutdown()
+        # Contrôle final de la taille du cache (éviction LRU)
+        ouvrir_cache(args.transform_cache, args.transform_cache_size, args.transform_cache_masks)
+        fermer_caches()
+        recapitulatif = profiling.terminer()
+        if recapitulatif: print(f"\n=== PROFIL ({args.profile}) ===\n{recapitulatif}")
         
     # Nettoyage global
     try: shutil.rmtree(temp_root)
@@ -268,4 +620,4 @@ def main():
     print(f"\nTemps Total : {(time.time() - t0)/60:.1f} minutes.")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
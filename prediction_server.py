@@ -0,0 +1,207 @@
+import os
+import sys
+import json
+import queue
+import signal
+import shutil
+import argparse
+import threading
+import socketserver
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from recalage import profiling
+from recalage.cache_transformations import fermer_caches
+from recalage.gt import formater_fcsv
+from recalage.scratch import creer_racine_scratch
+from predict_landmarks import (ajouter_arguments_prediction, grossier_fin, ouvrir_session,
+                               predict_single_patient, sauver_prior, verifier_arguments)
+
+"""
+Serveur de PRÉDICTION : la base d'atlas (liste, GT, banque memory-mappée, signatures,
+pool de processus) est chargée une seule fois, puis chaque scan est traité à la demande.
+
+HTTP (localhost uniquement) :
+    POST /predict   {"key": "/chemin/sub-001_T1w.key", "k": 12, "threshold": 15.0, "min_samples": 5}
+                    -> 200 text/plain : contenu du .fcsv prédit
+    GET  /health    -> 200 JSON (taille de la file, nombre d'atlas)
+Socket Unix (--socket) : une requête JSON par ligne, une réponse JSON par ligne
+    {"ok": true, "fcsv": "..."} ou {"ok": false, "error": "..."}.
+"""
+
+# Paramètres surchargeables par requête
+SURCHARGES = {"k": int, "threshold": float, "min_samples": int}
+
+class ErreurRequete(ValueError):
+    """Requête invalide (400)."""
+
+class ServeurPrediction:
+    """File bornée + pool de threads ; chaque thread exécute une prédiction complète."""
+
+    def __init__(self, args, session, n_workers, taille_file):
+        self.args = args
+        self.session = session
+        self.temp_root = creer_racine_scratch(args.scratch_dir, "prediction_server_")
+        self.file = queue.Queue(maxsize=taille_file)
+        self._compteur = 0
+        self._verrou = threading.Lock()
+        self._threads = [threading.Thread(target=self._boucle, daemon=True) for _ in range(n_workers)]
+        for t in self._threads: t.start()
+
+    def soumettre(self, requete):
+        """Retourne un Future ; lève queue.Full si la file est pleine."""
+        futur = Future()
+        self.file.put_nowait((requete, futur))
+        return futur
+
+    def _boucle(self):
+        while True:
+            requete, futur = self.file.get()
+            if not futur.set_running_or_notify_cancel(): continue
+            try: futur.set_result(self._executer(requete))
+            except Exception as e: futur.set_exception(e)
+            finally: self.file.task_done()
+
+    def _executer(self, requete):
+        key_path = requete.get("key")
+        if not key_path or not os.path.isfile(key_path):
+            raise ErreurRequete(f"Fichier .key introuvable : {key_path}")
+
+        args = argparse.Namespace(**vars(self.args))
+        for nom, type_ in SURCHARGES.items():
+            if requete.get(nom) is not None:
+                try: setattr(args, nom, type_(requete[nom]))
+                except (TypeError, ValueError): raise ErreurRequete(f"Valeur invalide pour {nom} : {requete[nom]!r}")
+        if grossier_fin(args) and 0 < args.refine_top < args.k:
+            raise ErreurRequete(f"k ({args.k}) supérieur à --refine_top ({args.refine_top}) du serveur")
+
+        # Espace de travail propre à la requête : deux requêtes sur le même patient ne se gênent pas
+        with self._verrou:
+            self._compteur += 1
+            temp_req = os.path.join(self.temp_root, f"req_{self._compteur}")
+        os.makedirs(temp_req)
+        try:
+            with profiling.etape("requete"):
+                consensus = predict_single_patient(os.path.abspath(key_path), args, temp_req, self.session.atlases,
+                                                   executor=self.session.executor,
+                                                   prescreening=self.session.prescreening,
+                                                   prior=self.session.prior, sauvegarder=False,
+                                                   verrou_prior=self._verrou)
+        finally:
+            shutil.rmtree(temp_req, ignore_errors=True)
+
+        if consensus is None: raise RuntimeError("Aucune prédiction valide générée.")
+        if self.session.prior is not None:
+            with self._verrou: sauver_prior(self.args.prior_file, self.session.prior)
+        return formater_fcsv(consensus)
+
+    def traiter(self, requete, timeout=None):
+        """Soumet et attend : retourne (code HTTP, corps, type de contenu)."""
+        try:
+            futur = self.soumettre(requete)
+        except queue.Full:
+            return 503, json.dumps({"error": "File d'attente pleine"}), "application/json"
+        try:
+            return 200, futur.result(timeout=timeout), "text/plain"
+        except ErreurRequete as e:
+            return 400, json.dumps({"error": str(e)}), "application/json"
+        except Exception as e:
+            return 500, json.dumps({"error": str(e)}), "application/json"
+
+    def fermer(self):
+        if self.session.executor is not None: self.session.executor.shutdown()
+        shutil.rmtree(self.temp_root, ignore_errors=True)
+        fermer_caches()
+        recapitulatif = profiling.terminer()
+        if recapitulatif: print(f"\n=== PROFIL ({self.args.profile}) ===\n{recapitulatif}")
+
+class HandlerHTTP(BaseHTTPRequestHandler):
+    def _repondre(self, code, corps, type_contenu):
+        donnees = corps.encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", f"{type_contenu}; charset=utf-8")
+        self.send_header("Content-Length", str(len(donnees)))
+        self.end_headers()
+        self.wfile.write(donnees)
+
+    def do_GET(self):
+        if self.path != "/health":
+            return self._repondre(404, json.dumps({"error": "Route inconnue"}), "application/json")
+        prediction = self.server.prediction
+        etat = {"status": "ok", "queue": prediction.file.qsize(), "atlas": len(prediction.session.atlases)}
+        self._repondre(200, json.dumps(etat), "application/json")
+
+    def do_POST(self):
+        if self.path != "/predict":
+            return self._repondre(404, json.dumps({"error": "Route inconnue"}), "application/json")
+        try:
+            taille = int(self.headers.get("Content-Length", 0))
+            requete = json.loads(self.rfile.read(taille) or b"{}")
+        except (ValueError, json.JSONDecodeError):
+            return self._repondre(400, json.dumps({"error": "JSON invalide"}), "application/json")
+        self._repondre(*self.server.prediction.traiter(requete, timeout=self.server.timeout_requete))
+
+class HandlerUnix(socketserver.StreamRequestHandler):
+    def handle(self):
+        for ligne in self.rfile:
+            if not ligne.strip(): continue
+            try:
+                requete = json.loads(ligne)
+            except json.JSONDecodeError:
+                reponse = {"ok": False, "error": "JSON invalide"}
+            else:
+                code, corps, _ = self.server.prediction.traiter(requete, timeout=self.server.timeout_requete)
+                reponse = {"ok": True, "fcsv": corps} if code == 200 else {"ok": False, "error": json.loads(corps)["error"]}
+            self.wfile.write((json.dumps(reponse) + "\n").encode("utf-8"))
+            self.wfile.flush()
+
+def _arreter(signum, frame):
+    raise KeyboardInterrupt
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Serveur de prédiction de landmarks (base d'atlas gardée en mémoire).")
+    ajouter_arguments_prediction(parser)
+
+    # Serveur
+    parser.add_argument("--port", type=int, default=8765, help="Port HTTP sur 127.0.0.1")
+    parser.add_argument("--socket", help="Écoute sur ce socket Unix au lieu du HTTP")
+    parser.add_argument("--server_workers", type=int, default=2, help="Nombre de scans traités simultanément")
+    parser.add_argument("--queue_size", type=int, default=16, help="Taille maximale de la file d'attente (503 au-delà)")
+    parser.add_argument("--request_timeout", type=float, help="Délai maximal d'une requête, en secondes")
+    return parser.parse_args()
+
+def main():
+    args = parse_arguments()
+    verifier_arguments(args)
+
+    print(f"=== SERVEUR DE PRÉDICTION (K={args.k}) ===")
+    profiling.activer(args.profile)
+    prediction = ServeurPrediction(args, ouvrir_session(args), args.server_workers, args.queue_size)
+
+    if args.socket:
+        if os.path.exists(args.socket): os.remove(args.socket)
+        serveur = socketserver.ThreadingUnixStreamServer(args.socket, HandlerUnix)
+        print(f"Écoute   : unix:{args.socket}")
+    else:
+        serveur = ThreadingHTTPServer(("127.0.0.1", args.port), HandlerHTTP)
+        print(f"Écoute   : http://127.0.0.1:{args.port}")
+    serveur.daemon_threads = True
+    serveur.prediction = prediction
+    serveur.timeout_requete = args.request_timeout
+    print(f"Workers  : {args.server_workers} (file : {args.queue_size})")
+    sys.stdout.flush()
+
+    # SIGTERM (et SIGINT, même hérité ignoré en arrière-plan) : arrêt propre
+    signal.signal(signal.SIGTERM, _arreter)
+    signal.signal(signal.SIGINT, _arreter)
+    try:
+        serveur.serve_forever()
+    except KeyboardInterrupt:
+        print("\nArrêt du serveur.")
+    finally:
+        serveur.server_close()
+        prediction.fermer()
+        if args.socket and os.path.exists(args.socket): os.remove(args.socket)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,4 @@
+"""
+Bibliothèque partagée du pipeline SIFT-RANSAC multi-atlas.
+Utilisée par generate_matches.py, top_K.py et predict_landmarks.py.
+"""
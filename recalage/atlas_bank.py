@@ -0,0 +1,108 @@
+import functools
+import glob
+import os
+
+import numpy as np
+
+from recalage.conteneur import ecrire_conteneur, lire_conteneur
+from recalage.gt import identifiants_atlas, load_gt_atlas
+from recalage.keys import Keypoints, lire_fichier_key
+from recalage.prescreening import TAILLE_CODEBOOK, signatures_atlas
+
+"""
+Banque d'atlas pré-construite : un seul fichier, memory-mappé par les lecteurs.
+
+Contenu :
+  - ids / raw_ids / key_paths (métadonnées) : identifiants normalisés 'sub-XXXX' ;
+  - gt (N_atlas, N_landmarks, 3) float64, NaN si l'atlas n'a pas de GT, + masque a_gt ;
+  - keypoints de tous les atlas concaténés (coords, echelles, descripteurs) + table d'offsets ;
+  - optionnel : codebook, idf et signatures globales pour la pré-sélection (prescreening.py).
+"""
+
+EXTENSION_BANK = ".atlasbank"
+
+def build_atlas_bank(atlas_dir, output_path, codebook_size=TAILLE_CODEBOOK, verbose=True):
+    """Construit la banque à partir d'un dossier d'atlas (.key + GT .fcsv). Retourne le nombre d'atlas."""
+    atlas_keys = sorted(glob.glob(os.path.join(atlas_dir, "*.key")))
+    if not atlas_keys: raise ValueError(f"Aucun fichier .key dans {atlas_dir}")
+
+    ids, raw_ids, gts, kps = [], [], [], []
+    forme_gt = None
+    for i, key_path in enumerate(atlas_keys):
+        raw_atlas_id, atlas_id = identifiants_atlas(key_path)
+        gt = load_gt_atlas(atlas_dir, raw_atlas_id)
+        if gt is not None:
+            forme_gt = forme_gt or gt.shape
+            if gt.shape != forme_gt:
+                if verbose: print(f"  [ATTENTION] GT ignorée pour {atlas_id} : forme {gt.shape} != {forme_gt}")
+                gt = None
+        ids.append(atlas_id); raw_ids.append(raw_atlas_id); gts.append(gt)
+        kps.append(lire_fichier_key(key_path))
+        if verbose: print(f"\r  [{i+1}/{len(atlas_keys)}] {atlas_id}", end="", flush=True)
+    if verbose: print("")
+
+    forme_gt = forme_gt or (0, 3)
+    a_gt = np.array([g is not None for g in gts])
+    gt_stack = np.full((len(ids),) + tuple(forme_gt), np.nan)
+    for i, g in enumerate(gts):
+        if g is not None: gt_stack[i] = g
+
+    n_desc = max((kp.descripteurs.shape[1] for kp in kps if len(kp.coords)), default=0)
+    offsets = np.zeros(len(kps) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(kp.coords) for kp in kps])
+    tableaux = {
+        "gt": gt_stack,
+        "a_gt": a_gt,
+        "offsets": offsets,
+        "coords": np.concatenate([kp.coords for kp in kps]).astype(np.float32),
+        "echelles": np.concatenate([kp.echelles for kp in kps]).astype(np.float32),
+        "descripteurs": np.concatenate([kp.descripteurs.reshape(len(kp.coords), n_desc) for kp in kps]).astype(np.float32),
+    }
+    if codebook_size:
+        codebook, idf, sigs = signatures_atlas([kp.descripteurs for kp in kps], taille=codebook_size)
+        tableaux.update({"codebook": codebook, "idf": idf, "signatures": sigs})
+
+    meta = {
+        "ids": ids,
+        "raw_ids": raw_ids,
+        "key_paths": [os.path.abspath(p) for p in atlas_keys],
+        "atlas_dir": os.path.abspath(atlas_dir),
+    }
+    ecrire_conteneur(output_path, tableaux, meta)
+    return len(ids)
+
+class AtlasBank:
+    """Vue en lecture seule (memory-mappée) d'une banque d'atlas."""
+
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        self._tableaux, meta = lire_conteneur(self.path, mmap=True)
+        self.ids = meta["ids"]
+        self.raw_ids = meta["raw_ids"]
+        self.key_paths = meta["key_paths"]
+        self.atlas_dir = meta.get("atlas_dir")
+        self.gt = self._tableaux["gt"]
+        self.a_gt = self._tableaux["a_gt"]
+        # (codebook, idf, signatures) si la banque a été construite avec un codebook
+        self.prescreening = None
+        if "codebook" in self._tableaux:
+            self.prescreening = (self._tableaux["codebook"], self._tableaux["idf"], self._tableaux["signatures"])
+
+    def __len__(self):
+        return len(self.ids)
+
+    def gt_atlas(self, i):
+        """GT (N_landmarks, 3) de l'atlas i, ou None."""
+        return np.array(self.gt[i]) if self.a_gt[i] else None
+
+    def keypoints(self, i):
+        """Keypoints de l'atlas i (vues sur le memmap, sans copie)."""
+        debut, fin = self._tableaux["offsets"][i], self._tableaux["offsets"][i + 1]
+        return Keypoints(self._tableaux["coords"][debut:fin],
+                         self._tableaux["echelles"][debut:fin],
+                         self._tableaux["descripteurs"][debut:fin])
+
+@functools.lru_cache(maxsize=2)
+def charger_atlas_bank(path):
+    """Une seule ouverture par processus (y compris dans les workers)."""
+    return AtlasBank(path)
@@ -0,0 +1,162 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+import numpy as np
+
+from recalage.ransac import MAX_TRIALS, STOP_PROBABILITY, balayer_seuils, calculer_affine_ransac, estimer_affine_ransac
+
+"""
+Cache persistant des transformations RANSAC, adressé par le contenu.
+
+Clé = hash (blake2b) des correspondances (pts_src, pts_dst) et des paramètres RANSAC
+(min_samples, threshold, moteur, max_trials, confiance, VERSION). Des matches inchangés
+avec les mêmes paramètres donnent donc la même clé, quel que soit le script ou le fichier
+d'origine. Valeur = matrice 3x4 (ou échec), nombre d'inliers et, en option, masque des inliers.
+
+Stockage SQLite (WAL : plusieurs processus peuvent lire et écrire), borné en taille par
+éviction LRU (date du dernier accès). Une lecture n'écrit rien : les dates d'accès sont gardées
+en mémoire et écrites par lots (toutes les PERIODE_ACCES lectures, avant une éviction, à la fermeture),
+pour que les lectures concurrentes ne se sérialisent pas sur le verrou d'écriture. Le RANSAC étant déterministe (graine fixe), un résultat
+relu est identique bit à bit à un résultat recalculé.
+"""
+
+VERSION = 1 # à incrémenter si le RANSAC change de résultat à paramètres égaux
+TAILLE_MAX_MO = 256
+PERIODE_EVICTION = 64 # insertions entre deux contrôles de taille
+PERIODE_ACCES = 256 # lectures entre deux écritures des dates d'accès
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS transformations (
+    cle       TEXT PRIMARY KEY,
+    mat       BLOB,
+    n_inliers INTEGER NOT NULL,
+    masque    BLOB,
+    n_points  INTEGER,
+    taille    INTEGER NOT NULL,
+    acces     REAL NOT NULL
+)
+"""
+
+def cle_transformation(pts_src, pts_dst, min_samples, threshold, backend):
+    h = hashlib.blake2b(digest_size=20)
+    for pts in (pts_src, pts_dst):
+        a = np.ascontiguousarray(pts, dtype=np.float64)
+        h.update(str(a.shape).encode())
+        h.update(a.tobytes())
+    h.update(f"{min_samples}|{float(threshold)!r}|{backend}|{MAX_TRIALS}|{STOP_PROBABILITY}|v{VERSION}".encode())
+    return h.hexdigest()
+
+class CacheTransformations:
+    def __init__(self, path, taille_max_mo=TAILLE_MAX_MO, masques=False):
+        self.path = path
+        self.taille_max = int(taille_max_mo * 1024 * 1024)
+        self.masques = masques
+        self._insertions = 0
+        self._acces = {} # cle -> date du dernier accès, pas encore écrite
+        self.conn = sqlite3.connect(path, timeout=60)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(SCHEMA)
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_acces ON transformations (acces)")
+        self.conn.commit()
+
+    def obtenir(self, cle):
+        """(matrice 3x4 ou None, n_inliers, masque ou None), ou None si la clé est absente."""
+        ligne = self.conn.execute("SELECT mat, n_inliers, masque, n_points FROM transformations WHERE cle = ?",
+                                  (cle,)).fetchone()
+        if ligne is None: return None
+        self._acces[cle] = time.time()
+        if len(self._acces) >= PERIODE_ACCES: self.ecrire_acces()
+        mat_blob, n_inliers, masque_blob, n_points = ligne
+        mat = np.frombuffer(mat_blob, dtype=np.float64).reshape(3, 4).copy() if mat_blob is not None else None
+        masque = None
+        if masque_blob is not None:
+            masque = np.unpackbits(np.frombuffer(masque_blob, dtype=np.uint8), count=n_points).astype(bool)
+        return mat, n_inliers, masque
+
+    def ecrire_acces(self):
+        """Écrit en une transaction les dates d'accès accumulées par les lectures."""
+        if not self._acces: return
+        with self.conn:
+            self.conn.executemany("UPDATE transformations SET acces = MAX(acces, ?) WHERE cle = ?",
+                                  [(t, cle) for cle, t in self._acces.items()])
+        self._acces.clear()
+
+    def enregistrer(self, cle, mat, n_inliers, masque=None):
+        mat_blob = np.ascontiguousarray(mat, dtype=np.float64).tobytes() if mat is not None else None
+        masque_blob, n_points = None, None
+        if self.masques and masque is not None:
+            masque_blob, n_points = np.packbits(np.asarray(masque, dtype=bool)).tobytes(), len(masque)
+        taille = len(cle) + len(mat_blob or b"") + len(masque_blob or b"") + 64
+        with self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO transformations VALUES (?, ?, ?, ?, ?, ?, ?)",
+                              (cle, mat_blob, int(n_inliers), masque_blob, n_points, taille, time.time()))
+        self._insertions += 1
+        if self._insertions % PERIODE_EVICTION == 0: self.evincer()
+
+    def evincer(self):
+        """Supprime les entrées les moins récemment utilisées jusqu'à repasser sous la taille maximale."""
+        self.ecrire_acces()
+        total = self.conn.execute("SELECT COALESCE(SUM(taille), 0) FROM transformations").fetchone()[0]
+        if total <= self.taille_max: return 0
+        a_liberer, cles = total - self.taille_max, []
+        for cle, taille in self.conn.execute("SELECT cle, taille FROM transformations ORDER BY acces"):
+            cles.append((cle,))
+            a_liberer -= taille
+            if a_liberer <= 0: break
+        with self.conn:
+            self.conn.executemany("DELETE FROM transformations WHERE cle = ?", cles)
+        return len(cles)
+
+    def fermer(self):
+        self.evincer()
+        self.conn.close()
+
+# Une connexion par (processus, thread) : une connexion SQLite ne survit ni à un fork ni à un changement de thread
+_caches = {}
+
+def ouvrir_cache(path, taille_max_mo=TAILLE_MAX_MO, masques=False):
+    """Cache partagé du processus/thread courant ; None si path est vide (cache désactivé)."""
+    if not path: return None
+    cle = (os.getpid(), threading.get_ident(), path)
+    if cle not in _caches:
+        _caches[cle] = CacheTransformations(path, taille_max_mo, masques)
+    return _caches[cle]
+
+def fermer_caches():
+    for cle in [c for c in _caches if c[0] == os.getpid()]:
+        try: _caches.pop(cle).fermer()
+        except sqlite3.ProgrammingError: pass # connexion d'un autre thread, déjà terminé
+
+def affine_en_cache(cache, pts_src, pts_dst, min_samples=5, threshold=15.0, backend="numpy"):
+    """Comme calculer_affine_ransac, en consultant puis alimentant le cache (s'il est fourni)."""
+    if cache is None: return calculer_affine_ransac(pts_src, pts_dst, min_samples, threshold, backend)
+    cle = cle_transformation(pts_src, pts_dst, min_samples, threshold, backend)
+    trouve = cache.obtenir(cle)
+    if trouve is not None: return trouve[0], trouve[1]
+
+    masque = None
+    if cache.masques and backend == "numpy" and min(len(pts_src), len(pts_dst)) >= min_samples:
+        try:
+            mat, n_inliers, masque = estimer_affine_ransac(pts_src, pts_dst, min_samples=min_samples, threshold=threshold)
+        except (ValueError, np.linalg.LinAlgError):
+            mat, n_inliers = None, 0
+    else:
+        mat, n_inliers = calculer_affine_ransac(pts_src, pts_dst, min_samples, threshold, backend)
+    cache.enregistrer(cle, mat, n_inliers, masque)
+    return mat, n_inliers
+
+def balayer_en_cache(cache, pts_src, pts_dst, min_samples, thresholds):
+    """Comme balayer_seuils : si tous les seuils sont en cache, aucun RANSAC n'est lancé."""
+    if cache is None: return balayer_seuils(pts_src, pts_dst, min_samples, thresholds)
+    cles = {t: cle_transformation(pts_src, pts_dst, min_samples, t, "numpy") for t in thresholds}
+    trouves = {t: cache.obtenir(c) for t, c in cles.items()}
+    if all(v is not None for v in trouves.values()): return trouves
+
+    resultats = balayer_seuils(pts_src, pts_dst, min_samples, thresholds)
+    for t, (mat, n_inliers, masque) in resultats.items():
+        if trouves[t] is None: cache.enregistrer(cles[t], mat, n_inliers, masque)
+    return resultats
@@ -0,0 +1,73 @@
+import json
+import os
+
+import numpy as np
+
+"""
+Conteneur binaire simple pour plusieurs tableaux NumPy dans un seul fichier,
+relisible par memory-mapping (aucune copie, aucun parsing au chargement).
+
+Disposition :
+    MAGIC (8 octets) | taille_entete (uint64 LE) | entête JSON | tableaux alignés sur ALIGNEMENT
+L'entête décrit chaque tableau (dtype, shape, offset) et porte des métadonnées libres.
+"""
+
+MAGIC = b"RCLGBIN1"
+ALIGNEMENT = 64
+
+def _aligner(n):
+    return (n + ALIGNEMENT - 1) // ALIGNEMENT * ALIGNEMENT
+
+def ecrire_conteneur(path, tableaux, meta=None):
+    """Écrit {nom: ndarray} + meta (JSON-sérialisable) de façon atomique."""
+    tableaux = {nom: np.ascontiguousarray(t) for nom, t in tableaux.items()}
+
+    # Les offsets dépendent de la taille de l'entête : on la fixe en deux passes
+    def construire_entete(base):
+        description, position = {}, base
+        for nom, t in tableaux.items():
+            position = _aligner(position)
+            description[nom] = {"dtype": t.dtype.str, "shape": list(t.shape), "offset": position}
+            position += t.nbytes
+        return json.dumps({"meta": meta or {}, "tableaux": description}).encode("utf-8")
+
+    # Marge pour les chiffres supplémentaires des offsets définitifs
+    entete = construire_entete(0)
+    base = _aligner(len(MAGIC) + 8 + len(entete) + 24 * (len(tableaux) + 1))
+    entete = construire_entete(base)
+    assert len(entete) <= base - len(MAGIC) - 8
+    entete = entete.ljust(base - len(MAGIC) - 8, b" ")
+
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, 'wb') as f:
+        f.write(MAGIC)
+        f.write(np.uint64(len(entete)).tobytes())
+        f.write(entete)
+        for nom, t in tableaux.items():
+            f.seek(_aligner(f.tell()))
+            f.write(t.tobytes())
+    os.replace(tmp, path)
+
+def lire_entete(path):
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"Fichier non reconnu (magic invalide) : {path}")
+        taille = int(np.frombuffer(f.read(8), dtype=np.uint64)[0])
+        return json.loads(f.read(taille).decode("utf-8"))
+
+def lire_conteneur(path, mmap=True):
+    """Retourne ({nom: tableau}, meta). Les tableaux sont des memmap en lecture seule si mmap=True."""
+    entete = lire_entete(path)
+    tableaux = {}
+    for nom, d in entete["tableaux"].items():
+        shape = tuple(d["shape"])
+        dtype = np.dtype(d["dtype"])
+        if int(np.prod(shape)) == 0:
+            tableaux[nom] = np.zeros(shape, dtype=dtype)
+        elif mmap:
+            tableaux[nom] = np.memmap(path, dtype=dtype, mode='r', offset=d["offset"], shape=shape)
+        else:
+            with open(path, 'rb') as f:
+                f.seek(d["offset"])
+                tableaux[nom] = np.fromfile(f, dtype=dtype, count=int(np.prod(shape))).reshape(shape)
+    return tableaux, entete["meta"]
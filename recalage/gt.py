@@ -0,0 +1,72 @@
+import glob
+import os
+
+import numpy as np
+
+"""
+Identifiants de sujets, lecture/écriture des vérités terrain (AFIDs .fcsv)
+et recherche des fichiers d'un sujet (avec ou sans préfixe sub-).
+"""
+
+SUFFIXE_GT_ATLAS = "_space-T1w_desc-groundtruth_afids"
+
+def identifiant_sujet(key_path):
+    """sub-0086_T1w.key -> 'sub-0086' ; 0086.key -> '0086' (identifiant d'un patient / d'une cible)."""
+    filename = os.path.basename(key_path)
+    if filename.startswith("sub-"): return filename.split('_')[0]
+    return filename.split('_')[0].split('.')[0]
+
+def identifiants_atlas(key_path):
+    """sub-0086_T1w.key -> ('sub-0086', 'sub-0086') ; 0086_T1w.key -> ('0086', 'sub-0086')."""
+    atlas_filename = os.path.basename(key_path)
+    raw_atlas_id = atlas_filename.split('_')[0].replace(".key", "")
+    atlas_id = f"sub-{raw_atlas_id}" if not raw_atlas_id.startswith("sub-") else raw_atlas_id
+    return raw_atlas_id, atlas_id
+
+def meme_sujet(id_a, id_b):
+    """Anti auto-match : compare deux identifiants sans le préfixe sub-."""
+    return id_a.replace("sub-", "") == id_b.replace("sub-", "")
+
+def _variantes(nom_sujet):
+    """Le nom tel quel, puis avec/sans préfixe sub-."""
+    return [nom_sujet, nom_sujet.replace("sub-", "") if nom_sujet.startswith("sub-") else f"sub-{nom_sujet}"]
+
+def lire_fcsv(path):
+    """Coordonnées (N, 3) d'un fichier .fcsv (ou .csv au même format)."""
+    return np.loadtxt(path, delimiter=',', comments='#', usecols=(1, 2, 3))
+
+def formater_fcsv(points):
+    lignes = ["# Markups fiducial file version = 4.13\n",
+              "# CoordinateSystem = LPS\n",
+              "# columns = id,x,y,z,ow,ox,oy,oz,vis,sel,lock,label,desc,associatedNodeID\n"]
+    for i, p in enumerate(points):
+        label = i + 1
+        lignes.append(f"vtkMRMLMarkupsFiducialNode_{i},{p[0]:.4f},{p[1]:.4f},{p[2]:.4f},0,0,0,1,1,1,0,{label},,\n")
+    return "".join(lignes)
+
+def save_fcsv(output_path, points):
+    """Écriture atomique : un lecteur ne voit jamais de .fcsv partiel."""
+    tmp = f"{output_path}.tmp.{os.getpid()}"
+    with open(tmp, 'w') as f:
+        f.write(formater_fcsv(points))
+    os.replace(tmp, output_path)
+
+def trouver_gt(dossier, nom_sujet):
+    """GT d'un sujet : <nom>_space-T1w_desc-groundtruth_afids.fcsv, puis .csv, puis <nom>.fcsv ; None si absente."""
+    nom_clean = nom_sujet.replace("_T1w", "").replace(".nii", "").replace(".gz", "")
+    for n in _variantes(nom_clean):
+        for path in (os.path.join(dossier, f"{n}{SUFFIXE_GT_ATLAS}.fcsv"),
+                     os.path.join(dossier, f"{n}{SUFFIXE_GT_ATLAS}.csv"),
+                     os.path.join(dossier, f"{n}.fcsv")):
+            if os.path.exists(path): return lire_fcsv(path)
+    return None
+
+def load_gt_atlas(atlas_dir, atlas_id):
+    return trouver_gt(atlas_dir, atlas_id)
+
+def trouver_key(dossier, nom_sujet):
+    """Fichier .key d'un sujet (avec ou sans préfixe sub-), ou None."""
+    for n in _variantes(nom_sujet.replace("_T1w", "")):
+        trouves = sorted(glob.glob(os.path.join(dossier, f"{n}_*.key")) + glob.glob(os.path.join(dossier, f"{n}.key")))
+        if trouves: return trouves[0]
+    return None
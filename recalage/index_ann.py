@@ -0,0 +1,319 @@
+import functools
+import glob
+import os
+
+import numpy as np
+
+from recalage.atlas_bank import AtlasBank
+from recalage.conteneur import ecrire_conteneur, lire_conteneur
+from recalage.gt import identifiants_atlas
+from recalage.keys import lire_fichier_key
+
+"""
+Index approché (IVF-PQ) des descripteurs SIFT de tous les atlas.
+
+Au lieu d'apparier le patient à chaque atlas séparément (coût linéaire en nombre d'atlas),
+une seule recherche par patient dans un index commun :
+  - IVF : k-means grossier (n_listes centres), chaque descripteur rangé dans la liste de son centre ;
+    une requête ne visite que les nprobe listes les plus proches ;
+  - PQ : le résidu (descripteur - centre) est découpé en n_sous_espaces blocs, chacun codé sur un octet
+    (k-means à 256 centres par bloc) ; la distance approchée se lit dans une table par requête (ADC) ;
+  - pour chaque (requête, atlas), les n_candidats meilleures entrées sont re-classées par distance exacte
+    (vecteurs float16 gardés dans l'index), puis soumises au test du ratio de l'atlas
+    (mêmes conventions que matching.apparier_descripteurs).
+
+Les k-means viennent de scikit-learn (importé à la construction seulement) ; la recherche est en NumPy.
+"""
+
+EXTENSION_INDEX = ".ivfpq"
+VERSION = 1
+N_SOUS_ESPACES = 8
+N_CODES = 256
+N_ECHANTILLON = 100000
+NPROBE_DEFAUT = 4
+N_CANDIDATS_DEFAUT = 4
+TAILLE_BLOC = 1024
+TAILLE_TAMPON = 1 << 23
+
+def chemin_index_defaut(atlas_dir=None, atlas_bank=None):
+    """L'index est rangé à côté du dossier d'atlas (<atlas_dir>.ivfpq) ou de la banque (<banque>.ivfpq)."""
+    base = atlas_bank if atlas_bank else os.path.normpath(atlas_dir)
+    return base + EXTENSION_INDEX
+
+def empreinte_sources(sources):
+    """(taille, mtime) des fichiers indexés (.key ou banque) : un index dont les atlas ont changé est reconstruit."""
+    empreinte = []
+    for p in sources:
+        try:
+            st = os.stat(p)
+            empreinte.append([st.st_size, int(st.st_mtime)])
+        except OSError:
+            empreinte.append([-1, -1])
+    return empreinte
+
+def _kmeans(donnees, n_clusters, random_state):
+    from sklearn.cluster import MiniBatchKMeans
+
+    n_clusters = max(1, min(n_clusters, len(donnees)))
+    kmeans = MiniBatchKMeans(n_clusters=n_clusters, random_state=random_state, n_init=3,
+                             batch_size=max(1024, 4 * n_clusters))
+    kmeans.fit(donnees)
+    return kmeans.cluster_centers_.astype(np.float32)
+
+def _plus_proche(donnees, centres):
+    """Indice du centre le plus proche de chaque ligne, par blocs."""
+    norme_centres = np.einsum('ij,ij->i', centres, centres)
+    sortie = np.empty(len(donnees), dtype=np.int64)
+    for debut in range(0, len(donnees), TAILLE_BLOC * 4):
+        bloc = donnees[debut:debut + TAILLE_BLOC * 4]
+        sortie[debut:debut + len(bloc)] = np.argmin(norme_centres[None, :] - 2.0 * (bloc @ centres.T), axis=1)
+    return sortie
+
+def construire_index(liste_keypoints, n_listes=None, n_sous_espaces=N_SOUS_ESPACES,
+                     n_echantillon=N_ECHANTILLON, garder_vecteurs=True, random_state=42):
+    """
+    Construit l'index à partir des Keypoints de chaque atlas (liste, dans l'ordre des atlas) ;
+    les coordonnées sont gardées pour que les appariements se passent des .key.
+    n_listes par défaut : ~4 sqrt(N). Retourne le dict de tableaux à persister (ecrire_index).
+    """
+    liste_descripteurs = [kp.descripteurs for kp in liste_keypoints]
+    tailles = [len(d) for d in liste_descripteurs]
+    D = max((np.asarray(d).shape[1] for d in liste_descripteurs if len(d)), default=0)
+    if D == 0: raise ValueError("Aucun descripteur à indexer")
+    if D % n_sous_espaces: raise ValueError(f"n_sous_espaces ({n_sous_espaces}) doit diviser la dimension ({D})")
+    tous = np.concatenate([np.asarray(d, dtype=np.float32).reshape(len(d), D) for d in liste_descripteurs])
+    n = len(tous)
+    if n_listes is None: n_listes = int(4 * np.sqrt(n))
+
+    rng = np.random.default_rng(random_state)
+    echantillon = tous[rng.choice(n, n_echantillon, replace=False)] if n > n_echantillon else tous
+
+    # IVF : centres grossiers et affectation de tous les descripteurs
+    centroides = _kmeans(echantillon, n_listes, random_state)
+    listes = _plus_proche(tous, centroides)
+
+    # PQ sur les résidus, un codebook par sous-espace
+    d_sous = D // n_sous_espaces
+    residus_ech = echantillon - centroides[_plus_proche(echantillon, centroides)]
+    codebooks = np.zeros((n_sous_espaces, N_CODES, d_sous), dtype=np.float32)
+    codes = np.empty((n, n_sous_espaces), dtype=np.uint8)
+    residus = tous - centroides[listes]
+    for m in range(n_sous_espaces):
+        sous = slice(m * d_sous, (m + 1) * d_sous)
+        cb = _kmeans(residus_ech[:, sous], N_CODES, random_state + m)
+        codebooks[m, :len(cb)] = cb
+        # Moins de 256 centres (petits jeux) : codes restants = doublons du premier, jamais choisis
+        codebooks[m, len(cb):] = cb[0]
+        codes[:, m] = _plus_proche(residus[:, sous], cb)
+
+    # Entrées rangées par liste (stable : ordre des atlas conservé dans chaque liste)
+    ordre = np.argsort(listes, kind="stable")
+    listes_offsets = np.zeros(len(centroides) + 1, dtype=np.int64)
+    listes_offsets[1:] = np.cumsum(np.bincount(listes, minlength=len(centroides)))
+    atlas_offsets = np.zeros(len(tailles) + 1, dtype=np.int64)
+    atlas_offsets[1:] = np.cumsum(tailles)
+
+    tableaux = {
+        "centroides": centroides,
+        "codebooks": codebooks,
+        "codes": np.ascontiguousarray(codes[ordre]),
+        "lignes": ordre.astype(np.int64),
+        "listes_offsets": listes_offsets,
+        "atlas_offsets": atlas_offsets,
+        "coords": np.concatenate([np.asarray(kp.coords, dtype=np.float32).reshape(-1, 3) for kp in liste_keypoints]),
+    }
+    if garder_vecteurs: tableaux["vecteurs"] = tous.astype(np.float16)
+    return tableaux
+
+def ecrire_index(path, tableaux, ids, sources, parametres=None):
+    meta = {
+        "version": VERSION,
+        "ids": list(ids),
+        "sources": [os.path.abspath(p) for p in sources],
+        "empreinte": empreinte_sources(sources),
+        "parametres": parametres or {},
+    }
+    ecrire_conteneur(path, tableaux, meta)
+
+def sources_atlas(atlas_dir=None, atlas_bank=None):
+    """Fichiers dont dépend l'index : les .key du dossier d'atlas, ou la banque elle-même."""
+    if atlas_bank: return [os.path.abspath(atlas_bank)]
+    return sorted(glob.glob(os.path.join(atlas_dir, "*.key")))
+
+def build_ann_index(output_path, atlas_dir=None, atlas_bank=None, n_listes=None, n_sous_espaces=N_SOUS_ESPACES,
+                    n_echantillon=N_ECHANTILLON, garder_vecteurs=True, verbose=True):
+    """Construit l'index des atlas d'un dossier (.key) ou d'une banque, dans l'ordre de predict_landmarks. Retourne le nombre d'atlas."""
+    if atlas_bank:
+        bank = AtlasBank(atlas_bank)
+        ids = list(bank.ids)
+        keypoints = [bank.keypoints(i) for i in range(len(bank))]
+    else:
+        key_paths = sources_atlas(atlas_dir)
+        if not key_paths: raise ValueError(f"Aucun fichier .key dans {atlas_dir}")
+        ids, keypoints = [], []
+        for i, key_path in enumerate(key_paths):
+            ids.append(identifiants_atlas(key_path)[1])
+            keypoints.append(lire_fichier_key(key_path))
+            if verbose: print(f"\r  [{i+1}/{len(key_paths)}] {ids[-1]}", end="", flush=True)
+        if verbose: print("")
+
+    tableaux = construire_index(keypoints, n_listes=n_listes, n_sous_espaces=n_sous_espaces,
+                                n_echantillon=n_echantillon, garder_vecteurs=garder_vecteurs)
+    parametres = {"n_listes": len(tableaux["centroides"]), "n_sous_espaces": n_sous_espaces}
+    ecrire_index(output_path, tableaux, ids, sources_atlas(atlas_dir, atlas_bank), parametres)
+    return len(ids)
+
+class IndexANN:
+    """Vue en lecture seule (memory-mappée) d'un index IVF-PQ."""
+
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        self._t, meta = lire_conteneur(self.path, mmap=True)
+        if meta.get("version") != VERSION: raise ValueError(f"Version d'index non supportée : {self.path}")
+        self.ids = meta["ids"]
+        self.sources = meta["sources"]
+        self.empreinte = meta["empreinte"]
+        self.parametres = meta.get("parametres", {})
+        self.position = {atlas_id: i for i, atlas_id in enumerate(self.ids)}
+        self.centroides = np.asarray(self._t["centroides"])
+        self.codebooks = np.asarray(self._t["codebooks"])
+        self.listes_offsets = np.asarray(self._t["listes_offsets"])
+        self.atlas_offsets = np.asarray(self._t["atlas_offsets"])
+        self.vecteurs = self._t.get("vecteurs")
+        # Atlas de chaque entrée (ordre des listes)
+        self._atlas_entree = (np.searchsorted(self.atlas_offsets, self._t["lignes"], side="right") - 1).astype(np.int32)
+        self._norme_codebooks = np.einsum('mkd,mkd->mk', self.codebooks, self.codebooks)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def coords_atlas(self, i):
+        """Coordonnées (N, 3) des keypoints de l'atlas i (vue sur le memmap)."""
+        return self._t["coords"][self.atlas_offsets[i]:self.atlas_offsets[i + 1]]
+
+    def a_jour(self, sources):
+        """Vrai si l'index couvre exactement ces fichiers, inchangés depuis sa construction."""
+        return [os.path.abspath(p) for p in sources] == self.sources and empreinte_sources(sources) == self.empreinte
+
+    def _tables_adc(self, residus):
+        """Distances² résidu/codes : (nq, M, 256)."""
+        M, _, d_sous = self.codebooks.shape
+        r = residus.reshape(len(residus), M, d_sous)
+        produits = np.einsum('qmd,mkd->qmk', r, self.codebooks)
+        return np.einsum('qmd,qmd->qm', r, r)[:, :, None] - 2.0 * produits + self._norme_codebooks[None]
+
+    def candidats(self, requetes, nprobe=NPROBE_DEFAUT, exclus=(), n_par_groupe=None):
+        """
+        Entrées des nprobe listes les plus proches de chaque requête, avec leur distance² approchée (ADC).
+        exclus : indices d'atlas ignorés (auto-match).
+        n_par_groupe : ne garde que les n meilleures entrées de chaque (requête, atlas), réduites dès que le tampon
+        dépasse TAILLE_TAMPON triplets (la mémoire reste bornée quel que soit nprobe) ; None = toutes.
+        Retourne (indices_requete, entrées (ordre des listes), distances²), à plat.
+        """
+        requetes = np.asarray(requetes, dtype=np.float32)
+        nq = len(requetes)
+        vide = (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32))
+        if nq == 0: return vide
+
+        nprobe = min(nprobe, len(self.centroides))
+        sondes = np.argpartition(_distances_carrees(requetes, self.centroides), nprobe - 1, axis=1)[:, :nprobe]
+        garder = ~np.isin(self._atlas_entree, list(exclus)) if len(exclus) else None
+        M = self.codebooks.shape[0]
+        decalage = (np.arange(M) * N_CODES)[None, :]
+
+        # Parcours par liste : toutes les requêtes qui sondent la liste l sont traitées ensemble
+        q_idx = np.repeat(np.arange(nq), nprobe)
+        l_idx = sondes.ravel()
+        ordre = np.argsort(l_idx, kind="stable")
+        q_idx, l_idx = q_idx[ordre], l_idx[ordre]
+        coupures = np.flatnonzero(np.diff(l_idx)) + 1
+        morceaux, taille = [], 0
+        for qs, ls in zip(np.split(q_idx, coupures), np.split(l_idx, coupures)):
+            l = ls[0]
+            debut, fin = self.listes_offsets[l], self.listes_offsets[l + 1]
+            entrees = np.arange(debut, fin)
+            if garder is not None: entrees = entrees[garder[debut:fin]]
+            if len(entrees) == 0: continue
+            # Indices à plat dans la table (M*256) : d[q, e] = somme_m tables[q, m, codes[e, m]]
+            codes = np.asarray(self._t["codes"][entrees], dtype=np.int64) + decalage
+            for b in range(0, len(qs), TAILLE_BLOC):
+                qb = qs[b:b + TAILLE_BLOC]
+                tables = self._tables_adc(requetes[qb] - self.centroides[l]).reshape(len(qb), -1)
+                d = tables[:, codes].sum(axis=2, dtype=np.float32)
+                morceaux.append((np.repeat(qb, len(entrees)), np.tile(entrees, len(qb)), d.ravel()))
+                taille += d.size
+                if n_par_groupe is not None and taille > TAILLE_TAMPON:
+                    morceaux = [self._reduire(*(np.concatenate(c) for c in zip(*morceaux)), n_par_groupe)]
+                    taille = len(morceaux[0][0])
+        if not morceaux: return vide
+        q, e, d = (np.concatenate(c) for c in zip(*morceaux))
+        # Un groupe (requête, atlas) peut s'étendre sur plusieurs listes et réductions : réduction finale
+        return self._reduire(q, e, d, n_par_groupe) if n_par_groupe is not None else (q, e, d)
+
+    def _reduire(self, q, e, d, n):
+        q, _, d, e = _premiers_par_groupe(q, self._atlas_entree[e], d, e, n)
+        return q, e, d
+
+    def _distances_exactes(self, requetes, q, lignes):
+        d = np.empty(len(q), dtype=np.float32)
+        for debut in range(0, len(q), TAILLE_BLOC * 16):
+            sel = slice(debut, debut + TAILLE_BLOC * 16)
+            diff = np.asarray(self.vecteurs[lignes[sel]], dtype=np.float32) - requetes[q[sel]]
+            d[sel] = np.einsum('ij,ij->i', diff, diff)
+        return d
+
+    def apparier(self, requetes, ratio, nprobe=NPROBE_DEFAUT, n_candidats=N_CANDIDATS_DEFAUT, exclus=(), rerank=True):
+        """
+        Appariement patient -> tous les atlas en une recherche.
+        Pour chaque (requête, atlas), les n_candidats meilleures entrées (ADC) sont re-classées par distance exacte
+        (si l'index garde les vecteurs et rerank), puis le test du ratio d1 < ratio² d2 est appliqué avec les deux
+        premières. Une entrée seule de son atlas dans les listes visitées n'a pas de second voisin pour le test :
+        elle est rejetée (c'est là que la sonde a vu trop peu de l'atlas).
+        Retourne {indice d'atlas: (indices_requete, indices_atlas)} (indices locaux à l'atlas).
+        """
+        requetes = np.asarray(requetes, dtype=np.float32)
+        q, e, d = self.candidats(requetes, nprobe=nprobe, exclus=exclus, n_par_groupe=max(n_candidats, 2))
+        if len(q) == 0: return {}
+        a = self._atlas_entree[e]
+        lignes = np.asarray(self._t["lignes"])[e]
+
+        q, a, d, lignes = _premiers_par_groupe(q, a, d, lignes, max(n_candidats, 2))
+        if rerank and self.vecteurs is not None:
+            d = self._distances_exactes(requetes, q, lignes)
+            q, a, d, lignes = _premiers_par_groupe(q, a, d, lignes, 2)
+
+        premier = np.ones(len(q), dtype=bool)
+        premier[1:] = (q[1:] != q[:-1]) | (a[1:] != a[:-1])
+        i1 = np.flatnonzero(premier)
+        a_second = np.zeros(len(q), dtype=bool)
+        a_second[:-1] = ~premier[1:]
+        d2 = d[np.minimum(i1 + 1, len(d) - 1)]
+        i1 = i1[a_second[i1] & (d[i1] < (ratio ** 2) * d2)]
+
+        resultat = {}
+        q_g, a_g, l_g = q[i1], a[i1], lignes[i1]
+        for idx_atlas in np.unique(a_g):
+            sel = a_g == idx_atlas
+            resultat[int(idx_atlas)] = (q_g[sel], l_g[sel] - self.atlas_offsets[idx_atlas])
+        return resultat
+
+def _premiers_par_groupe(q, a, d, lignes, n):
+    """Les n plus petites distances de chaque groupe (requête, atlas), triées par groupe puis distance."""
+    ordre = np.lexsort((d, a, q))
+    q, a, d, lignes = q[ordre], a[ordre], d[ordre], lignes[ordre]
+    nouveau = np.ones(len(q), dtype=bool)
+    nouveau[1:] = (q[1:] != q[:-1]) | (a[1:] != a[:-1])
+    debuts = np.flatnonzero(nouveau)
+    rang = np.arange(len(q)) - np.repeat(debuts, np.diff(np.append(debuts, len(q))))
+    garde = rang < n
+    return q[garde], a[garde], d[garde], lignes[garde]
+
+def _distances_carrees(a, b):
+    d2 = np.einsum('ij,ij->i', b, b)[None, :] - 2.0 * (a @ b.T)
+    d2 += np.einsum('ij,ij->i', a, a)[:, None]
+    return np.maximum(d2, 0, out=d2)
+
+@functools.lru_cache(maxsize=2)
+def charger_index(path):
+    """Une seule ouverture par processus."""
+    return IndexANN(path)
@@ -0,0 +1,115 @@
+import functools
+import os
+from collections import namedtuple
+
+import numpy as np
+
+"""
+Lecture native des fichiers .key produits par featExtract (SIFT 3D).
+
+Format d'une ligne de feature :
+    x y z scale | o11 .. o33 (9) | e1 e2 e3 | info flag | d1 .. d64
+Les lignes d'en-tête (commentaires '#', "Features: N", ligne de description
+des colonnes) sont ignorées.
+"""
+
+COL_COORDS = slice(0, 3)
+COL_ECHELLE = 3
+COL_DESCRIPTEUR = 17
+SELECTIONS = ("scale", "grid")
+
+Keypoints = namedtuple("Keypoints", ["coords", "echelles", "descripteurs"])
+
+def _est_ligne_donnees(parts):
+    if len(parts) <= COL_DESCRIPTEUR: return False
+    try:
+        float(parts[0])
+        return True
+    except ValueError:
+        return False
+
+def lire_fichier_key(path):
+    """
+    Charge un .key en mémoire.
+    Retourne Keypoints(coords (N,3) float32, echelles (N,) float32, descripteurs (N,D) float32).
+    """
+    with open(path, 'r') as f: lines = f.read().splitlines()
+
+    # Les en-têtes sont en début de fichier : on cherche la première ligne numérique
+    debut = None
+    for i, line in enumerate(lines):
+        if line.startswith('#'): continue
+        if _est_ligne_donnees(line.split()):
+            debut = i; break
+    if debut is None:
+        vide = np.zeros((0, 3), dtype=np.float32)
+        return Keypoints(vide, np.zeros(0, dtype=np.float32), np.zeros((0, 0), dtype=np.float32))
+
+    data = np.loadtxt(lines[debut:], dtype=np.float32, comments='#', ndmin=2)
+    return Keypoints(np.ascontiguousarray(data[:, COL_COORDS]),
+                     np.ascontiguousarray(data[:, COL_ECHELLE]),
+                     np.ascontiguousarray(data[:, COL_DESCRIPTEUR:]))
+
+def compter_keypoints(path):
+    """Nombre de keypoints d'un .key, lu dans l'en-tête "Features: N" (comptage des lignes à défaut)."""
+    n = 0
+    with open(path, 'r') as f:
+        for line in f:
+            if line.startswith('#'): continue
+            if line.startswith("Features:"):
+                try: return int(line.split(':')[1])
+                except ValueError: continue
+            if _est_ligne_donnees(line.split()): n += 1
+    return n
+
+def indices_sous_echantillon(kp, max_keypoints, selection="grid"):
+    """
+    Indices (croissants) d'au plus max_keypoints keypoints :
+      - scale : les plus grandes échelles (les plus stables) ;
+      - grid  : stratification spatiale, grille d'environ max_keypoints cellules sur la boîte englobante,
+                puis tour à tour la plus grande échelle restante de chaque cellule.
+    """
+    n = len(kp.coords)
+    if max_keypoints <= 0 or n <= max_keypoints: return np.arange(n)
+    echelles = kp.echelles.astype(np.float64)
+    if selection == "scale":
+        return np.sort(np.argpartition(-echelles, max_keypoints - 1)[:max_keypoints])
+
+    coords = kp.coords.astype(np.float64)
+    etendue = np.maximum(coords.max(axis=0) - coords.min(axis=0), 1e-6)
+    cote = (np.prod(etendue) / max_keypoints) ** (1 / 3)
+    _, cellules = np.unique(np.floor((coords - coords.min(axis=0)) / cote).astype(np.int64), axis=0, return_inverse=True)
+    cellules = cellules.reshape(-1)
+    # Rang de chaque keypoint dans sa cellule (0 = plus grande échelle)
+    ordre = np.lexsort((-echelles, cellules))
+    debuts = np.searchsorted(cellules[ordre], cellules[ordre])
+    rangs = np.empty(n, dtype=np.int64)
+    rangs[ordre] = np.arange(n) - debuts
+    return np.sort(np.lexsort((-echelles, rangs))[:max_keypoints])
+
+def sous_echantillonner(kp, max_keypoints, selection="grid"):
+    """Keypoints réduits à max_keypoints (indices_sous_echantillon) ; kp inchangé si déjà assez petit."""
+    if max_keypoints <= 0 or len(kp.coords) <= max_keypoints: return kp
+    idx = indices_sous_echantillon(kp, max_keypoints, selection)
+    return Keypoints(kp.coords[idx], kp.echelles[idx], kp.descripteurs[idx])
+
+def _empreinte(path):
+    st = os.stat(path)
+    return st.st_size, st.st_mtime_ns
+
+# Cache par processus : le .key du patient n'est lu qu'une fois, quel que soit le nombre d'atlas.
+# Clé (chemin, taille, mtime) : un .key réécrit au même chemin (serveur de prédiction) est relu.
+@functools.lru_cache(maxsize=4)
+def _charger_key(path, empreinte):
+    return lire_fichier_key(path)
+
+def charger_key(path):
+    return _charger_key(path, _empreinte(path))
+
+@functools.lru_cache(maxsize=8)
+def _charger_key_reduit(path, empreinte, max_keypoints, selection):
+    return sous_echantillonner(_charger_key(path, empreinte), max_keypoints, selection)
+
+def charger_key_reduit(path, max_keypoints, selection="grid"):
+    """Keypoints du patient sous-échantillonnés, calculés une fois par processus (passes grossière et fine)."""
+    return _charger_key_reduit(path, _empreinte(path), max_keypoints, selection)
@@ -0,0 +1,103 @@
+import os
+import sqlite3
+import time
+
+"""
+Manifeste des jobs de matching (SQLite) : une ligne par paire (cible, source)
+avec son statut (pending, running, done, failed), le nombre de tentatives,
+la durée, le code retour et le dernier message d'erreur.
+
+Une paire interrompue en cours de route reste 'running' : elle est remise
+en 'pending' au redémarrage suivant, contrairement à une paire terminée.
+"""
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    target_id   TEXT NOT NULL,
+    source_id   TEXT NOT NULL,
+    path_target TEXT NOT NULL,
+    path_source TEXT NOT NULL,
+    statut      TEXT NOT NULL DEFAULT 'pending',
+    tentatives  INTEGER NOT NULL DEFAULT 0,
+    duree       REAL,
+    code_retour INTEGER,
+    erreur      TEXT,
+    maj         REAL,
+    PRIMARY KEY (target_id, source_id)
+)
+"""
+
+class Manifest:
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.execute(SCHEMA)
+        self.conn.commit()
+
+    def synchroniser(self, jobs, sorties_presentes, reprendre_echecs=False):
+        """
+        Enregistre les paires inconnues ; reprend les jobs interrompus.
+        jobs : itérable de (target_id, source_id, path_target, path_source).
+        sorties_presentes(target_id, source_id) -> bool : une paire déjà présente
+        sur disque mais absente du manifeste (ancien format) est marquée 'done'.
+        reprendre_echecs : remet à zéro les tentatives des jobs 'failed'.
+        """
+        maintenant = time.time()
+        with self.conn:
+            self.conn.execute("UPDATE jobs SET statut = 'pending' WHERE statut = 'running'")
+            if reprendre_echecs:
+                self.conn.execute("UPDATE jobs SET statut = 'pending', tentatives = 0 WHERE statut = 'failed'")
+            connus = {(t, s): statut for t, s, statut in self.conn.execute("SELECT target_id, source_id, statut FROM jobs")}
+            nouveaux = []
+            for t, s, pt, ps in jobs:
+                statut = connus.get((t, s))
+                if statut is None:
+                    nouveaux.append((t, s, pt, ps, "done" if sorties_presentes(t, s) else "pending", maintenant))
+                elif statut == "done" and not sorties_presentes(t, s):
+                    # Sorties supprimées depuis : à refaire
+                    self.conn.execute("UPDATE jobs SET statut = 'pending', tentatives = 0 WHERE target_id = ? AND source_id = ?", (t, s))
+            self.conn.executemany(
+                "INSERT INTO jobs (target_id, source_id, path_target, path_source, statut, maj) VALUES (?, ?, ?, ?, ?, ?)",
+                nouveaux)
+
+    def a_traiter(self, max_tentatives, ids=None):
+        """Jobs pending, ou failed avec moins de max_tentatives essais (restreints à ids si fourni)."""
+        lignes = self.conn.execute(
+            "SELECT target_id, source_id, path_target, path_source, tentatives FROM jobs "
+            "WHERE statut = 'pending' OR (statut = 'failed' AND tentatives < ?) ORDER BY target_id, source_id",
+            (max_tentatives,)).fetchall()
+        if ids is not None: lignes = [l for l in lignes if (l[0], l[1]) in ids]
+        return lignes
+
+    def demarrer(self, target_id, source_id):
+        with self.conn:
+            self.conn.execute("UPDATE jobs SET statut = 'running', tentatives = tentatives + 1, maj = ? "
+                              "WHERE target_id = ? AND source_id = ?", (time.time(), target_id, source_id))
+
+    def liberer(self, target_id, source_id):
+        """Annule un démarrage (paire prise par un autre worker) : retour à 'pending', tentative non comptée."""
+        with self.conn:
+            self.conn.execute("UPDATE jobs SET statut = 'pending', tentatives = MAX(tentatives - 1, 0), maj = ? "
+                              "WHERE target_id = ? AND source_id = ?", (time.time(), target_id, source_id))
+
+    def terminer(self, target_id, source_id, statut, duree=None, code_retour=None, erreur=None):
+        with self.conn:
+            self.conn.execute("UPDATE jobs SET statut = ?, duree = ?, code_retour = ?, erreur = ?, maj = ? "
+                              "WHERE target_id = ? AND source_id = ?",
+                              (statut, duree, code_retour, erreur, time.time(), target_id, source_id))
+
+    def non_terminees(self):
+        """Paires (target_id, source_id) qui ne sont pas 'done'."""
+        return set(self.conn.execute("SELECT target_id, source_id FROM jobs WHERE statut != 'done'").fetchall())
+
+    def a_refaire(self, paires):
+        """Remet des paires en 'pending' (entrées modifiées depuis leur calcul), tentatives remises à zéro."""
+        with self.conn:
+            self.conn.executemany("UPDATE jobs SET statut = 'pending', tentatives = 0, maj = ? WHERE target_id = ? AND source_id = ?",
+                                  [(time.time(), t, s) for t, s in paires])
+
+    def resume(self):
+        return dict(self.conn.execute("SELECT statut, COUNT(*) FROM jobs GROUP BY statut").fetchall())
+
+    def fermer(self):
+        self.conn.close()
@@ -0,0 +1,121 @@
+import glob
+import hashlib
+import os
+
+import numpy as np
+
+from recalage.conteneur import ecrire_conteneur, lire_conteneur, lire_entete
+
+"""
+Stockage columnaire des matches : un seul fichier par cible au lieu de deux
+fichiers texte par paire (match_<atlas>.img1.txt / .img2.txt).
+
+<cible>/matches.store (format conteneur.py, memory-mappé) :
+  - img1, img2 (N_total, 3) float32 : correspondances de tous les atlas, concaténées ;
+  - offsets (N_atlas + 1,) int64 : bloc de l'atlas i = [offsets[i], offsets[i+1]) ;
+  - meta["sources"] : identifiants des atlas, dans l'ordre des blocs.
+
+Pendant la génération, chaque job écrit un fragment <cible>/.parts/<atlas>.npz ;
+consolider() les fusionne dans le store en fin d'exécution.
+"""
+
+NOM_STORE = "matches.store"
+DOSSIER_PARTS = ".parts"
+
+def ecrire_match_store(path, paires):
+    """paires : {source_id: (img1 (n,3), img2 (n,3))}. Écriture atomique, sources triées."""
+    sources = sorted(paires)
+    tailles = [len(paires[s][0]) for s in sources]
+    offsets = np.zeros(len(sources) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(tailles)
+    vide = np.zeros((0, 3), dtype=np.float32)
+    img1 = np.concatenate([np.asarray(paires[s][0], dtype=np.float32).reshape(-1, 3) for s in sources] or [vide])
+    img2 = np.concatenate([np.asarray(paires[s][1], dtype=np.float32).reshape(-1, 3) for s in sources] or [vide])
+    ecrire_conteneur(path, {"img1": img1, "img2": img2, "offsets": offsets}, {"sources": sources})
+
+class MatchStore:
+    """Lecture memory-mappée d'un store de cible."""
+
+    def __init__(self, path):
+        self.path = path
+        self._tableaux, meta = lire_conteneur(path, mmap=True)
+        self.sources = meta["sources"]
+        self._index = {s: i for i, s in enumerate(self.sources)}
+
+    def __contains__(self, source_id):
+        return source_id in self._index
+
+    def __len__(self):
+        return len(self.sources)
+
+    def paire(self, source_id):
+        """(img1, img2) en float64 pour une source, ou None si absente."""
+        i = self._index.get(source_id)
+        if i is None: return None
+        debut, fin = self._tableaux["offsets"][i], self._tableaux["offsets"][i + 1]
+        return (np.asarray(self._tableaux["img1"][debut:fin], dtype=np.float64),
+                np.asarray(self._tableaux["img2"][debut:fin], dtype=np.float64))
+
+    def empreinte(self, source_id):
+        """Empreinte du contenu d'une source (hash des correspondances), pour détecter une paire recalculée."""
+        i = self._index[source_id]
+        debut, fin = self._tableaux["offsets"][i], self._tableaux["offsets"][i + 1]
+        h = hashlib.blake2b(digest_size=16)
+        h.update(np.ascontiguousarray(self._tableaux["img1"][debut:fin]).tobytes())
+        h.update(np.ascontiguousarray(self._tableaux["img2"][debut:fin]).tobytes())
+        return h.hexdigest()
+
+def chemin_store(dossier_cible):
+    return os.path.join(dossier_cible, NOM_STORE)
+
+def chemin_part(dossier_cible, source_id):
+    return os.path.join(dossier_cible, DOSSIER_PARTS, f"{source_id}.npz")
+
+def ecrire_part(dossier_cible, source_id, img1, img2):
+    """Fragment d'une paire, écrit de façon atomique (en attente de consolidation)."""
+    os.makedirs(os.path.join(dossier_cible, DOSSIER_PARTS), exist_ok=True)
+    path = chemin_part(dossier_cible, source_id)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, 'wb') as f:
+        np.savez(f, img1=np.asarray(img1, dtype=np.float32), img2=np.asarray(img2, dtype=np.float32))
+    os.replace(tmp, path)
+
+def sources_presentes(dossier_cible):
+    """Sources déjà disponibles pour une cible : dans le store ou en fragment."""
+    sources = set()
+    path = chemin_store(dossier_cible)
+    if os.path.exists(path):
+        sources.update(lire_entete(path)["meta"]["sources"])
+    for part in glob.glob(os.path.join(dossier_cible, DOSSIER_PARTS, "*.npz")):
+        sources.add(os.path.basename(part)[:-len(".npz")])
+    return sources
+
+def lire_paire(dossier_cible, source_id):
+    """(img1, img2) d'une source, depuis son fragment ou le store de la cible ; None si absente."""
+    part = chemin_part(dossier_cible, source_id)
+    if os.path.exists(part):
+        with np.load(part) as z: return z["img1"], z["img2"]
+    path = chemin_store(dossier_cible)
+    return MatchStore(path).paire(source_id) if os.path.exists(path) else None
+
+def consolider(dossier_cible):
+    """Fusionne le store existant et les fragments en un nouveau store. Retourne le nombre de sources."""
+    parts = sorted(glob.glob(os.path.join(dossier_cible, DOSSIER_PARTS, "*.npz")))
+    path = chemin_store(dossier_cible)
+    if not parts: return len(MatchStore(path)) if os.path.exists(path) else 0
+
+    paires = {}
+    if os.path.exists(path):
+        store = MatchStore(path)
+        paires = {s: store.paire(s) for s in store.sources}
+    for part in parts:
+        with np.load(part) as z:
+            paires[os.path.basename(part)[:-len(".npz")]] = (z["img1"], z["img2"])
+    ecrire_match_store(path, paires)
+
+    for part in parts:
+        try: os.remove(part)
+        except OSError: pass
+    try: os.rmdir(os.path.join(dossier_cible, DOSSIER_PARTS))
+    except OSError: pass
+    return len(paires)
@@ -0,0 +1,93 @@
+import os
+import zipfile
+
+import numpy as np
+
+"""
+Lecture des fichiers de correspondances (.img1.txt / .img2.txt).
+
+Le décalage de la colonne x est détecté une seule fois sur la première ligne
+exploitable, puis le bloc (x, y, z) est chargé en un seul appel vectorisé.
+Un cache binaire optionnel (sidecar .npz float32, invalidé sur taille + mtime)
+évite tout parsing texte lors des analyses suivantes.
+"""
+
+SUFFIXE_CACHE = ".cache.npz"
+
+def _detecter_offset(lines):
+    """Recherche heuristique du début des données numériques (3 flottants non nuls consécutifs)."""
+    for line in lines:
+        if line.startswith('#'): continue
+        parts = line.split()
+        for i in range(1, len(parts) - 2):
+            try:
+                if float(parts[i]) and float(parts[i+1]) and float(parts[i+2]):
+                    return i
+            except ValueError:
+                continue
+    return -1
+
+def _parser_lignes(lines, offset):
+    """Chemin lent, ligne par ligne : seulement si le chargement vectorisé échoue (lignes tronquées...)."""
+    data = []
+    for line in lines:
+        parts = line.split()
+        if len(parts) < offset + 3: continue
+        try: data.append([float(parts[offset]), float(parts[offset+1]), float(parts[offset+2])])
+        except ValueError: continue
+    return np.array(data)
+
+def parser_fichier_matches(path):
+    """Parse un fichier texte de matches. Retourne un tableau (N,3) float64 ou None."""
+    with open(path, 'r') as f: lines = [l for l in f.read().splitlines() if l and not l.startswith('#')]
+    offset = _detecter_offset(lines)
+    if offset == -1: return None
+    try:
+        return np.loadtxt(lines, usecols=(offset, offset + 1, offset + 2), ndmin=2)
+    except (ValueError, IndexError):
+        return _parser_lignes(lines, offset)
+
+def _signature(path):
+    st = os.stat(path)
+    return st.st_size, st.st_mtime_ns
+
+def _lire_cache(path_cache, signature):
+    try:
+        with np.load(path_cache) as z:
+            if (int(z["taille"]), int(z["mtime_ns"])) != signature: return None
+            return z["pts"]
+    except (OSError, KeyError, ValueError, EOFError, zipfile.BadZipFile):
+        # Sidecar tronqué ou corrompu : reconstruit à partir du fichier texte
+        return None
+
+def _ecrire_cache(path_cache, pts, signature):
+    tmp = f"{path_cache}.{os.getpid()}.tmp"
+    try:
+        with open(tmp, 'wb') as f:
+            np.savez(f, pts=pts, taille=np.int64(signature[0]), mtime_ns=np.int64(signature[1]))
+        os.replace(tmp, path_cache)
+    except OSError:
+        # Dossier en lecture seule, quota... : le cache est facultatif
+        try: os.remove(tmp)
+        except OSError: pass
+
+def charger_fichier_matches_robuste(path, cache=False):
+    """
+    Charge les coordonnées (N,3) d'un fichier de matches, None si illisible.
+    Avec cache=True, les points sont stockés/relus en float32 dans `path + SUFFIXE_CACHE` ;
+    le résultat est alors toujours la version float32 (même valeur au premier et aux suivants appels).
+    """
+    try:
+        if not cache: return parser_fichier_matches(path)
+
+        signature = _signature(path)
+        path_cache = path + SUFFIXE_CACHE
+        pts = _lire_cache(path_cache, signature)
+        if pts is None:
+            pts = parser_fichier_matches(path)
+            if pts is None: return None
+            pts = pts.astype(np.float32).reshape(-1, 3)
+            _ecrire_cache(path_cache, pts, signature)
+        return pts.astype(np.float64)
+    except (OSError, ValueError):
+        return None
@@ -0,0 +1,137 @@
+import numpy as np
+
+"""
+Appariement in-process des descripteurs SIFT 3D (remplace l'appel à featMatchMultiple).
+
+Plus proche voisin + test du ratio de Lowe, entièrement vectorisé :
+les distances sont calculées par blocs via ||a||² + ||b||² - 2 a.b.
+"""
+
+RATIO_DEFAUT = 0.8
+TAILLE_BLOC = 2048
+
+def _deux_plus_proches_brute(desc_req, desc_ref, norme_ref):
+    """Retourne (indices (N,2), distances² (N,2)) des deux plus proches voisins, par blocs."""
+    n = len(desc_req)
+    idx = np.empty((n, 2), dtype=np.int64)
+    dist = np.empty((n, 2), dtype=np.float32)
+    for debut in range(0, n, TAILLE_BLOC):
+        bloc = desc_req[debut:debut + TAILLE_BLOC]
+        d2 = norme_ref[None, :] - 2.0 * (bloc @ desc_ref.T)
+        d2 += np.einsum('ij,ij->i', bloc, bloc)[:, None]
+        np.maximum(d2, 0, out=d2)
+        top2 = np.argpartition(d2, 1, axis=1)[:, :2]
+        d_top2 = np.take_along_axis(d2, top2, axis=1)
+        ordre = np.argsort(d_top2, axis=1)
+        idx[debut:debut + len(bloc)] = np.take_along_axis(top2, ordre, axis=1)
+        dist[debut:debut + len(bloc)] = np.take_along_axis(d_top2, ordre, axis=1)
+    return idx, dist
+
+def _deux_plus_proches_kdtree(desc_req, desc_ref):
+    from sklearn.neighbors import KDTree
+    dist, idx = KDTree(desc_ref).query(desc_req, k=2)
+    return idx, (dist ** 2).astype(np.float32)
+
+def apparier_descripteurs(desc_patient, desc_atlas, ratio=RATIO_DEFAUT, algorithme="brute"):
+    """
+    Pour chaque descripteur du patient, cherche son plus proche voisin dans l'atlas
+    et ne le garde que si d1 < ratio * d2.
+    Retourne (indices_patient, indices_atlas).
+    """
+    vide = np.zeros(0, dtype=np.int64)
+    if len(desc_patient) == 0 or len(desc_atlas) < 2: return vide, vide
+
+    desc_patient = np.asarray(desc_patient, dtype=np.float32)
+    desc_atlas = np.asarray(desc_atlas, dtype=np.float32)
+
+    if algorithme == "kdtree":
+        idx, dist = _deux_plus_proches_kdtree(desc_patient, desc_atlas)
+    else:
+        norme_atlas = np.einsum('ij,ij->i', desc_atlas, desc_atlas)
+        idx, dist = _deux_plus_proches_brute(desc_patient, desc_atlas, norme_atlas)
+
+    # Test du ratio sur les distances au carré
+    garde = dist[:, 0] < (ratio ** 2) * dist[:, 1]
+    return np.nonzero(garde)[0], idx[garde, 0]
+
+def apparier_keypoints(kp_patient, kp_atlas, ratio=RATIO_DEFAUT, algorithme="brute"):
+    """
+    Appariement de deux Keypoints.
+    Retourne (pts_patient, pts_atlas) : coordonnées 3D appariées, en float64, alignées ligne à ligne
+    (mêmes conventions que .img1.txt / .img2.txt).
+    """
+    i_pat, i_atl = apparier_descripteurs(kp_patient.descripteurs, kp_atlas.descripteurs,
+                                         ratio=ratio, algorithme=algorithme)
+    return (kp_patient.coords[i_pat].astype(np.float64),
+            kp_atlas.coords[i_atl].astype(np.float64))
+
+def apparier_voisinage(kp_patient, kp_atlas, affine, rayon, ratio=RATIO_DEFAUT):
+    """
+    Appariement restreint au voisinage d'une affine grossière (atlas -> patient, 3x4) :
+    un keypoint du patient n'est comparé qu'aux keypoints de l'atlas projetés à moins de `rayon` mm.
+    Grille de cellules de côté `rayon` : chaque cellule du patient ne voit que les 27 cellules voisines.
+    Un candidat seul dans son voisinage n'a pas de second voisin : il est gardé (la contrainte spatiale tient lieu de test).
+    Retourne (pts_patient, pts_atlas) comme apparier_keypoints.
+    """
+    vide = np.zeros((0, 3))
+    if len(kp_patient.coords) == 0 or len(kp_atlas.coords) == 0: return vide, vide
+
+    pos_patient = kp_patient.coords.astype(np.float64)
+    projections = np.hstack([kp_atlas.coords, np.ones((len(kp_atlas.coords), 1))]) @ np.asarray(affine).T
+    desc_patient = np.asarray(kp_patient.descripteurs, dtype=np.float32)
+    desc_atlas = np.asarray(kp_atlas.descripteurs, dtype=np.float32)
+    norme_atlas = np.einsum('ij,ij->i', desc_atlas, desc_atlas)
+
+    def grouper(positions):
+        """{cellule: indices des points de la cellule}."""
+        cellules = np.floor(positions / rayon).astype(np.int64)
+        cles, inverse = np.unique(cellules, axis=0, return_inverse=True)
+        inverse = inverse.reshape(-1)
+        ordre = np.argsort(inverse, kind="stable")
+        bornes = np.searchsorted(inverse[ordre], np.arange(len(cles) + 1))
+        return {tuple(c): ordre[bornes[i]:bornes[i + 1]] for i, c in enumerate(cles)}
+
+    cellules_atlas = grouper(projections)
+    voisines = np.array([(i, j, k) for i in (-1, 0, 1) for j in (-1, 0, 1) for k in (-1, 0, 1)])
+    i_pat, i_atl = [], []
+    for cle, membres in grouper(pos_patient).items():
+        groupes = [cellules_atlas.get(tuple(v)) for v in np.array(cle) + voisines]
+        groupes = [g for g in groupes if g is not None]
+        if not groupes: continue
+        candidats = np.concatenate(groupes)
+
+        bloc = desc_patient[membres]
+        d2 = norme_atlas[candidats][None, :] - 2.0 * (bloc @ desc_atlas[candidats].T)
+        d2 += np.einsum('ij,ij->i', bloc, bloc)[:, None]
+        np.maximum(d2, 0, out=d2)
+        ecarts = np.linalg.norm(pos_patient[membres][:, None, :] - projections[candidats][None, :, :], axis=2)
+        d2[ecarts > rayon] = np.inf
+
+        if len(candidats) == 1:
+            meilleurs, d1, d2_second = np.zeros(len(membres), dtype=np.int64), d2[:, 0], np.full(len(membres), np.inf)
+        else:
+            top2 = np.argpartition(d2, 1, axis=1)[:, :2]
+            d_top2 = np.take_along_axis(d2, top2, axis=1)
+            premier = np.argmin(d_top2, axis=1)
+            meilleurs = top2[np.arange(len(membres)), premier]
+            d1, d2_second = d_top2[np.arange(len(membres)), premier], d_top2[np.arange(len(membres)), 1 - premier]
+        garde = np.isfinite(d1) & (d1 < (ratio ** 2) * d2_second)
+        i_pat.append(membres[garde])
+        i_atl.append(candidats[meilleurs[garde]])
+
+    if not i_pat: return vide, vide
+    i_pat, i_atl = np.concatenate(i_pat), np.concatenate(i_atl)
+    ordre = np.argsort(i_pat, kind="stable") # ordre des keypoints du patient, comme apparier_keypoints
+    return (kp_patient.coords[i_pat[ordre]].astype(np.float64),
+            kp_atlas.coords[i_atl[ordre]].astype(np.float64))
+
+def ecrire_fichiers_matches(path_img1, path_img2, kp_img1, kp_img2, idx_img1, idx_img2):
+    """
+    Écrit une paire de fichiers de matches au format texte (index x y z scale),
+    relisible par charger_fichier_matches_robuste.
+    """
+    for path, kp, idx in ((path_img1, kp_img1, idx_img1), (path_img2, kp_img2, idx_img2)):
+        with open(path, 'w') as f:
+            f.write("# index x y z scale\n")
+            for i, (p, s) in enumerate(zip(kp.coords[idx], kp.echelles[idx])):
+                f.write(f"{i} {p[0]:.6f} {p[1]:.6f} {p[2]:.6f} {s:.6f}\n")
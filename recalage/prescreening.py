@@ -0,0 +1,65 @@
+import numpy as np
+
+"""
+Pré-sélection des atlas par signature globale (sac de mots visuels).
+
+Chaque volume est résumé par l'histogramme tf-idf de ses descripteurs SIFT
+quantifiés sur un petit codebook (k-means), normalisé L2. La similarité
+patient/atlas est le produit scalaire (cosinus) de ces signatures ; le
+matching complet n'est ensuite lancé que sur les M atlas les plus proches.
+"""
+
+TAILLE_CODEBOOK = 64
+N_ECHANTILLON = 50000
+TAILLE_BLOC = 4096
+
+def construire_codebook(liste_descripteurs, taille=TAILLE_CODEBOOK, n_echantillon=N_ECHANTILLON, random_state=42):
+    """k-means (MiniBatch) sur un échantillon des descripteurs de tous les atlas. Retourne (taille, D) float32."""
+    from sklearn.cluster import MiniBatchKMeans
+
+    rng = np.random.default_rng(random_state)
+    tous = np.concatenate([np.asarray(d, dtype=np.float32) for d in liste_descripteurs if len(d)])
+    if len(tous) > n_echantillon:
+        tous = tous[rng.choice(len(tous), n_echantillon, replace=False)]
+    kmeans = MiniBatchKMeans(n_clusters=min(taille, len(tous)), random_state=random_state, n_init=3)
+    kmeans.fit(tous)
+    return kmeans.cluster_centers_.astype(np.float32)
+
+def histogramme_mots(descripteurs, codebook):
+    """Nombre de descripteurs affectés à chaque mot visuel (plus proche centre)."""
+    descripteurs = np.asarray(descripteurs, dtype=np.float32)
+    norme_centres = np.einsum('ij,ij->i', codebook, codebook)
+    mots = np.empty(len(descripteurs), dtype=np.int64)
+    for debut in range(0, len(descripteurs), TAILLE_BLOC):
+        bloc = descripteurs[debut:debut + TAILLE_BLOC]
+        # ||c||² - 2 d.c suffit pour l'argmin (||d||² constant par ligne)
+        mots[debut:debut + len(bloc)] = np.argmin(norme_centres[None, :] - 2.0 * (bloc @ codebook.T), axis=1)
+    return np.bincount(mots, minlength=len(codebook)).astype(np.float64)
+
+def calculer_idf(histogrammes):
+    """idf de chaque mot sur la collection d'atlas."""
+    histogrammes = np.asarray(histogrammes)
+    df = np.count_nonzero(histogrammes > 0, axis=0)
+    return np.log((1.0 + len(histogrammes)) / (1.0 + df)) + 1.0
+
+def signature(histogramme, idf):
+    """Signature tf-idf normalisée L2."""
+    tf = histogramme / max(histogramme.sum(), 1.0)
+    v = tf * idf
+    n = np.linalg.norm(v)
+    return v / n if n > 0 else v
+
+def signatures_atlas(liste_descripteurs, taille=TAILLE_CODEBOOK, random_state=42):
+    """Codebook, idf et signatures (N_atlas, taille) d'une collection d'atlas."""
+    codebook = construire_codebook(liste_descripteurs, taille=taille, random_state=random_state)
+    histos = np.array([histogramme_mots(d, codebook) for d in liste_descripteurs])
+    idf = calculer_idf(histos)
+    sigs = np.array([signature(h, idf) for h in histos])
+    return codebook, idf, sigs
+
+def classer_atlas(descripteurs_patient, codebook, idf, sigs_atlas):
+    """Indices des atlas triés par similarité décroissante, et similarités correspondantes."""
+    sig_patient = signature(histogramme_mots(descripteurs_patient, codebook), idf)
+    similarites = np.asarray(sigs_atlas) @ sig_patient
+    ordre = np.argsort(-similarites, kind="stable")
+    return ordre, similarites[ordre]
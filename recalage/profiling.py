@@ -0,0 +1,130 @@
+import glob
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import numpy as np
+
+"""
+Profilage par étape (--profile) : temps mur et temps CPU de chaque étape,
+avec le contexte (patient, atlas...) de la paire traitée.
+
+Chaque processus écrit ses événements dans son propre fichier `<trace>.<pid>.part`
+(aucune écriture concurrente, y compris avec un pool de processus) ; terminer()
+les fusionne en une trace JSON-lines unique et produit le tableau récapitulatif
+(total, p50, p95, max par étape, atlas/paires les plus lents).
+
+Le temps CPU est celui du thread courant : pour l'étape featMatchMultiple il
+exclut le sous-processus lui-même (un CPU proche de 0 signifie que l'étape attend le binaire).
+"""
+
+_actif = None
+_local = threading.local() # contexte courant (patient, atlas...) du thread
+
+class Profileur:
+    def __init__(self, path):
+        self.path = path
+        self._verrou = threading.Lock()
+        self._fichier = None
+        self._pid = None
+
+    def enregistrer(self, evenement):
+        ligne = json.dumps(evenement) + "\n"
+        with self._verrou:
+            # Après un fork, le processus fils ouvre son propre fichier
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._fichier = open(f"{self.path}.{self._pid}.part", 'a', buffering=1)
+            self._fichier.write(ligne)
+
+    def fermer(self):
+        with self._verrou:
+            if self._fichier is not None and self._pid == os.getpid(): self._fichier.close()
+            self._fichier, self._pid = None, None
+
+def activer(path):
+    """Active le profilage dans ce processus (idempotent ; aussi utilisé comme initializer de pool)."""
+    global _actif
+    if path and (_actif is None or _actif.path != path):
+        _actif = Profileur(path)
+    return _actif
+
+def actif():
+    return _actif is not None
+
+@contextmanager
+def contexte(**champs):
+    """Ajoute `champs` (ex. patient=..., atlas=...) à toutes les étapes mesurées dans le bloc."""
+    precedent = getattr(_local, "champs", {})
+    _local.champs = {**precedent, **champs}
+    try:
+        yield
+    finally:
+        _local.champs = precedent
+
+@contextmanager
+def etape(nom):
+    """Mesure le bloc comme une étape `nom`. Sans profileur actif, ne fait rien."""
+    if _actif is None:
+        yield
+        return
+    debut, w0, c0 = time.time(), time.perf_counter(), time.thread_time()
+    try:
+        yield
+    finally:
+        _actif.enregistrer(dict(etape=nom, debut=round(debut, 6), mur=time.perf_counter() - w0,
+                                cpu=time.thread_time() - c0, pid=os.getpid(), **getattr(_local, "champs", {})))
+
+def _fusionner(path):
+    """Rassemble les fichiers .part de tous les processus dans la trace, triée par date de début."""
+    evenements = []
+    for part in glob.glob(f"{glob.escape(path)}.*.part"):
+        with open(part, 'r') as f:
+            evenements += [json.loads(l) for l in f if l.strip()]
+        os.remove(part)
+    evenements.sort(key=lambda e: e["debut"])
+    with open(path, 'w') as f:
+        for e in evenements: f.write(json.dumps(e) + "\n")
+    return evenements
+
+def resumer(evenements, n_lents=10):
+    """Tableau texte : statistiques par étape, puis les paires et atlas les plus coûteux."""
+    par_etape = {}
+    for e in evenements: par_etape.setdefault(e["etape"], []).append(e)
+
+    lignes = [f"{'étape':<24}{'n':>8}{'total_s':>11}{'cpu_s':>11}{'p50_ms':>10}{'p95_ms':>10}{'max_ms':>10}"]
+    for nom, evs in sorted(par_etape.items(), key=lambda x: -sum(e["mur"] for e in x[1])):
+        murs = np.array([e["mur"] for e in evs])
+        lignes.append(f"{nom:<24}{len(evs):>8}{murs.sum():>11.2f}{sum(e['cpu'] for e in evs):>11.2f}"
+                      f"{np.percentile(murs, 50) * 1e3:>10.1f}{np.percentile(murs, 95) * 1e3:>10.1f}{murs.max() * 1e3:>10.1f}")
+
+    # Cumul par paire (patient/cible, atlas/source) et par atlas
+    paires, atlas = {}, {}
+    for e in evenements:
+        cle_atlas = e.get("atlas", e.get("source"))
+        if cle_atlas is None: continue
+        cle = (e.get("patient", e.get("cible", "")), cle_atlas)
+        paires[cle] = paires.get(cle, 0.0) + e["mur"]
+        atlas[cle_atlas] = atlas.get(cle_atlas, 0.0) + e["mur"]
+    if paires:
+        lignes.append("")
+        lignes.append(f"Paires les plus lentes (temps mur cumulé) :")
+        for (p, a), d in sorted(paires.items(), key=lambda x: -x[1])[:n_lents]:
+            lignes.append(f"  {p:<20}{a:<20}{d:>10.2f} s")
+        lignes.append(f"Atlas les plus lents (temps mur cumulé) :")
+        for a, d in sorted(atlas.items(), key=lambda x: -x[1])[:n_lents]:
+            lignes.append(f"  {a:<40}{d:>10.2f} s")
+    return "\n".join(lignes)
+
+def terminer():
+    """Fusionne la trace, écrit `<trace>_summary.txt` et retourne le récapitulatif (None si inactif)."""
+    global _actif
+    if _actif is None: return None
+    _actif.fermer()
+    path = _actif.path
+    _actif = None
+    texte = resumer(_fusionner(path))
+    with open(os.path.splitext(path)[0] + "_summary.txt", 'w') as f: f.write(texte + "\n")
+    return texte
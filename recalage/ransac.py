@@ -0,0 +1,155 @@
+import numpy as np
+
+"""
+RANSAC dédié à l'estimation d'une affine 3D (pts_src -> pts_dst).
+
+Les hypothèses sont tirées par lots : chaque lot résout tous ses systèmes
+normaux 4x4 en une seule opération batchée, puis évalue les résidus de toutes
+les hypothèses sur tous les points en un seul produit matriciel.
+L'arrêt anticipé suit le nombre d'essais adaptatif classique (confiance
+STOP_PROBABILITY), borné par max_trials.
+
+Sémantique conservée de l'ancienne version (sklearn RANSACRegressor) :
+  - min_samples : nombre de correspondances par hypothèse ;
+  - threshold   : seuil sur le résidu = somme des écarts absolus |dx|+|dy|+|dz| (mm) ;
+  - sortie      : matrice 3x4 raffinée par moindres carrés sur les inliers + nombre d'inliers.
+"""
+
+MAX_TRIALS = 100
+STOP_PROBABILITY = 0.99
+TAILLE_LOT = 32
+COND_MAX = 1e10
+
+def nombre_essais_dynamique(n_inliers, n_points, min_samples, probabilite=STOP_PROBABILITY):
+    """Nombre d'essais garantissant (avec la confiance donnée) un échantillon sans outlier."""
+    ratio = n_inliers / float(n_points)
+    nom = max(np.finfo(float).eps, 1 - probabilite)
+    denom = max(np.finfo(float).eps, 1 - ratio ** min_samples)
+    if nom == 1: return 0
+    if denom == 1: return float("inf")
+    return abs(float(np.ceil(np.log(nom) / np.log(denom))))
+
+def homogeneiser(pts):
+    return np.hstack([pts, np.ones((len(pts), 1))])
+
+def ajuster_lot(A, dst, echantillons):
+    """
+    Résout en une fois les moindres carrés de chaque échantillon (B, m).
+    Retourne (X (b,4,3), valides (B,) bool) ; X ne contient que les hypothèses non dégénérées.
+    """
+    As = A[echantillons]                       # (B, m, 4)
+    Ys = dst[echantillons]                     # (B, m, 3)
+    AtA = np.einsum('bmi,bmj->bij', As, As)    # (B, 4, 4)
+    AtY = np.einsum('bmi,bmj->bij', As, Ys)    # (B, 4, 3)
+    valides = np.linalg.cond(AtA) < COND_MAX
+    if not np.any(valides): return np.zeros((0, 4, 3)), valides
+    return np.linalg.solve(AtA[valides], AtY[valides]), valides
+
+def calculer_residus(A, dst, X):
+    """Résidus (b, N) de b hypothèses sur N points, en un seul produit matriciel."""
+    pred = np.einsum('nk,bkj->bnj', A, X)
+    return np.abs(pred - dst[None]).sum(axis=2)
+
+def lots_hypotheses(A, dst, min_samples, rng, max_trials=MAX_TRIALS, taille_lot=TAILLE_LOT):
+    """
+    Générateur des lots d'hypothèses : (X (b,4,3), residus (b,N), n_essais du lot).
+    La séquence de tirages ne dépend que de rng : deux consommateurs qui s'arrêtent
+    à des lots différents voient exactement les mêmes hypothèses jusqu'à leur arrêt.
+    """
+    n = len(A)
+    fait = 0
+    while fait < max_trials:
+        taille = min(taille_lot, max_trials - fait)
+        # Tirage sans remise de min_samples indices par hypothèse
+        echantillons = np.argpartition(rng.random((taille, n)), min_samples - 1, axis=1)[:, :min_samples]
+        X, _ = ajuster_lot(A, dst, echantillons)
+        fait += taille
+        yield X, calculer_residus(A, dst, X), taille
+
+def selectionner_meilleure(residus, threshold, meilleur=None):
+    """
+    Met à jour le meilleur (n_inliers, somme_residus_inliers, masque) avec un lot de résidus.
+    Plus d'inliers gagne ; à égalité, le plus petit résidu cumulé sur les inliers.
+    """
+    if len(residus) == 0: return meilleur
+    masques = residus <= threshold
+    n_in = masques.sum(axis=1)
+    cout = np.where(masques, residus, 0.0).sum(axis=1)
+    # lexsort : dernier critère prioritaire -> max inliers puis min coût
+    i = np.lexsort((cout, -n_in))[0]
+    if meilleur is None or n_in[i] > meilleur[0] or (n_in[i] == meilleur[0] and cout[i] < meilleur[1]):
+        return int(n_in[i]), float(cout[i]), masques[i]
+    return meilleur
+
+def raffiner(pts_src, pts_dst, masque):
+    """Moindres carrés sur les inliers : matrice affine 3x4."""
+    solution, _, _, _ = np.linalg.lstsq(homogeneiser(pts_src[masque]), pts_dst[masque], rcond=None)
+    return solution.T
+
+def balayer_seuils(pts_src, pts_dst, min_samples, thresholds,
+                   max_trials=MAX_TRIALS, stop_probability=STOP_PROBABILITY, random_state=42):
+    """
+    RANSAC évalué pour plusieurs seuils sur les mêmes hypothèses.
+    Chaque lot est tiré et ses résidus calculés une seule fois, puis re-scorés pour
+    chaque seuil encore actif ; chaque seuil applique son propre arrêt anticipé.
+    Le résultat pour un seuil est donc identique à un appel isolé avec ce seuil.
+    Retourne {seuil: (matrice 3x4 ou None, n_inliers, masque ou None)}.
+    """
+    pts_src = np.asarray(pts_src, dtype=np.float64)
+    pts_dst = np.asarray(pts_dst, dtype=np.float64)
+    n = len(pts_src)
+    if n < min_samples or len(pts_dst) < min_samples:
+        return {t: (None, 0, None) for t in thresholds}
+
+    rng = np.random.default_rng(random_state)
+    A = homogeneiser(pts_src)
+    meilleurs = {t: None for t in thresholds}
+    actifs = set(thresholds)
+    essais = 0
+    for _, residus, taille in lots_hypotheses(A, pts_dst, min_samples, rng, max_trials=max_trials):
+        essais += taille
+        for t in list(actifs):
+            meilleurs[t] = selectionner_meilleure(residus, t, meilleurs[t])
+            m = meilleurs[t]
+            if m is None: continue
+            if m[0] == n or essais >= nombre_essais_dynamique(m[0], n, min_samples, stop_probability):
+                actifs.discard(t)
+        if not actifs: break
+
+    resultats = {}
+    for t, m in meilleurs.items():
+        if m is None or m[0] < min_samples:
+            resultats[t] = (None, 0, None)
+        else:
+            resultats[t] = (raffiner(pts_src, pts_dst, m[2]), m[0], m[2])
+    return resultats
+
+def estimer_affine_ransac(pts_src, pts_dst, min_samples=5, threshold=15.0,
+                          max_trials=MAX_TRIALS, stop_probability=STOP_PROBABILITY, random_state=42):
+    """
+    RANSAC affine 3D batché.
+    Retourne (matrice 3x4 ou None, n_inliers, masque_inliers ou None).
+    """
+    return balayer_seuils(pts_src, pts_dst, min_samples, [threshold], max_trials=max_trials,
+                          stop_probability=stop_probability, random_state=random_state)[threshold]
+
+def _affine_ransac_sklearn(pts_src, pts_dst, min_samples, threshold):
+    """Implémentation historique (référence de comparaison)."""
+    from sklearn.linear_model import RANSACRegressor
+    ransac = RANSACRegressor(min_samples=min_samples, residual_threshold=threshold, random_state=42)
+    ransac.fit(pts_src, pts_dst)
+    nb_inliers = np.sum(ransac.inlier_mask_)
+    if nb_inliers < min_samples: return None, 0
+    return raffiner(pts_src, pts_dst, ransac.inlier_mask_), nb_inliers
+
+def calculer_affine_ransac(pts_src, pts_dst, min_samples=5, threshold=15.0, backend="numpy"):
+    """Affine 3x4 (src -> dst) et nombre d'inliers ; (None, 0) en cas d'échec."""
+    if len(pts_src) < min_samples or len(pts_dst) < min_samples:
+        return None, 0
+    try:
+        if backend == "sklearn":
+            return _affine_ransac_sklearn(pts_src, pts_dst, min_samples, threshold)
+        mat, nb_inliers, _ = estimer_affine_ransac(pts_src, pts_dst, min_samples=min_samples, threshold=threshold)
+        return mat, nb_inliers
+    except (ValueError, np.linalg.LinAlgError):
+        return None, 0
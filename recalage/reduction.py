@@ -0,0 +1,81 @@
+import os
+
+import numpy as np
+
+"""
+Réduction hors ligne de la base d'atlas : beaucoup d'atlas sont anatomiquement quasi redondants.
+À partir des appariements atlas x atlas (matrice de coûts C[a, r] : à quel point l'atlas r « sert »
+l'atlas a, via l'erreur de transfert des landmarks ou les inliers RANSAC), on choisit par couverture
+gloutonne un sous-ensemble de représentants : chaque atlas est couvert par son meilleur représentant,
+et l'on ajoute à chaque étape celui qui fait le plus baisser le coût moyen de couverture.
+Les listes d'atlas sont des fichiers texte, un identifiant (sub-XXXX) par ligne, # = commentaire.
+"""
+
+def identifiant_liste(nom):
+    """'0086', 'sub-0086', 'sub-0086_T1w' -> 'sub-0086' (même forme que Atlas.atlas_id)."""
+    nom = nom.strip().replace("_T1w", "")
+    return nom if nom.startswith("sub-") else f"sub-{nom}"
+
+def lire_liste_atlas(path):
+    """Identifiants d'une liste d'atlas, dans l'ordre du fichier (premier champ si la ligne est un CSV)."""
+    ids = []
+    with open(path, 'r') as f:
+        for line in f:
+            line = line.split('#', 1)[0].strip()
+            if line: ids.append(identifiant_liste(line.split(',')[0]))
+    return ids
+
+def ecrire_liste_atlas(path, ids, entete=(), valeurs=None):
+    """Écriture atomique d'une liste d'atlas (en-tête en commentaire ; valeurs : seconde colonne optionnelle)."""
+    tmp = f"{path}.tmp.{os.getpid()}"
+    with open(tmp, 'w') as f:
+        for ligne in entete: f.write(f"# {ligne}\n")
+        for i, atlas_id in enumerate(ids):
+            f.write(f"{atlas_id},{valeurs[i]:.4f}\n" if valeurs is not None else f"{atlas_id}\n")
+    os.replace(tmp, path)
+
+def couts_erreur(erreurs, inliers, min_inliers):
+    """Coût = erreur de transfert (mm) ; paire absente ou sous min_inliers : non couverte (inf), soi-même : 0."""
+    couts = np.where(inliers >= min_inliers, erreurs, np.inf)
+    np.fill_diagonal(couts, 0.0)
+    return couts
+
+def couts_inliers(inliers, min_inliers):
+    """Coût sans vérité terrain : 1 - inliers / meilleur nombre d'inliers de la cible (0 = meilleur appariement)."""
+    inliers = np.asarray(inliers, dtype=np.float64)
+    hors_diagonale = np.where(np.eye(len(inliers), dtype=bool), 0, inliers)
+    meilleurs = np.maximum(hors_diagonale.max(axis=1, keepdims=True), 1)
+    couts = np.where(inliers >= min_inliers, 1.0 - hors_diagonale / meilleurs, np.inf)
+    np.fill_diagonal(couts, 0.0)
+    return couts
+
+def couverture_gloutonne(couts):
+    """
+    Ordre glouton des représentants pour la matrice de coûts C[a, r] (a couvert par r).
+    Un atlas non couvert coûte la pénalité (plus grand coût fini) ; les ex aequo vont au plus petit indice.
+    Retourne (ordre, couverture) : couverture[i] = coût moyen de couverture avec les i+1 premiers représentants.
+    """
+    couts = np.asarray(couts, dtype=np.float64)
+    n = len(couts)
+    finis = couts[np.isfinite(couts)]
+    penalite = finis.max() if len(finis) else 1.0
+    couts = np.where(np.isfinite(couts), couts, penalite)
+
+    meilleur = np.full(n, penalite)
+    libres = np.ones(n, dtype=bool)
+    ordre, couverture = [], []
+    for _ in range(n):
+        totaux = np.minimum(meilleur[:, None], couts).sum(axis=0)
+        totaux[~libres] = np.inf
+        r = int(np.argmin(totaux))
+        meilleur = np.minimum(meilleur, couts[:, r])
+        libres[r] = False
+        ordre.append(r)
+        couverture.append(float(meilleur.mean()))
+    return ordre, couverture
+
+def taille_pour_tolerance(couverture, tolerance):
+    """Plus petit nombre de représentants dont le coût moyen de couverture est <= tolerance."""
+    for i, c in enumerate(couverture):
+        if c <= tolerance: return i + 1
+    return len(couverture)
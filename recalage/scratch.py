@@ -0,0 +1,97 @@
+import os
+import shutil
+import tempfile
+
+"""
+Dossiers de travail isolés pour les appels à featMatchMultiple.
+
+Le binaire écrit ses sorties (.matches.img1/img2, .trans, .info, .update.key) à côté
+des .key qu'on lui passe : en lui donnant des liens créés dans un dossier propre
+au job, tout reste confiné et le nettoyage se limite à supprimer ce dossier.
+Ces dossiers peuvent vivre en mémoire (--scratch_dir shm, ou tout tmpfs) : les sorties
+intermédiaires du binaire ne touchent alors jamais le système de fichiers partagé, où
+seuls les résultats finaux sont écrits (placer_atomiquement copie puis renomme).
+"""
+
+EXTENSIONS_TEMPORAIRES = [".matches.info.txt", ".trans.txt", ".trans-inverse.txt", ".update.key"]
+SCRATCH_RAM = "/dev/shm"
+
+def creer_racine_scratch(scratch_dir, prefixe, defaut=None):
+    """
+    Racine des dossiers de job d'une exécution.
+    Sans scratch_dir : defaut (dans l'arborescence de sortie), ou un dossier temporaire du système.
+    Avec scratch_dir ("shm" = /dev/shm, ou un chemin) : sous-dossier propre à l'exécution,
+    pour que des exécutions concurrentes sur la même machine ne partagent aucun dossier de job.
+    """
+    if not scratch_dir:
+        return defaut if defaut else tempfile.mkdtemp(prefix=prefixe)
+    base = scratch_dir
+    if scratch_dir == "shm":
+        base = SCRATCH_RAM if os.access(SCRATCH_RAM, os.W_OK) else tempfile.gettempdir()
+    os.makedirs(base, exist_ok=True)
+    return tempfile.mkdtemp(prefix=prefixe, dir=os.path.abspath(base))
+
+def preparer_espace_job(job_dir, chemins, noms=None):
+    """
+    Crée un dossier de travail isolé et y expose les fichiers d'entrée
+    (lien symbolique, copie à défaut), sous leur nom ou sous noms[i]. Retourne les chemins locaux.
+    """
+    if os.path.exists(job_dir): shutil.rmtree(job_dir)
+    os.makedirs(job_dir)
+    chemins_locaux = []
+    for i, chemin in enumerate(chemins):
+        local = os.path.join(job_dir, noms[i] if noms and noms[i] else os.path.basename(chemin))
+        try: os.symlink(chemin, local)
+        except OSError: shutil.copy2(chemin, local)
+        chemins_locaux.append(local)
+    return chemins_locaux
+
+def nom_local_lot(i, chemin):
+    """
+    Nom sous lequel la i-ème source d'un lot est exposée au binaire : le préfixe d'index de largeur
+    fixe rend chaque nom unique et jamais préfixe d'un autre, donc ses sorties retrouvables sans ambiguïté.
+    """
+    return f"{i:05d}__{os.path.basename(chemin)}"
+
+def sorties_lot(job_dir, noms):
+    """
+    Fichiers de correspondances (img1, img2) de chaque source d'un lot, d'après son nom local
+    (sorties <nom sans .key>*.matches.img1.txt écrites à côté de la source) ; None si absents.
+    """
+    presents = os.listdir(job_dir)
+    sorties = []
+    for nom in noms:
+        stem = nom[:-len(".key")] if nom.endswith(".key") else nom
+        img1 = sorted(f for f in presents if f.startswith(stem) and f.endswith(".matches.img1.txt"))
+        img2 = img1[0].replace(".img1.txt", ".img2.txt") if img1 else None
+        if img2 is None or img2 not in presents: sorties.append(None)
+        else: sorties.append((os.path.join(job_dir, img1[0]), os.path.join(job_dir, img2)))
+    return sorties
+
+def nettoyer_espace_job(job_dir):
+    if os.path.exists(job_dir):
+        shutil.rmtree(job_dir, ignore_errors=True)
+
+def placer_atomiquement(source, destination):
+    """
+    Déplace source vers destination sans jamais exposer de fichier partiel :
+    copie vers un nom temporaire dans le dossier final, puis renommage atomique.
+    """
+    tmp = f"{destination}.{os.getpid()}.tmp"
+    try:
+        os.replace(source, tmp) # même système de fichiers : simple renommage
+    except OSError:
+        shutil.copyfile(source, tmp)
+    os.replace(tmp, destination)
+
+def lier_atomiquement(cible, destination):
+    """
+    Crée destination comme lien symbolique relatif vers cible (copie si les liens
+    ne sont pas supportés), via un nom temporaire puis un renommage atomique.
+    """
+    tmp = f"{destination}.{os.getpid()}.tmp"
+    try:
+        os.symlink(os.path.relpath(cible, os.path.dirname(destination)), tmp)
+    except OSError:
+        shutil.copyfile(cible, tmp)
+    os.replace(tmp, destination)
@@ -0,0 +1,139 @@
+import os
+import socket
+import threading
+import time
+import uuid
+
+"""
+Répartition de la grille de paires entre plusieurs machines (--shard i/N).
+
+Répartition : LPT (longest processing time first). Les paires sont triées par coût
+estimé décroissant (produit des nombres de keypoints cible x source, l'appariement
+exhaustif étant quadratique), chacune allant au shard le moins chargé. Le résultat ne
+dépend que de la liste des paires : chaque machine calcule la même répartition.
+
+Revendications : avant de calculer une paire, un worker crée <output>/.claims/<cible>__<source>.claim
+en mode exclusif (O_CREAT | O_EXCL, atomique y compris sur NFS v3+). Une machine en avance
+peut ainsi prendre le travail restant des autres shards (--steal) sans doublon. La revendication
+contient un jeton unique, relu après création pour confirmer la propriété. Tant que le job
+tourne, un thread du processus rafraîchit la date de ses revendications (battement, toutes les
+claim_ttl / 4 secondes) ; elle est supprimée en fin de job, par son seul propriétaire. Celle d'une
+machine tombée en panne n'est plus rafraîchie : périmée après claim_ttl secondes, elle peut être
+reprise (renommage atomique : un seul gagnant ; une revendication renommée qui s'avère fraîche,
+recréée entre-temps par un autre worker, est remise en place).
+"""
+
+DOSSIER_CLAIMS = ".claims"
+BATTEMENT_MAX = 60.0
+
+# Revendications détenues par ce processus {chemin: jeton}, rafraîchies par le thread de battement
+_detenues = {}
+_verrou = threading.Lock()
+_battement = {"pid": None, "periode": None}
+
+def parser_shard(texte):
+    """Convertisseur argparse : "2/4" -> (2, 4), shards numérotés de 1 à N."""
+    try:
+        i, n = (int(v) for v in texte.split("/"))
+    except ValueError:
+        raise ValueError(f"Shard invalide : {texte!r} (attendu i/N)")
+    if not 1 <= i <= n: raise ValueError(f"Shard invalide : {texte!r} (1 <= i <= N)")
+    return i, n
+
+def repartir_lpt(couts, n_shards):
+    """
+    couts : {cle: coût estimé}. Retourne la liste des clés de chaque shard
+    (index 0 à n_shards-1), chacune par coût décroissant.
+    """
+    charges = [0.0] * n_shards
+    shards = [[] for _ in range(n_shards)]
+    for cle in sorted(couts, key=lambda c: (-couts[c], c)):
+        i = min(range(n_shards), key=lambda k: (charges[k], k))
+        shards[i].append(cle)
+        charges[i] += couts[cle]
+    return shards
+
+def _chemin_claim(dossier_claims, target_id, source_id):
+    return os.path.join(dossier_claims, f"{target_id}__{source_id}.claim")
+
+def _lire_jeton(path):
+    try:
+        with open(path, 'r') as f: return f.read().split(" ", 1)[0].strip()
+    except OSError:
+        return None
+
+def _entretenir(periode):
+    """Battement : rafraîchit la date des revendications encore détenues (jeton inchangé)."""
+    while True:
+        time.sleep(periode)
+        with _verrou: detenues = list(_detenues.items())
+        for path, jeton in detenues:
+            if _lire_jeton(path) != jeton: continue
+            try: os.utime(path)
+            except OSError: pass
+
+def _demarrer_battement(claim_ttl):
+    periode = min(claim_ttl / 4, BATTEMENT_MAX) if claim_ttl else BATTEMENT_MAX
+    with _verrou:
+        # Processus fils (fork) : ni le thread ni les revendications du parent ne sont hérités
+        if _battement["pid"] != os.getpid():
+            _detenues.clear()
+        elif _battement["periode"] <= periode:
+            return
+        _battement.update(pid=os.getpid(), periode=periode)
+    threading.Thread(target=_entretenir, args=(periode,), daemon=True).start()
+
+def _reprendre_perimee(path, claim_ttl, jeton):
+    """
+    Écarte une revendication périmée. Le renommage n'a qu'un gagnant, mais la revendication renommée peut
+    être fraîche (reprise et recréée par un autre worker depuis notre stat) : elle est alors remise en place.
+    Retourne True si la voie est libre pour une nouvelle création O_EXCL.
+    """
+    perime = f"{path}.perime.{jeton}"
+    try: os.rename(path, perime)
+    except FileNotFoundError: return False
+    try:
+        frais = time.time() - os.stat(perime).st_mtime <= claim_ttl
+        if frais:
+            try: os.link(perime, path)
+            except FileExistsError: pass
+        return not frais
+    finally:
+        os.remove(perime)
+
+def revendiquer(dossier_claims, target_id, source_id, claim_ttl=None):
+    """True si la paire est revendiquée par ce processus, False si un autre la traite déjà."""
+    path = _chemin_claim(dossier_claims, target_id, source_id)
+    jeton = f"{socket.gethostname()}.{os.getpid()}.{uuid.uuid4().hex[:12]}"
+    for _ in range(2):
+        try:
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+        except FileExistsError:
+            try:
+                age = time.time() - os.stat(path).st_mtime
+            except FileNotFoundError:
+                continue # libérée entre-temps : nouvel essai
+            if claim_ttl is None or age <= claim_ttl: return False
+            # Revendication périmée (machine arrêtée)
+            if not _reprendre_perimee(path, claim_ttl, jeton): return False
+            continue
+        with os.fdopen(fd, 'w') as f: f.write(f"{jeton} {time.time():.0f}\n")
+        # Relecture : la revendication est bien la nôtre
+        if _lire_jeton(path) != jeton: return False
+        _demarrer_battement(claim_ttl)
+        with _verrou: _detenues[path] = jeton
+        return True
+    return False
+
+def liberer(dossier_claims, target_id, source_id):
+    """Supprime la revendication si ce processus la détient encore (jeton inchangé)."""
+    path = _chemin_claim(dossier_claims, target_id, source_id)
+    with _verrou: jeton = _detenues.pop(path, None)
+    if jeton is None or _lire_jeton(path) != jeton: return
+    try: os.remove(path)
+    except FileNotFoundError: pass
+
+def revendications_actives(dossier_claims):
+    """Paires (cible, source) actuellement revendiquées."""
+    if not os.path.isdir(dossier_claims): return []
+    return [tuple(f[:-len(".claim")].split("__", 1)) for f in sorted(os.listdir(dossier_claims)) if f.endswith(".claim")]
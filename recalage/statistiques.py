@@ -0,0 +1,27 @@
+import numpy as np
+
+"""
+Statistiques courantes (algorithme de Welford) : moyenne et écart-type élément par élément
+sur un flux de tableaux de forme fixe, en mémoire constante quel que soit le nombre de patients.
+Les valeurs NaN (ex: K supérieur au nombre de candidats d'un patient) ne sont pas comptées.
+"""
+
+class StatistiquesCourantes:
+    def __init__(self, forme):
+        self.n = np.zeros(forme, dtype=np.int64)
+        self.moyenne = np.zeros(forme, dtype=np.float64)
+        self._m2 = np.zeros(forme, dtype=np.float64)
+
+    def ajouter(self, valeurs):
+        """Ajoute une observation (tableau de la forme donnée, NaN = absente)."""
+        valeurs = np.asarray(valeurs, dtype=np.float64)
+        present = ~np.isnan(valeurs)
+        self.n += present
+        delta = np.where(present, valeurs - self.moyenne, 0.0)
+        self.moyenne += np.where(present, delta / np.maximum(self.n, 1), 0.0)
+        self._m2 += np.where(present, delta * (valeurs - self.moyenne), 0.0)
+
+    def ecart_type(self):
+        """Écart-type de population (ddof=0, comme np.std), NaN sans observation."""
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return np.where(self.n > 0, np.sqrt(self._m2 / self.n), np.nan)
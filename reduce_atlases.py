@@ -0,0 +1,139 @@
+import os
+import sys
+import time
+import argparse
+
+import numpy as np
+
+from recalage import profiling
+from recalage.cache_transformations import TAILLE_MAX_MO, affine_en_cache, fermer_caches
+from recalage.gt import trouver_gt
+from recalage.reduction import (couts_erreur, couts_inliers, couverture_gloutonne, ecrire_liste_atlas,
+                                identifiant_liste, taille_pour_tolerance)
+from top_K import cache_args, charger_paires, executer_patients, projeter_landmarks
+
+"""
+Réduction hors ligne de la base d'atlas.
+Entrée : les appariements atlas x atlas de generate_matches.py (dossier des atlas passé comme
+cibles ET comme sources, --symmetric conseillé). Pour chaque paire, RANSAC donne le nombre d'inliers
+et l'erreur de transfert des landmarks de la source vers la cible ; les représentants sont choisis par
+couverture gloutonne (recalage/reduction.py) et écrits en liste d'atlas pour predict_landmarks.py --atlas_list.
+Le compromis taille / précision se mesure ensuite avec top_K.py --atlas_order.
+"""
+
+def ligne_similarite(nom_cible, args):
+    """{atlas source: (inliers, erreur de transfert moyenne en mm)} pour une cible, None sans GT."""
+    gt_cible = trouver_gt(args.gt, nom_cible)
+    if gt_cible is None: return None
+    ligne = {}
+    for nom_source, p_a, p_b, gt_source in charger_paires(nom_cible, args):
+        if len(p_a) < args.min_samples: continue
+        try:
+            with profiling.contexte(atlas=nom_source), profiling.etape("ransac"):
+                mat, score = affine_en_cache(cache_args(args), p_b, p_a, min_samples=args.min_samples,
+                                             threshold=args.threshold, backend=args.ransac)
+        except (ValueError, np.linalg.LinAlgError):
+            continue
+        if mat is None: continue
+        erreur = np.linalg.norm(projeter_landmarks(gt_source, mat) - gt_cible, axis=1).mean()
+        ligne[identifiant_liste(nom_source)] = (score, erreur)
+    return ligne
+
+def matrices_similarite(cibles, args):
+    """(ids, inliers, erreurs) : matrices (n, n), ligne = cible, colonne = source ; paire absente : 0 inlier, erreur inf."""
+    lignes = {}
+    for i, (nom, ligne) in enumerate(zip(cibles, executer_patients(ligne_similarite, cibles, args))):
+        if ligne is None:
+            print(f"[{i+1}] {nom}... ÉCHEC (GT absente)")
+            continue
+        lignes[identifiant_liste(nom)] = ligne
+        print(f"[{i+1}] {nom}... {len(ligne)} atlas")
+    ids = sorted(lignes)
+    position = {atlas_id: i for i, atlas_id in enumerate(ids)}
+    inliers = np.zeros((len(ids), len(ids)), dtype=np.int64)
+    erreurs = np.full((len(ids), len(ids)), np.inf)
+    for cible, ligne in lignes.items():
+        for source, (score, erreur) in ligne.items():
+            if source not in position: continue
+            inliers[position[cible], position[source]] = score
+            erreurs[position[cible], position[source]] = erreur
+    return ids, inliers, erreurs
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Choisit un sous-ensemble représentatif d'atlas à partir des appariements atlas x atlas.")
+    parser.add_argument("results", help="Dossier de generate_matches.py (atlas comme cibles et comme sources)")
+    parser.add_argument("gt", help="Dossier des GT des atlas")
+    parser.add_argument("--output_dir", default=".", help="Dossier de sortie (défaut: courant)")
+    parser.add_argument("--name_list", default="atlas_list.txt", help="Liste réduite (predict_landmarks.py --atlas_list)")
+    parser.add_argument("--name_order", default="atlas_order.txt",
+                        help="Ordre glouton complet des atlas, avec le coût de couverture (top_K.py --atlas_order)")
+    parser.add_argument("--name_matrix", default="atlas_similarity.npz", help="Matrices inliers / erreurs de transfert")
+    parser.add_argument("--criterion", choices=["error", "inliers"], default="error",
+                        help="Coût de couverture : erreur de transfert des landmarks (mm) ou part d'inliers perdue (sans GT de la cible)")
+    parser.add_argument("--size", type=int, default=0, help="Nombre d'atlas conservés (0 = selon --tolerance)")
+    parser.add_argument("--tolerance", type=float,
+                        help="Coût moyen de couverture visé quand --size vaut 0 (défaut : 2.0 mm avec error, 0.25 avec inliers)")
+    parser.add_argument("--min_inliers", type=int, default=0, help="Inliers minimum pour qu'un atlas en couvre un autre")
+
+    parser.add_argument("--min_samples", type=int, default=10)
+    parser.add_argument("--threshold", type=float, default=12)
+    parser.add_argument("--ransac", choices=["numpy", "sklearn"], default="numpy", help="Moteur RANSAC")
+    parser.add_argument("--no_cache", dest="cache", action="store_false",
+                        help="Désactive le cache binaire (.cache.npz) des fichiers de matches")
+    parser.add_argument("--transform_cache", help="Cache SQLite des transformations RANSAC, partagé avec top_K.py et predict_landmarks.py")
+    parser.add_argument("--transform_cache_size", type=float, default=TAILLE_MAX_MO, help="Taille maximale du cache (Mo), éviction LRU")
+    parser.add_argument("--transform_cache_masks", action="store_true", help="Conserve aussi les masques d'inliers dans le cache")
+    parser.add_argument("--jobs", type=int, default=1, help="Nombre de processus traitant les cibles en parallèle")
+    parser.add_argument("--chunksize", type=int, default=0, help="Cibles envoyées par paquet à chaque processus")
+    parser.add_argument("--profile", help="Trace JSON-lines des temps par étape ; récapitulatif dans <trace>_summary.txt")
+    return parser.parse_args()
+
+def main():
+    args = parse_arguments()
+    if not os.path.isdir(args.results):
+        print(f"[ERREUR] Dossier résultats introuvable : {args.results}")
+        sys.exit(1)
+    args.gt_source = args.gt # charger_paires lit les GT des sources ici
+    if args.tolerance is None: args.tolerance = 2.0 if args.criterion == "error" else 0.25
+    os.makedirs(args.output_dir, exist_ok=True)
+    profiling.activer(os.path.abspath(args.profile) if args.profile else None)
+    try:
+        reduire(args)
+    finally:
+        fermer_caches()
+        recapitulatif = profiling.terminer()
+        if recapitulatif: print(f"\n=== PROFIL ({args.profile}) ===\n{recapitulatif}")
+
+def reduire(args):
+    cibles = sorted(d for d in os.listdir(args.results)
+                    if not d.startswith('.') and os.path.isdir(os.path.join(args.results, d)))
+    print(f"--- RÉDUCTION DE LA BASE D'ATLAS ({len(cibles)} cibles, critère {args.criterion}) ---")
+    t0 = time.time()
+    ids, inliers, erreurs = matrices_similarite(cibles, args)
+    if len(ids) < 2:
+        print("[ERREUR] Moins de deux atlas exploitables.")
+        sys.exit(1)
+    path_matrice = os.path.join(args.output_dir, args.name_matrix)
+    np.savez(path_matrice, ids=np.array(ids), inliers=inliers, erreurs=erreurs)
+    print(f"Matrices {len(ids)} x {len(ids)} en {time.time() - t0:.1f} s : {path_matrice}")
+
+    if args.criterion == "error": couts = couts_erreur(erreurs, inliers, args.min_inliers)
+    else: couts = couts_inliers(inliers, args.min_inliers)
+    ordre, couverture = couverture_gloutonne(couts)
+    taille = min(args.size, len(ids)) if args.size > 0 else taille_pour_tolerance(couverture, args.tolerance)
+
+    unite = "mm" if args.criterion == "error" else ""
+    path_ordre = os.path.join(args.output_dir, args.name_order)
+    ecrire_liste_atlas(path_ordre, [ids[r] for r in ordre], valeurs=couverture,
+                       entete=[f"ordre glouton ({args.criterion}) : atlas, couverture moyenne avec les atlas jusqu'à celui-ci"])
+    path_liste = os.path.join(args.output_dir, args.name_list)
+    ecrire_liste_atlas(path_liste, [ids[r] for r in ordre[:taille]],
+                       entete=[f"{taille} / {len(ids)} atlas, couverture moyenne {couverture[taille - 1]:.3f} {unite} ({args.criterion})"])
+
+    print(f"\n{'atlas':>7}{'couverture':>12}")
+    for n in sorted({1, taille, len(ids)} | {int(len(ids) * f) for f in (0.1, 0.25, 0.5, 0.75)} - {0}):
+        print(f"{n:>7}{couverture[n - 1]:>12.3f}{' <-' if n == taille else ''}")
+    print(f"\nListe réduite : {path_liste} ({taille} / {len(ids)} atlas) ; ordre complet : {path_ordre}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,32 @@
+import numpy as np
+
+from recalage import cache_transformations
+from recalage.cache_transformations import CacheTransformations
+
+def test_lectures_sans_ecriture(tmp_path, monkeypatch):
+    cache = CacheTransformations(str(tmp_path / "cache.sqlite"))
+    mat = np.arange(12, dtype=np.float64).reshape(3, 4)
+    for i in range(3): cache.enregistrer(f"cle{i}", mat, 10 + i)
+    ecritures = cache.conn.total_changes
+
+    for _ in range(10):
+        assert cache.obtenir("cle0")[1] == 10
+    assert cache.conn.total_changes == ecritures
+    assert cache.obtenir("absente") is None
+
+    # Les accès en mémoire comptent pour l'éviction LRU : cle0, lue en dernier, est gardée
+    monkeypatch.setattr(cache, "taille_max", cache.conn.execute("SELECT SUM(taille) FROM transformations").fetchone()[0] - 1)
+    assert cache.evincer() == 1
+    assert cache.obtenir("cle0") is not None
+    cache.fermer()
+
+def test_acces_ecrits_par_lots(tmp_path, monkeypatch):
+    monkeypatch.setattr(cache_transformations, "PERIODE_ACCES", 2)
+    cache = CacheTransformations(str(tmp_path / "cache.sqlite"))
+    for i in range(2): cache.enregistrer(f"cle{i}", None, 0)
+    avant = dict(cache.conn.execute("SELECT cle, acces FROM transformations"))
+    cache.obtenir("cle0")
+    cache.obtenir("cle1")
+    apres = dict(cache.conn.execute("SELECT cle, acces FROM transformations"))
+    assert all(apres[c] >= avant[c] for c in avant) and not cache._acces
+    cache.fermer()
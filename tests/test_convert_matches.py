@@ -0,0 +1,61 @@
+import os
+
+import numpy as np
+
+import convert_matches
+from recalage.match_store import MatchStore, chemin_store
+from recalage.scratch import lier_atomiquement
+
+def ecrire_paire(dossier, source_id, pts1, pts2):
+    os.makedirs(dossier, exist_ok=True)
+    for suffixe, pts in ((".img1.txt", pts1), (".img2.txt", pts2)):
+        with open(os.path.join(dossier, f"match_{source_id}{suffixe}"), 'w') as f:
+            f.write("# index x y z scale\n")
+            for i, p in enumerate(pts): f.write(f"{i} {p[0]:.6f} {p[1]:.6f} {p[2]:.6f} 1.0\n")
+
+def arbre_symetrique(results, sujets, rng):
+    """Comme generate_matches.py --symmetric : (A, B) calculée pour A < B, (B, A) servie par liens échangés."""
+    for i, a in enumerate(sujets):
+        for b in sujets[i + 1:]:
+            pts1, pts2 = rng.random((6, 3)), rng.random((6, 3))
+            ecrire_paire(os.path.join(results, a), b, pts1, pts2)
+            src1 = os.path.join(results, a, f"match_{b}.img1.txt")
+            src2 = os.path.join(results, a, f"match_{b}.img2.txt")
+            os.makedirs(os.path.join(results, b), exist_ok=True)
+            lier_atomiquement(src1, os.path.join(results, b, f"match_{a}.img2.txt"))
+            lier_atomiquement(src2, os.path.join(results, b, f"match_{a}.img1.txt"))
+
+def convertir_tout(results, supprimer):
+    convertis = []
+    for cible in sorted(os.listdir(results)):
+        convertis += convert_matches.convertir_cible(os.path.join(results, cible), verifier=supprimer)[2]
+    if supprimer: convert_matches.supprimer_txt(results, convertis)
+
+def test_arbre_symetrique_delete_txt(tmp_path):
+    """Aucune paire perdue : les miroirs sont convertis avant la suppression des fichiers qu'ils visent."""
+    results = str(tmp_path / "results")
+    sujets = [f"sub-A00{i}" for i in range(1, 7)]
+    arbre_symetrique(results, sujets, np.random.default_rng(0))
+    attendu = {}
+    for cible in sujets:
+        for source in sujets:
+            if source == cible: continue
+            f1 = os.path.join(results, cible, f"match_{source}.img1.txt")
+            attendu[(cible, source)] = np.loadtxt(f1, comments='#', usecols=(1, 2, 3))
+
+    convertir_tout(results, supprimer=True)
+
+    for cible in sujets:
+        store = MatchStore(chemin_store(os.path.join(results, cible)))
+        assert sorted(store.sources) == sorted(s for s in sujets if s != cible)
+        for source in store.sources:
+            np.testing.assert_allclose(store.paire(source)[0], attendu[(cible, source)], atol=1e-5)
+    assert not any(f.endswith(".txt") for _, _, noms in os.walk(results) for f in noms)
+
+def test_lien_casse_signale(tmp_path, capsys):
+    results = str(tmp_path / "results")
+    arbre_symetrique(results, ["sub-A001", "sub-A002"], np.random.default_rng(0))
+    os.remove(os.path.join(results, "sub-A001", "match_sub-A002.img1.txt"))
+    n, n_illisibles, _ = convert_matches.convertir_cible(os.path.join(results, "sub-A002"))
+    assert (n, n_illisibles) == (0, 1)
+    assert "Lien miroir cassé" in capsys.readouterr().out
@@ -0,0 +1,34 @@
+import os
+import subprocess
+import sys
+
+import numpy as np
+
+from benchmark.synthetique import ecrire_key
+
+RACINE = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def ecrire_sujet(path, rng, base, n_keypoints=40):
+    coords, descripteurs = base
+    ecrire_key(path, coords[:n_keypoints] + rng.normal(0, 1, (n_keypoints, 3)), rng.uniform(1, 5, n_keypoints),
+               descripteurs[:n_keypoints] + rng.normal(0, 2, (n_keypoints, descripteurs.shape[1])))
+
+def generer(tmp_path, *options):
+    cmd = [sys.executable, os.path.join(RACINE, "generate_matches.py"), "--patients", str(tmp_path / "patients"),
+           "--atlases", str(tmp_path / "atlases"), "--output", str(tmp_path / "out"), "--matcher", "python", *options]
+    subprocess.run(cmd, check=True, cwd=RACINE, stdout=subprocess.DEVNULL)
+
+def test_shard_incremental_recalcule_key_modifie(tmp_path):
+    rng = np.random.default_rng(0)
+    base = rng.uniform(-80, 80, (40, 3)), rng.integers(0, 256, (40, 64)).astype(np.float64)
+    for dossier, prefixe in (("patients", "P"), ("atlases", "A")):
+        os.makedirs(tmp_path / dossier)
+        for i in range(3): ecrire_sujet(tmp_path / dossier / f"sub-{prefixe}00{i}_T1w.key", rng, base)
+    generer(tmp_path, "--shard", "1/1")
+    generer(tmp_path, "--merge")
+
+    sortie = tmp_path / "out" / "sub-P000" / "match_sub-A001.img1.txt"
+    avant = sortie.read_bytes()
+    ecrire_sujet(tmp_path / "atlases" / "sub-A001_T1w.key", rng, base, n_keypoints=20)
+    generer(tmp_path, "--shard", "1/1", "--incremental")
+    assert sortie.read_bytes() != avant
@@ -0,0 +1,27 @@
+from types import SimpleNamespace
+
+import numpy as np
+
+from recalage.index_ann import IndexANN, construire_index, ecrire_index
+
+def keypoints(descripteurs):
+    descripteurs = np.asarray(descripteurs, dtype=np.float32)
+    return SimpleNamespace(descripteurs=descripteurs, coords=np.zeros((len(descripteurs), 3), dtype=np.float32))
+
+def index_test(tmp_path, liste_keypoints):
+    path = str(tmp_path / "atlas.ivfpq")
+    ecrire_index(path, construire_index(liste_keypoints, n_listes=1), [f"atlas{i}" for i in range(len(liste_keypoints))], [])
+    return IndexANN(path)
+
+def test_candidat_seul_rejete(tmp_path):
+    rng = np.random.default_rng(0)
+    base = rng.normal(size=(3, 16)).astype(np.float32) * 10
+    # atlas0 : un seul descripteur (pas de second voisin) ; atlas1 : le bon descripteur et un lointain
+    index = index_test(tmp_path, [keypoints(base[:1]), keypoints(base[1:])])
+    requetes = base[[0, 1]] + 0.01
+
+    for rerank in (True, False):
+        resultat = index.apparier(requetes, 0.8, nprobe=1, rerank=rerank)
+        assert 0 not in resultat
+        q, idx = resultat[1]
+        assert 1 in q and idx[list(q).index(1)] == 0
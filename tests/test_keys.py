@@ -0,0 +1,26 @@
+import os
+
+import numpy as np
+
+from benchmark.synthetique import ecrire_key
+from recalage.keys import charger_key, charger_key_reduit, sous_echantillonner
+
+def ecrire_sujet(path, n_keypoints, rng):
+    ecrire_key(path, rng.uniform(-80, 80, (n_keypoints, 3)), rng.uniform(1, 5, n_keypoints),
+               rng.integers(0, 256, (n_keypoints, 64)).astype(np.float64))
+
+def test_key_reecrit_relu(tmp_path):
+    rng = np.random.default_rng(0)
+    path = str(tmp_path / "sub-P000_T1w.key")
+    ecrire_sujet(path, 30, rng)
+    premier = charger_key(path)
+    assert charger_key(path) is premier
+    charger_key_reduit(path, 10)
+
+    # Nouveau scan au même chemin entre deux requêtes : même taille, seule la date change
+    ecrire_sujet(path, 30, rng)
+    st = os.stat(path)
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 10 ** 9))
+    second = charger_key(path)
+    assert not np.array_equal(second.coords, premier.coords)
+    assert np.array_equal(charger_key_reduit(path, 10).coords, sous_echantillonner(second, 10).coords)
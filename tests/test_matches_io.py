@@ -0,0 +1,21 @@
+import numpy as np
+import pytest
+
+from benchmark.synthetique import ecrire_matches
+from recalage.matches_io import SUFFIXE_CACHE, charger_fichier_matches_robuste
+
+@pytest.mark.parametrize("contenu", [b"", b"PK\x03\x04tronque", None])
+def test_cache_corrompu_reconstruit(tmp_path, contenu):
+    pts = np.random.default_rng(0).uniform(-80, 80, (4, 3))
+    path_img1, path_img2 = str(tmp_path / "match.img1.txt"), str(tmp_path / "match.img2.txt")
+    ecrire_matches(path_img1, path_img2, pts, pts)
+    assert np.allclose(charger_fichier_matches_robuste(path_img1, cache=True), pts)
+
+    path_cache = path_img1 + SUFFIXE_CACHE
+    if contenu is None:
+        # Archive tronquée en cours d'écriture
+        with open(path_cache, 'rb') as f: contenu = f.read()[:-20]
+    with open(path_cache, 'wb') as f: f.write(contenu)
+
+    assert np.allclose(charger_fichier_matches_robuste(path_img1, cache=True), pts)
+    with np.load(path_cache) as z: assert np.allclose(z["pts"], pts)
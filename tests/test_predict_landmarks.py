@@ -0,0 +1,65 @@
+import argparse
+import sys
+import threading
+
+import numpy as np
+import pytest
+
+from predict_landmarks import (ajouter_arguments_prediction, consensus_stable, mettre_a_jour_prior, raffiner_candidats,
+                               verifier_arguments)
+
+@pytest.fixture
+def commutations_frequentes():
+    intervalle = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    yield
+    sys.setswitchinterval(intervalle)
+
+def test_prior_concurrent(commutations_frequentes):
+    prior, verrou = {}, threading.Lock()
+    n_threads, n_patients = 8, 500
+    inliers = [(f"atlas{i}", 10 * (i + 1)) for i in range(4)]
+
+    def patients():
+        for _ in range(n_patients): mettre_a_jour_prior(prior, inliers, verrou)
+
+    threads = [threading.Thread(target=patients) for _ in range(n_threads)]
+    for t in threads: t.start()
+    for t in threads: t.join()
+
+    for atlas_id, n_inliers in inliers:
+        n, moyenne = prior[atlas_id]
+        assert n == n_threads * n_patients
+        assert moyenne == pytest.approx(n_inliers)
+
+def arguments_grossier_fin(*options):
+    parser = argparse.ArgumentParser()
+    ajouter_arguments_prediction(parser)
+    return parser.parse_args(["--atlas_dir", ".", "--matcher", "python", "--coarse_keypoints", "500", *options])
+
+def test_refine_top_inferieur_a_k_refuse():
+    with pytest.raises(SystemExit):
+        verifier_arguments(arguments_grossier_fin("--k", "12", "--refine_top", "5"))
+    verifier_arguments(arguments_grossier_fin("--k", "12", "--refine_top", "0"))
+    verifier_arguments(arguments_grossier_fin("--k", "12", "--refine_top", "20"))
+
+def test_raffinement_echoue_ecarte():
+    # Inliers grossiers élevés (atlas0 en tête) ; la passe fine échoue pour atlas0
+    candidats = [(n, np.full((2, 3), float(i)), f"atlas{i}", None) for i, n in enumerate([90, 80, 70])]
+    fins = {"atlas0": None, "atlas1": 12, "atlas2": 15}
+    job_fin = lambda atlas, mat: ("o", fins[atlas], None if fins[atlas] is None else np.zeros((2, 3)), None)
+    args = argparse.Namespace(refine_top=0, k=3)
+
+    raffines = raffiner_candidats(candidats, job_fin, None, args)
+    assert sorted((c[2], c[0]) for c in raffines) == [("atlas1", 12), ("atlas2", 15)]
+
+    fins.update(atlas1=None, atlas2=None)
+    assert raffiner_candidats(candidats, job_fin, None, args) == candidats
+
+def test_arret_adaptatif_aller_retour():
+    stable = np.zeros((2, 3))
+    ecart = np.array([[5.0, 0, 0], [0, 0, 0]])
+    # Les deux bouts de la fenêtre coïncident, mais le consensus s'est écarté de 5 mm entre-temps
+    assert not consensus_stable([stable, stable, ecart, stable], 3, 1.0)
+    assert consensus_stable([ecart, stable, stable + 0.1, stable], 2, 1.0)
+    assert not consensus_stable([stable, stable], 2, 1.0)
@@ -0,0 +1,43 @@
+import os
+import time
+
+from recalage import sharding
+from recalage.sharding import _chemin_claim, _lire_jeton, _reprendre_perimee, liberer, revendiquer
+
+def vieillir(path, age):
+    os.utime(path, (time.time() - age, time.time() - age))
+
+def test_reprise_tardive_remet_la_revendication_fraiche(tmp_path):
+    dossier = str(tmp_path)
+    path = _chemin_claim(dossier, "sub-P000", "sub-A001")
+    with open(path, 'w') as f: f.write("machine-arretee 0\n")
+    vieillir(path, 100)
+
+    # X reprend la revendication périmée ; Y, qui l'avait vue périmée avant, renomme ensuite celle de X
+    assert revendiquer(dossier, "sub-P000", "sub-A001", claim_ttl=10)
+    jeton_x = _lire_jeton(path)
+    assert not _reprendre_perimee(path, 10, "worker-y")
+    assert _lire_jeton(path) == jeton_x
+    assert not revendiquer(dossier, "sub-P000", "sub-A001", claim_ttl=10)
+    assert os.listdir(dossier) == [os.path.basename(path)]
+
+    liberer(dossier, "sub-P000", "sub-A001")
+    assert not os.path.exists(path)
+
+def test_battement_job_long(tmp_path, monkeypatch):
+    dossier = str(tmp_path)
+    monkeypatch.setattr(sharding, "_battement", {"pid": None, "periode": None})
+    assert revendiquer(dossier, "sub-P000", "sub-A002", claim_ttl=0.4)
+    time.sleep(0.8)
+    # Plus vieux que claim_ttl depuis sa création, mais rafraîchie : non reprise
+    assert not revendiquer(dossier, "sub-P000", "sub-A002", claim_ttl=0.4)
+    liberer(dossier, "sub-P000", "sub-A002")
+
+def test_liberer_ne_supprime_que_sa_revendication(tmp_path):
+    dossier = str(tmp_path)
+    path = _chemin_claim(dossier, "sub-P000", "sub-A003")
+    assert revendiquer(dossier, "sub-P000", "sub-A003", claim_ttl=10)
+    # Reprise par un autre worker (revendication écrasée)
+    with open(path, 'w') as f: f.write("autre-worker 0\n")
+    liberer(dossier, "sub-P000", "sub-A003")
+    assert _lire_jeton(path) == "autre-worker"
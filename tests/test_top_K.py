@@ -0,0 +1,37 @@
+import argparse
+import os
+
+import numpy as np
+
+import top_K
+from recalage.gt import SUFFIXE_GT_ATLAS, save_fcsv
+
+def args_analyse(tmp_path, incremental):
+    return argparse.Namespace(results=str(tmp_path / "matches"), gt_target=str(tmp_path / "gt"),
+                              gt_source=str(tmp_path / "gt"), output_dir=str(tmp_path / "out"),
+                              incremental=incremental, min_samples=5, threshold=10.0, ransac="numpy",
+                              cache=False, transform_cache=None, transform_cache_size=1.0,
+                              transform_cache_masks=False)
+
+def test_cible_sans_paire(tmp_path):
+    """Une cible sans candidat est un ÉCHEC (None), pas une exception, avec ou sans --incremental."""
+    os.makedirs(tmp_path / "matches" / "sub-P001")
+    os.makedirs(tmp_path / "gt")
+    save_fcsv(str(tmp_path / "gt" / f"sub-P001{SUFFIXE_GT_ATLAS}.fcsv"), np.zeros((32, 3)))
+
+    for incremental in (False, True):
+        args = args_analyse(tmp_path, incremental)
+        assert top_K.analyser_patient_tous_k("sub-P001", args) is None
+
+    # Seul --incremental écrit l'état, avec un tableau de prédictions vide bien formé
+    with np.load(top_K.chemin_etat(args, "sub-P001")) as z:
+        assert z["predictions"].shape == (0, 32, 3)
+    assert top_K.charger_etat(top_K.chemin_etat(args, "sub-P001"), top_K.parametres_analyse(args)) == ([], {})
+
+def test_etat_non_ecrit_sans_incremental(tmp_path):
+    os.makedirs(tmp_path / "matches" / "sub-P001")
+    os.makedirs(tmp_path / "gt")
+    save_fcsv(str(tmp_path / "gt" / f"sub-P001{SUFFIXE_GT_ATLAS}.fcsv"), np.zeros((32, 3)))
+    args = args_analyse(tmp_path, incremental=False)
+    top_K.analyser_patient_tous_k("sub-P001", args)
+    assert not os.path.exists(top_K.chemin_etat(args, "sub-P001"))
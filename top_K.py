@@ -1,130 +1,453 @@
 import numpy as np
 import os
 import glob
+import heapq
+import json
 import argparse
-from sklearn.linear_model import RANSACRegressor
-import matplotlib.pyplot as plt
+from concurrent.futures import ProcessPoolExecutor
 
-# --- CONFIGURATION ---
-SUFFIXE_GT_BASE = "_space-T1w_desc-groundtruth_afids"
+from recalage import profiling
+from recalage.cache_transformations import TAILLE_MAX_MO, affine_en_cache, balayer_en_cache, fermer_caches, ouvrir_cache
+from recalage.gt import identifiants_atlas, trouver_gt, trouver_key
+from recalage.keys import lire_fichier_key
+from recalage.match_store import MatchStore, chemin_store
+from recalage.matches_io import charger_fichier_matches_robuste
+from recalage.prescreening import classer_atlas, signatures_atlas
+from recalage.reduction import identifiant_liste, lire_liste_atlas
+from recalage.statistiques import StatistiquesCourantes
 
-# --- FONCTIONS ROBUSTES ---
-def charger_fichier_matches_robuste(path):
-    try:
-        data = []
-        with open(path, 'r') as f: lines = f.readlines()
-        offset = -1
-        for line in lines:
-            if line.startswith('#'): continue
-            parts = line.split()
-            # Recherche heuristique du début des données numériques
-            for i in range(1, len(parts)-2):
-                try:
-                    if float(parts[i]) and float(parts[i+1]) and float(parts[i+2]):
-                        offset = i; break
-                except: continue
-            if offset != -1: break
-        if offset == -1: return None 
-        for line in lines:
-            if line.startswith('#'): continue
-            parts = line.split()
-            if len(parts) < offset + 3: continue
-            try: data.append([float(parts[offset]), float(parts[offset+1]), float(parts[offset+2])])
-            except: continue
-        return np.array(data)
-    except: return None
-
-def trouver_gt(dossier, nom_sujet):
-    # Nettoyage
-    nom_clean = nom_sujet.replace("_T1w", "").replace(".nii", "").replace(".gz", "")
-    noms = [nom_clean]
-    if nom_clean.startswith("sub-"): noms.append(nom_clean.replace("sub-", ""))
-    else: noms.append(f"sub-{nom_clean}")
-    
-    for n in noms:
-        # Priorité .fcsv
-        p1 = os.path.join(dossier, f"{n}{SUFFIXE_GT_BASE}.fcsv")
-        if os.path.exists(p1): return np.loadtxt(p1, delimiter=',', comments='#', usecols=(1, 2, 3))
-        # Fallback .csv
-        p2 = os.path.join(dossier, f"{n}{SUFFIXE_GT_BASE}.csv")
-        if os.path.exists(p2): return np.loadtxt(p2, delimiter=',', comments='#', usecols=(1, 2, 3))
-        # Fallback court
-        p3 = os.path.join(dossier, f"{n}.fcsv")
-        if os.path.exists(p3): return np.loadtxt(p3, delimiter=',', comments='#', usecols=(1, 2, 3))
-    return None
-
-def calculer_affine_ransac(pts_src, pts_dst, min_samples=5, residual_threshold=15.0):
-    ransac = RANSACRegressor(min_samples=min_samples, residual_threshold=residual_threshold, random_state=42)
-    try:
-        ransac.fit(pts_src, pts_dst)
-        nb_inliers = np.sum(ransac.inlier_mask_)
-        if nb_inliers < min_samples: return None, 0
-        src_in = pts_src[ransac.inlier_mask_]; dst_in = pts_dst[ransac.inlier_mask_]
-        col_un = np.ones((len(src_in), 1)); A = np.hstack([src_in, col_un])
-        solution, _, _, _ = np.linalg.lstsq(A, dst_in, rcond=None)
-        return solution.T, nb_inliers
-    except: return None, 0
+K_MAX = 30
+DOSSIER_ETAT = "candidats_topk"
 
 # --- CŒUR DU CALCUL ---
-def analyser_patient_tous_k(nom_dossier_cible, args):
-    # 1. GT Cible
-    gt_cible = trouver_gt(args.gt_target, nom_dossier_cible)
-    if gt_cible is None: return None
+def nom_source_txt(f_img1):
+    # Ex: match_sub-0086_T1w.img1.txt -> sub-0086
+    return os.path.basename(f_img1).replace("match_", "").replace(".img1.txt", "").replace("_T1w", "")
 
-    # 2. Matches
+def charger_paires(nom_dossier_cible, args, ignorer=()):
+    """Paires exploitables d'une cible : liste de (nom_source, p_a, p_b, gt_source), par nom de source.
+    ignorer : sources déjà traitées (mode incrémental), ni lues ni renvoyées."""
     path_matches = os.path.join(args.results, nom_dossier_cible)
-    fichiers = glob.glob(os.path.join(path_matches, "match_*.img1.txt"))
-    if not fichiers: return None
+    if os.path.exists(chemin_store(path_matches)):
+        return charger_paires_store(path_matches, args, ignorer)
+    fichiers = sorted(glob.glob(os.path.join(path_matches, "match_*.img1.txt")))
 
-    candidats = [] 
-    
+    paires = []
     for f_img1 in fichiers:
         f_img2 = f_img1.replace(".img1.txt", ".img2.txt")
         if not os.path.exists(f_img2): continue
 
-        base = os.path.basename(f_img1)
-        # Ex: match_sub-0086_T1w.img1.txt -> sub-0086
-        nom_source_raw = base.replace("match_", "").replace(".img1.txt", "").replace("_T1w", "")
+        nom_source_raw = nom_source_txt(f_img1)
+        if nom_source_raw in ignorer: continue
         
-        gt_source = trouver_gt(args.gt_source, nom_source_raw)
-        if gt_source is None: continue
+        with profiling.contexte(atlas=nom_source_raw):
+            with profiling.etape("gt"):
+                gt_source = trouver_gt(args.gt_source, nom_source_raw)
+            if gt_source is None: continue
+
+            with profiling.etape("lecture_matches"):
+                p_a = charger_fichier_matches_robuste(f_img1, cache=args.cache)
+                p_b = charger_fichier_matches_robuste(f_img2, cache=args.cache)
+        if p_a is None or p_b is None: continue
+        paires.append((nom_source_raw, p_a, p_b, gt_source))
+    return paires
+
+def charger_paires_store(path_matches, args, ignorer=()):
+    """Même résultat que charger_paires, lu depuis le store columnaire de la cible (--format store)."""
+    store = MatchStore(chemin_store(path_matches))
+    paires = []
+    for source_id in store.sources:
+        nom_source_raw = source_id.replace("_T1w", "")
+        if nom_source_raw in ignorer: continue
+        with profiling.contexte(atlas=nom_source_raw):
+            with profiling.etape("gt"):
+                gt_source = trouver_gt(args.gt_source, nom_source_raw)
+            if gt_source is None: continue
+
+            with profiling.etape("lecture_matches"):
+                p_a, p_b = store.paire(source_id)
+        # Sortie vide de featMatchMultiple : ignorée comme un fichier texte illisible
+        if len(p_a) == 0: continue
+        paires.append((nom_source_raw, p_a, p_b, gt_source))
+    return paires
+
+def empreintes_sources(nom_dossier_cible, args):
+    """{nom_source: empreinte} des matches d'une cible : taille/date des fichiers texte, hash du contenu pour un store."""
+    path_matches = os.path.join(args.results, nom_dossier_cible)
+    if os.path.exists(chemin_store(path_matches)):
+        store = MatchStore(chemin_store(path_matches))
+        return {s.replace("_T1w", ""): store.empreinte(s) for s in store.sources}
+    empreintes = {}
+    for f_img1 in glob.glob(os.path.join(path_matches, "match_*.img1.txt")):
+        try:
+            st1, st2 = os.stat(f_img1), os.stat(f_img1.replace(".img1.txt", ".img2.txt"))
+        except OSError:
+            continue
+        empreintes[nom_source_txt(f_img1)] = f"{st1.st_size}:{st1.st_mtime_ns}:{st2.st_size}:{st2.st_mtime_ns}"
+    return empreintes
+
+# --- ÉTAT INCRÉMENTAL : Top-K_MAX de chaque patient et sources déjà traitées ---
+def parametres_analyse(args):
+    return json.dumps({"min_samples": args.min_samples, "threshold": args.threshold, "ransac": args.ransac}, sort_keys=True)
+
+def chemin_etat(args, nom_dossier_cible):
+    return os.path.join(args.output_dir, DOSSIER_ETAT, f"{nom_dossier_cible}.npz")
+
+def charger_etat(path, parametres):
+    """(candidats [(score, pred, source)] triés, {source vue: empreinte}), ou None si absent ou paramètres différents."""
+    if not os.path.exists(path): return None
+    try:
+        with np.load(path) as z:
+            if str(z["parametres"]) != parametres: return None
+            candidats = [(s, p, str(n)) for s, p, n in zip(z["scores"].tolist(), z["predictions"], z["sources"])]
+            return candidats, dict(zip(z["vues"].tolist(), z["empreintes"].tolist()))
+    except (OSError, ValueError, KeyError):
+        return None
 
-        p_a = charger_fichier_matches_robuste(f_img1)
-        p_b = charger_fichier_matches_robuste(f_img2)
-        if p_a is None or p_b is None or len(p_a) < args.min_samples: continue
+def sauver_etat(path, candidats, vues, parametres, n_landmarks):
+    """Écriture atomique de l'état d'une cible ; sans candidat, predictions vaut (0, n_landmarks, 3)."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    noms_vues = sorted(vues)
+    with open(tmp, 'wb') as f:
+        np.savez(f, scores=np.array([c[0] for c in candidats], dtype=np.float64),
+                 predictions=np.array([c[1] for c in candidats], dtype=np.float64).reshape(len(candidats), n_landmarks, 3),
+                 sources=np.array([c[2] for c in candidats], dtype=str),
+                 vues=np.array(noms_vues, dtype=str), empreintes=np.array([vues[n] for n in noms_vues], dtype=str),
+                 parametres=np.array(parametres))
+    os.replace(tmp, path)
 
+def cle_candidat(c):
+    """Score décroissant, puis nom de source : même ordre en calcul complet et en fusion incrémentale."""
+    return (-c[0], c[2])
+
+def cache_args(args):
+    """Cache des transformations (--transform_cache), None s'il est désactivé."""
+    return ouvrir_cache(args.transform_cache, args.transform_cache_size, args.transform_cache_masks)
+
+def projeter_landmarks(gt_source, mat):
+    """On projette les landmarks de l'atlas vers le patient."""
+    lm_homog = np.hstack([gt_source, np.ones((len(gt_source), 1))])
+    return np.dot(lm_homog, mat.T)
+
+def erreurs_k_landmarks(preds_triees, gt_cible):
+    """
+    Erreur (mm) de chaque landmark pour la médiane des k meilleurs candidats, k = 1..min(n, K_MAX),
+    en une passe : matrice (K, N_landmarks).
+    Les préfixes sont empilés (complétés par NaN) puis triés le long de l'axe des atlas ;
+    la médiane de chaque préfixe se lit aux rangs (k-1)//2 et k//2, comme np.median.
+    """
+    preds = np.asarray(preds_triees[:K_MAX], dtype=np.float64) # (n, L, 3)
+    n = len(preds)
+    prefixes = np.where(np.tri(n, dtype=bool)[:, :, None, None], preds[None], np.nan) # (k, n, L, 3)
+    prefixes.sort(axis=1) # NaN en fin de ligne
+    k = np.arange(n)
+    medianes = (prefixes[k, k // 2] + prefixes[k, (k + 1) // 2]) / 2
+    return np.sqrt(np.sum((medianes - gt_cible) ** 2, axis=2))
+
+def erreurs_tous_k(candidats, gt_cible):
+    """TRE moyenne de la médiane des k meilleurs candidats (score décroissant), pour k = 1..K_MAX."""
+    candidats.sort(key=lambda x: x[0], reverse=True)
+    return list(erreurs_k_landmarks([c[1] for c in candidats], gt_cible).mean(axis=1))
+
+def analyser_patient_tous_k(nom_dossier_cible, args):
+    # 1. GT Cible
+    gt_cible = trouver_gt(args.gt_target, nom_dossier_cible)
+    if gt_cible is None: return None
+
+    # 2. Candidats déjà calculés (Top-K_MAX enregistré) : seules les sources nouvelles ou modifiées sont relues
+    path_etat = chemin_etat(args, nom_dossier_cible)
+    parametres = parametres_analyse(args)
+    empreintes = empreintes_sources(nom_dossier_cible, args)
+    etat = charger_etat(path_etat, parametres) if args.incremental else None
+    existants, vues = [], {}
+    if etat is not None:
+        existants, vues = etat
+        # Un candidat du Top-K_MAX disparu ou recalculé : le suivant n'a pas été conservé, calcul complet
+        if any(vues.get(c[2]) != empreintes.get(c[2]) for c in existants):
+            existants, vues = [], {}
+        vues = {n: e for n, e in vues.items() if empreintes.get(n) == e}
+
+    # 3. Matches
+    paires = charger_paires(nom_dossier_cible, args, ignorer=vues)
+
+    nouveaux = []
+    for nom_source, p_a, p_b, gt_source in paires:
+        vues[nom_source] = empreintes.get(nom_source, "")
+        if len(p_a) < args.min_samples: continue
         try:
             # Cas 2 (p_b -> p_a) : On calcule la transfo
-            mat, score = calculer_affine_ransac(p_b, p_a, min_samples=args.min_samples, residual_threshold=args.threshold)
+            with profiling.contexte(atlas=nom_source), profiling.etape("ransac"):
+                mat, score = affine_en_cache(cache_args(args), p_b, p_a, min_samples=args.min_samples, threshold=args.threshold, backend=args.ransac)
             
             if mat is not None:
-                # On projette les landmarks de l'atlas vers le patient
-                lm_homog = np.hstack([gt_source, np.ones((len(gt_source), 1))])
-                pred = np.dot(lm_homog, mat.T)
-                candidats.append((score, pred))
+                nouveaux.append((score, projeter_landmarks(gt_source, mat), nom_source))
         except: continue
 
+    # Fusion des nouveaux candidats dans la liste triée ; seuls les K_MAX premiers servent
+    candidats = list(heapq.merge(existants, sorted(nouveaux, key=cle_candidat), key=cle_candidat))[:K_MAX]
+    if args.incremental and (etat is None or paires):
+        with profiling.etape("etat"):
+            sauver_etat(path_etat, candidats, vues, parametres, len(gt_cible))
     if not candidats: return None
 
-    # 3. Calcul progressif K
-    candidats.sort(key=lambda x: x[0], reverse=True)
-    preds_triees = [c[1] for c in candidats]
-    
-    erreurs_par_k = []
-    max_k = min(len(preds_triees), 30)
-    
-    for k in range(1, max_k + 1):
-        subset = np.array(preds_triees[:k])
-        # Médiane robuste
-        pred_mediane = np.median(subset, axis=0)
-        
-        diff = pred_mediane - gt_cible
-        tre = np.mean(np.sqrt(np.sum(diff**2, axis=1)))
-        erreurs_par_k.append(tre)
-        
-    return erreurs_par_k
+    # 4. Erreurs (K x landmark)
+    with profiling.etape("fusion_k"):
+        return erreurs_k_landmarks([c[1] for c in candidats], gt_cible)
 
-def main():
+def balayer_patient(nom_dossier_cible, args, seuils, liste_min_samples):
+    """
+    Mode balayage : les matches de chaque paire sont chargés une seule fois, et pour chaque
+    min_samples les hypothèses RANSAC sont partagées entre tous les seuils.
+    Retourne {(seuil, min_samples): erreurs_par_k}.
+    """
+    gt_cible = trouver_gt(args.gt_target, nom_dossier_cible)
+    if gt_cible is None: return None
+
+    paires = charger_paires(nom_dossier_cible, args)
+    if not paires: return None
+
+    candidats = {(t, m): [] for t in seuils for m in liste_min_samples}
+    for nom_source, p_a, p_b, gt_source in paires:
+        for m in liste_min_samples:
+            if len(p_a) < m: continue
+            try:
+                with profiling.contexte(atlas=nom_source), profiling.etape("ransac"):
+                    resultats = balayer_en_cache(cache_args(args), p_b, p_a, m, seuils)
+            except (ValueError, np.linalg.LinAlgError):
+                continue
+            for t, (mat, score, _) in resultats.items():
+                if mat is not None:
+                    candidats[(t, m)].append((score, projeter_landmarks(gt_source, mat)))
+
+    return {cle: erreurs_tous_k(c, gt_cible) for cle, c in candidats.items() if c}
+
+def candidats_identifies(nom_dossier_cible, args):
+    """Tous les candidats d'une cible : [(score, landmarks projetés, identifiant sub-XXXX de l'atlas)]."""
+    candidats = []
+    for nom_source, p_a, p_b, gt_source in charger_paires(nom_dossier_cible, args):
+        if len(p_a) < args.min_samples: continue
+        with profiling.contexte(atlas=nom_source), profiling.etape("ransac"):
+            mat, score = affine_en_cache(cache_args(args), p_b, p_a, min_samples=args.min_samples, threshold=args.threshold, backend=args.ransac)
+        if mat is not None:
+            candidats.append((score, projeter_landmarks(gt_source, mat), identifiant_liste(nom_source)))
+    return candidats
+
+def evaluer_reduction(nom_dossier_cible, args, rangs, tailles):
+    """
+    Compromis taille / précision d'une base réduite (reduce_atlases.py) : pour chaque taille n, Top-K
+    restreint aux n premiers atlas de l'ordre glouton (rangs : {atlas: rang}).
+    Retourne {taille: erreurs_par_k} (taille 0 = tous les atlas appariés), ou None.
+    """
+    gt_cible = trouver_gt(args.gt_target, nom_dossier_cible)
+    if gt_cible is None: return None
+    candidats = candidats_identifies(nom_dossier_cible, args)
+    if not candidats: return None
+
+    resultats = {0: erreurs_tous_k([c[:2] for c in candidats], gt_cible)}
+    for n in tailles:
+        restants = [c[:2] for c in candidats if rangs.get(c[2], n) < n]
+        if restants: resultats[n] = erreurs_tous_k(restants, gt_cible)
+    return resultats
+
+def evaluer_prescreening(nom_dossier_cible, args, prescreening):
+    """
+    Compare la pré-sélection par signature globale au Top-K complet (par inliers) d'une cible.
+    Retourne (rappel, tre_complet, tre_preselection, n_atlas) ou None.
+    """
+    gt_cible = trouver_gt(args.gt_target, nom_dossier_cible)
+    key_cible = trouver_key(args.keys_target, nom_dossier_cible)
+    if gt_cible is None or key_cible is None: return None
+
+    ids_sources, codebook, idf, sigs = prescreening
+    index_sources = {id_: i for i, id_ in enumerate(ids_sources)}
+
+    candidats = [c for c in candidats_identifies(nom_dossier_cible, args) if c[2] in index_sources]
+    if not candidats: return None
+
+    # Signatures restreintes aux atlas effectivement appariés avec cette cible
+    ids_candidats = [c[2] for c in candidats]
+    lignes = [index_sources[i] for i in ids_candidats]
+    ordre, _ = classer_atlas(lire_fichier_key(key_cible).descripteurs, codebook, idf, sigs[lignes])
+    preselection = {ids_candidats[j] for j in ordre[:args.prescreen]}
+
+    k = min(args.prescreen_k, len(candidats))
+    top_k_complet = {c[2] for c in sorted(candidats, key=lambda x: x[0], reverse=True)[:k]}
+    rappel = len(top_k_complet & preselection) / float(k)
+
+    tre_complet = erreurs_tous_k([c[:2] for c in candidats], gt_cible)[k - 1]
+    restants = [c[:2] for c in candidats if c[2] in preselection]
+    erreurs_pre = erreurs_tous_k(restants, gt_cible)
+    tre_pre = erreurs_pre[min(k, len(erreurs_pre)) - 1]
+    return rappel, tre_complet, tre_pre, len(candidats)
+
+def traiter_patient(tache):
+    """Exécute fonction(patient, args, *extra) sous le contexte de profilage du patient (processus courant ou worker)."""
+    fonction, p, args, extra = tache
+    with profiling.contexte(patient=p), profiling.etape("patient"):
+        return fonction(p, args, *extra)
+
+def executer_patients(fonction, patients, args, *extra):
+    """
+    Itérateur des résultats de fonction(p, args, *extra), TOUJOURS dans l'ordre de patients.
+    Avec --jobs N > 1, les patients sont répartis par paquets (--chunksize) sur un pool de processus ;
+    executor.map rend les résultats dans l'ordre de soumission, la réduction (CSV, Welford) est donc
+    faite dans le même ordre qu'en séquentiel. RANSAC étant graine fixe à chaque appel, les sorties
+    sont identiques octet pour octet.
+    """
+    taches = ((fonction, p, args, extra) for p in patients)
+    if args.jobs <= 1:
+        yield from map(traiter_patient, taches)
+        return
+    taille_paquet = args.chunksize or max(1, len(patients) // (4 * args.jobs))
+    with ProcessPoolExecutor(max_workers=args.jobs, initializer=profiling.activer,
+                             initargs=(os.path.abspath(args.profile) if args.profile else None,)) as executor:
+        yield from executor.map(traiter_patient, taches, chunksize=taille_paquet)
+
+def main_prescreening(args, patients):
+    sources = sorted(glob.glob(os.path.join(args.keys_source, "*.key")))
+    if not sources:
+        print(f"Erreur: aucun .key source dans {args.keys_source}"); return
+    print(f"Pré-sélection : signatures de {len(sources)} atlas (M={args.prescreen}, K={args.prescreen_k})...")
+    codebook, idf, sigs = signatures_atlas([lire_fichier_key(p).descripteurs for p in sources])
+    prescreening = ([identifiants_atlas(p)[1] for p in sources], codebook, idf, sigs)
+
+    path_csv = os.path.join(args.output_dir, args.name_prescreen_csv)
+    resultats = []
+    with open(path_csv, 'w') as f:
+        f.write("patient,recall,TRE_full,TRE_prescreen,n_atlas\n")
+        resultats_patients = executer_patients(evaluer_prescreening, patients, args, prescreening)
+        for i, p in enumerate(patients):
+            print(f"[{i+1}] {p}...", end="", flush=True)
+            res = next(resultats_patients)
+            if res is None:
+                print(" ÉCHEC"); continue
+            f.write(f"{p},{res[0]:.4f},{res[1]:.4f},{res[2]:.4f},{res[3]}\n")
+            resultats.append(res)
+            print(f" rappel={res[0]:.2f}")
+
+    print(f"\nDonnées sauvegardées : {path_csv}")
+    if not resultats: return
+    r = np.array(resultats)
+    print("\n" + "="*40)
+    print(f"PRÉ-SÉLECTION M={args.prescreen} vs TOP-K COMPLET (K={args.prescreen_k}) :")
+    print(f"Rappel moyen du Top-K : {r[:, 0].mean():.3f}")
+    print(f"TRE complet           : {r[:, 1].mean():.4f} mm")
+    print(f"TRE pré-sélection     : {r[:, 2].mean():.4f} mm")
+    print(f"Atlas appariés        : {args.prescreen} / {r[:, 3].mean():.0f} en moyenne")
+    print("="*40 + "\n")
+
+def main_reduction(args, patients):
+    ordre = lire_liste_atlas(args.atlas_order)
+    rangs = {atlas_id: i for i, atlas_id in enumerate(ordre)}
+    tailles = sorted({min(n, len(ordre)) for n in args.atlas_sizes} if args.atlas_sizes
+                     else {max(1, int(len(ordre) * f)) for f in (0.1, 0.25, 0.5, 0.75)} | {len(ordre)})
+    print(f"Réduction : {len(ordre)} atlas ordonnés ({args.atlas_order}), tailles {tailles}")
+
+    path_csv = os.path.join(args.output_dir, args.name_reduction_csv)
+    par_taille = {} # {taille: {K: [TRE des patients]}}
+    with open(path_csv, 'w') as f:
+        f.write("size,K,patient,TRE\n")
+        resultats = executer_patients(evaluer_reduction, patients, args, rangs, tailles)
+        for i, p in enumerate(patients):
+            print(f"[{i+1}] {p}...", end="", flush=True)
+            res = next(resultats)
+            if res is None:
+                print(" ÉCHEC"); continue
+            for n, erreurs in sorted(res.items()):
+                for k_idx, err in enumerate(erreurs):
+                    f.write(f"{n if n else 'all'},{k_idx + 1},{p},{err:.4f}\n")
+                    par_taille.setdefault(n, {}).setdefault(k_idx + 1, []).append(err)
+            print(" OK")
+
+    print(f"\nDonnées sauvegardées : {path_csv}")
+    if 0 not in par_taille: return
+    # Par taille : meilleur K (TRE moyenne sur les patients), comparé à la base complète
+    print("\n" + "="*40)
+    print(f"{'atlas':>7}{'K':>5}{'TRE_mm':>10}{'écart_mm':>10}{'patients':>10}")
+    ref = min(np.mean(v) for v in par_taille[0].values())
+    for n in sorted(par_taille, key=lambda n: (n == 0, n)):
+        k, vals = min(par_taille[n].items(), key=lambda kv: np.mean(kv[1]))
+        print(f"{n if n else 'tous':>7}{k:>5}{np.mean(vals):>10.4f}{np.mean(vals) - ref:>+10.4f}{len(vals):>10}")
+    print("="*40 + "\n")
+
+def liste_nombres(type_):
+    """Convertisseur argparse pour les grilles : "8,10,12" -> [8.0, 10.0, 12.0]."""
+    return lambda texte: [type_(v) for v in texte.split(",") if v.strip()]
+
+def main_balayage(args, patients):
+    seuils = args.sweep_thresholds or [args.threshold]
+    liste_min_samples = args.sweep_min_samples or [args.min_samples]
+    print(f"Balayage : seuils={seuils} x min_samples={liste_min_samples}")
+
+    path_csv = os.path.join(args.output_dir, args.name_sweep_csv)
+    moyennes = {}
+    with open(path_csv, 'w') as f:
+        f.write("threshold,min_samples,K,patient,TRE\n")
+        resultats = executer_patients(balayer_patient, patients, args, seuils, liste_min_samples)
+        for i, p in enumerate(patients):
+            print(f"[{i+1}] {p}...", end="", flush=True)
+            res = next(resultats)
+            if not res:
+                print(" ÉCHEC"); continue
+            for (t, m), erreurs in sorted(res.items()):
+                for k_idx, err in enumerate(erreurs):
+                    f.write(f"{t:g},{m},{k_idx + 1},{p},{err:.4f}\n")
+                    moyennes.setdefault((t, m, k_idx + 1), []).append(err)
+            print(" OK")
+
+    print(f"\nDonnées sauvegardées : {path_csv}")
+    if not moyennes: return
+    (t, m, k), vals = min(moyennes.items(), key=lambda kv: np.mean(kv[1]))
+    print("\n" + "="*40)
+    print(f"MEILLEURE COMBINAISON : threshold={t:g}, min_samples={m}, K={k}")
+    print(f"Moyenne    : {np.mean(vals):.4f} mm ({len(vals)} patients)")
+    print("="*40 + "\n")
+
+def tracer_courbe_k(path_png, k_axis, means, stds, best_k, min_err, best_std):
+    import matplotlib
+    matplotlib.use("Agg") # pas d'affichage : évite la détection d'un backend graphique
+    import matplotlib.pyplot as plt
+
+    plt.figure(figsize=(10, 6))
+    plt.plot(k_axis, means, marker='o', color='#e67e22', label='Erreur Moyenne')
+    plt.fill_between(k_axis, np.array(means)-np.array(stds), np.array(means)+np.array(stds), color='#e67e22', alpha=0.1, label='Écart-type')
+
+    plt.plot(best_k, min_err, marker='*', color='gold', markersize=15, markeredgecolor='black', 
+                label=f'Min: {min_err:.2f}mm (std: {best_std:.2f}) (K={best_k})')
+
+    plt.title(f"Influence de K") 
+    plt.xlabel("K (Nombre d'atlas utilisés)")
+    plt.ylabel("Erreur Moyenne (mm)")
+    plt.legend()
+    plt.grid(True, linestyle='--', alpha=0.6)
+
+    plt.savefig(path_png)
+    plt.close()
+
+def tracer_courbes_landmarks(path_png, k_axis, moyennes, best_k):
+    """Une courbe TRE(K) par landmark ; moyennes (K, N_landmarks)."""
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+
+    plt.figure(figsize=(10, 6))
+    couleurs = plt.cm.viridis(np.linspace(0, 1, moyennes.shape[1]))
+    for l in range(moyennes.shape[1]):
+        plt.plot(k_axis, moyennes[:, l], color=couleurs[l], alpha=0.7, linewidth=1, label=f"L{l + 1}")
+    plt.plot(k_axis, moyennes.mean(axis=1), color='black', linewidth=2.5, label='Moyenne')
+    plt.axvline(best_k, color='gold', linestyle='--')
+
+    plt.title("Influence de K par landmark")
+    plt.xlabel("K (Nombre d'atlas utilisés)")
+    plt.ylabel("Erreur Moyenne (mm)")
+    plt.legend(ncol=4, fontsize=6)
+    plt.grid(True, linestyle='--', alpha=0.6)
+
+    plt.savefig(path_png)
+    plt.close()
+
+def parse_arguments():
     parser = argparse.ArgumentParser(description="Analyse K Influence")
     
     # Arguments Obligatoires
@@ -136,12 +459,66 @@ def main():
     parser.add_argument("--output_dir", default=".", help="Dossier de sauvegarde (défaut: courant)")
     parser.add_argument("--name_png", default="courbe_K_test.png", help="Nom du fichier PNG")
     parser.add_argument("--name_csv", default="stats_K.csv", help="Nom du fichier CSV")
+    parser.add_argument("--name_landmarks_csv", default="stats_K_landmarks.csv", help="CSV des courbes TRE(K) par landmark")
+    parser.add_argument("--name_patients_csv", default="tre_K_patients.csv",
+                        help="CSV écrit au fil de l'eau : une ligne par (patient, K), TRE et erreur de chaque landmark")
+    parser.add_argument("--no_plot", dest="plot", action="store_false",
+                        help="CSV uniquement : pas de courbe, matplotlib n'est jamais importé")
 
     # Arguments Paramètres
     parser.add_argument("--min_samples", type=int, default=10)
     parser.add_argument("--threshold", type=float, default=12)
-    
-    args = parser.parse_args()
+    parser.add_argument("--ransac", choices=["numpy", "sklearn"], default="numpy",
+                        help="Moteur RANSAC : batché NumPy (défaut) ou RANSACRegressor de sklearn (référence)")
+
+    # Balayage de paramètres (remplace l'analyse simple si une grille est fournie)
+    parser.add_argument("--sweep_thresholds", type=liste_nombres(float),
+                        help="Grille de seuils RANSAC, ex: 8,10,12,15")
+    parser.add_argument("--sweep_min_samples", type=liste_nombres(int),
+                        help="Grille de min_samples, ex: 5,10")
+    parser.add_argument("--name_sweep_csv", default="sweep_TRE.csv",
+                        help="CSV du balayage (threshold,min_samples,K,patient,TRE)")
+
+    # Évaluation de la pré-sélection par signature globale
+    parser.add_argument("--prescreen", type=int, default=0,
+                        help="Évalue la pré-sélection des M atlas les plus similaires contre le Top-K complet (0 = désactivé)")
+    parser.add_argument("--prescreen_k", type=int, default=12, help="K de référence pour l'évaluation de la pré-sélection")
+    parser.add_argument("--keys_target", help="Dossier des .key des cibles (défaut: gt_target)")
+    parser.add_argument("--keys_source", help="Dossier des .key des atlas (défaut: gt_source)")
+    parser.add_argument("--name_prescreen_csv", default="prescreen.csv", help="CSV de l'évaluation de la pré-sélection")
+
+    # Compromis taille / précision d'une base d'atlas réduite (reduce_atlases.py)
+    parser.add_argument("--atlas_order", help="Ordre glouton des atlas (reduce_atlases.py) : évalue le Top-K restreint aux N premiers")
+    parser.add_argument("--atlas_sizes", type=liste_nombres(int),
+                        help="Tailles N évaluées, ex: 25,50,100 (défaut : 10, 25, 50, 75 et 100 %% de la liste)")
+    parser.add_argument("--name_reduction_csv", default="reduction_TRE.csv", help="CSV du compromis taille / précision")
+
+    # Arguments Performance
+    parser.add_argument("--no_cache", dest="cache", action="store_false",
+                        help="Désactive le cache binaire (.cache.npz) des fichiers de matches")
+    parser.add_argument("--transform_cache", help="Cache SQLite des transformations RANSAC (clé : hash des matches + paramètres), partagé avec predict_landmarks.py")
+    parser.add_argument("--transform_cache_size", type=float, default=TAILLE_MAX_MO, help="Taille maximale du cache (Mo), éviction LRU")
+    parser.add_argument("--transform_cache_masks", action="store_true", help="Conserve aussi les masques d'inliers dans le cache")
+    parser.add_argument("--jobs", type=int, default=1,
+                        help="Nombre de processus analysant les patients en parallèle (résultats identiques au séquentiel)")
+    parser.add_argument("--chunksize", type=int, default=0,
+                        help="Patients envoyés par paquet à chaque processus (défaut : patients / (4 x jobs))")
+    parser.add_argument("--incremental", action="store_true",
+                        help=f"Reprend le Top-{K_MAX} enregistré de chaque patient (<output_dir>/{DOSSIER_ETAT}) et n'y fusionne que les atlas nouveaux ou modifiés")
+    parser.add_argument("--profile", help="Trace JSON-lines des temps par étape et par paire ; récapitulatif dans <trace>_summary.txt")
+    return parser.parse_args()
+
+def main():
+    args = parse_arguments()
+    profiling.activer(os.path.abspath(args.profile) if args.profile else None)
+    try:
+        analyser(args)
+    finally:
+        fermer_caches()
+        recapitulatif = profiling.terminer()
+        if recapitulatif: print(f"\n=== PROFIL ({args.profile}) ===\n{recapitulatif}")
+
+def analyser(args):
 
     print("--- ANALYSE K (Custom Output) ---")
     if not os.path.exists(args.results): 
@@ -151,52 +528,87 @@ def main():
     if not os.path.exists(args.output_dir):
         os.makedirs(args.output_dir)
 
-    patients = sorted([d for d in os.listdir(args.results) if os.path.isdir(os.path.join(args.results, d))])
-    donnees_globales = {k: [] for k in range(1, 31)}
-    
+    # Les dossiers cachés (ex: .scratch de generate_matches.py) ne sont pas des cibles
+    patients = sorted([d for d in os.listdir(args.results)
+                       if not d.startswith('.') and os.path.isdir(os.path.join(args.results, d))])
+
+    if args.incremental and (args.prescreen > 0 or args.sweep_thresholds or args.sweep_min_samples or args.atlas_order):
+        print("Note : --incremental ne s'applique qu'à l'analyse Top-K (calcul complet pour la pré-sélection, le balayage et la réduction)")
+
+    if args.atlas_order:
+        main_reduction(args, patients)
+        return
+
+    if args.prescreen > 0:
+        args.keys_target = args.keys_target or args.gt_target
+        args.keys_source = args.keys_source or args.gt_source
+        main_prescreening(args, patients)
+        return
+
+    if args.sweep_thresholds or args.sweep_min_samples:
+        if args.ransac != "numpy": print("Note : le balayage utilise toujours le moteur RANSAC numpy")
+        main_balayage(args, patients)
+        return
+
     print(f"Calcul sur {len(patients)} dossiers...")
-    
+
+    # Une ligne par (patient, K) écrite au fil de l'eau ; agrégats en mémoire constante (Welford)
+    path_patients = os.path.join(args.output_dir, args.name_patients_csv)
+    stats_globales = StatistiquesCourantes(K_MAX)
+    stats_landmarks = None
     count_ok = 0
-    for i, p in enumerate(patients):
-        print(f"[{i+1}] {p}...", end="", flush=True)
-        res = analyser_patient_tous_k(p, args)
-        if res:
-            for k_idx, err in enumerate(res):
-                donnees_globales[k_idx + 1].append(err)
+    with open(path_patients, 'w') as f_patients:
+        resultats = executer_patients(analyser_patient_tous_k, patients, args)
+        for i, p in enumerate(patients):
+            print(f"[{i+1}] {p}...", end="", flush=True)
+            res = next(resultats)
+            if res is None:
+                print(" ÉCHEC")
+                continue
+            n_landmarks = res.shape[1]
+            if stats_landmarks is None:
+                stats_landmarks = StatistiquesCourantes((K_MAX, n_landmarks))
+                f_patients.write("patient,K,TRE," + ",".join(f"L{l + 1}" for l in range(n_landmarks)) + "\n")
+            elif n_landmarks != stats_landmarks.n.shape[1]:
+                print(f" IGNORÉ ({n_landmarks} landmarks au lieu de {stats_landmarks.n.shape[1]})")
+                continue
+            tre = res.mean(axis=1)
+            for k_idx in range(len(res)):
+                f_patients.write(f"{p},{k_idx + 1},{tre[k_idx]:.4f}," + ",".join(f"{e:.4f}" for e in res[k_idx]) + "\n")
+            # K au-delà du nombre de candidats du patient : NaN, non compté
+            complet = np.full((K_MAX, n_landmarks), np.nan)
+            complet[:len(res)] = res
+            stats_landmarks.ajouter(complet)
+            stats_globales.ajouter(np.concatenate([tre, np.full(K_MAX - len(tre), np.nan)]))
             print(" OK")
             count_ok += 1
-        else:
-            print(" ÉCHEC")
 
     if count_ok == 0:
         print("\nAucun patient analysé avec succès.")
         return
 
     # --- GRAPHIQUE & CSV ---
-    k_axis, means, stds = [], [], []
-    for k in range(1, 31):
-        vals = donnees_globales[k]
-        if vals:
-            means.append(np.mean(vals))
-            stds.append(np.std(vals))
-            k_axis.append(k)
-    
-    if not means: return
+    presents = stats_globales.n > 0
+    k_axis = [int(k) for k in np.flatnonzero(presents) + 1]
+    means = stats_globales.moyenne[presents].tolist()
+    stds = stats_globales.ecart_type()[presents].tolist()
 
     # Chemins complets
     path_csv = os.path.join(args.output_dir, args.name_csv)
     path_png = os.path.join(args.output_dir, args.name_png)
+    path_landmarks = os.path.join(args.output_dir, args.name_landmarks_csv)
 
     # Sauvegarde CSV
     np.savetxt(path_csv, np.column_stack((k_axis, means, stds)), 
                header="K,Mean,Std", delimiter=",", fmt=["%d", "%.4f", "%.4f"])
-    print(f"\nDonnées sauvegardées : {path_csv}")
+    moyennes_lm, stds_lm = stats_landmarks.moyenne, stats_landmarks.ecart_type()
+    with open(path_landmarks, 'w') as f:
+        f.write("K,landmark,Mean,Std,N\n")
+        for k in k_axis:
+            for l in range(moyennes_lm.shape[1]):
+                f.write(f"{k},{l + 1},{moyennes_lm[k - 1, l]:.4f},{stds_lm[k - 1, l]:.4f},{stats_landmarks.n[k - 1, l]}\n")
+    print(f"\nDonnées sauvegardées : {path_csv}, {path_landmarks} (par patient : {path_patients})")
 
-    plt.figure(figsize=(10, 6))
-    plt.plot(k_axis, means, marker='o', color='#e67e22', label='Erreur Moyenne')
-    plt.fill_between(k_axis, np.array(means)-np.array(stds), np.array(means)+np.array(stds), color='#e67e22', alpha=0.1, label='Écart-type')
-
-    
     # 1. On trouve l'index du minimum
     min_err = min(means)
     index_best = means.index(min_err)
@@ -205,24 +617,22 @@ def main():
     best_k = k_axis[index_best]
     best_std = stds[index_best] 
 
-    # Partie graphique
-    plt.plot(best_k, min_err, marker='*', color='gold', markersize=15, markeredgecolor='black', 
-                label=f'Min: {min_err:.2f}mm (std: {best_std:.2f}) (K={best_k})')
-
-    plt.title(f"Influence de K") 
-    plt.xlabel("K (Nombre d'atlas utilisés)")
-    plt.ylabel("Erreur Moyenne (mm)")
-    plt.legend()
-    plt.grid(True, linestyle='--', alpha=0.6)
-
-    plt.savefig(path_png)
-    print(f"Graphique généré : {path_png}")
+    # Partie graphique (matplotlib n'est importé qu'ici)
+    if args.plot:
+        path_png_landmarks = os.path.splitext(path_png)[0] + "_landmarks.png"
+        with profiling.etape("graphique"):
+            tracer_courbe_k(path_png, k_axis, means, stds, best_k, min_err, best_std)
+            tracer_courbes_landmarks(path_png_landmarks, k_axis, moyennes_lm[np.array(k_axis) - 1], best_k)
+        print(f"Graphiques générés : {path_png}, {path_png_landmarks}")
 
     # 3. PRINT DANS LE TERMINAL
     print("\n" + "="*40)
     print(f"MEILLEUR RÉSULTAT OBTENU (K={best_k}) :")
     print(f"Moyenne    : {min_err:.4f} mm")
     print(f"Écart-type : {best_std:.4f} mm") 
+    au_best = moyennes_lm[best_k - 1]
+    pires = np.argsort(au_best)[::-1][:3]
+    print("Landmarks les plus difficiles : " + ", ".join(f"L{l + 1} ({au_best[l]:.2f} mm)" for l in pires))
     print("="*40 + "\n")
 
 if __name__ == "__main__":